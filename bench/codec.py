@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+# Micro-benchmark of the record/subrecord codec on a synthetic master.
+# Run it against another checkout with --tree to see the difference, eg:
+#   git worktree add /tmp/old HEAD~1
+#   python -m bench.codec --tree /tmp/old && python -m bench.codec
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+from bench import generate
+
+
+def best_of(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = ArgumentParser(prog="bench.codec")
+    parser.add_argument("--tree", default=None,
+            help="Import lib from this checkout instead of the current one")
+    parser.add_argument("-n", "--records", type=int, default=200000)
+    parser.add_argument("-m", "--lists", type=int, default=5000)
+    parser.add_argument("-k", "--entries", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.tree:
+        sys.path.insert(0, os.path.abspath(args.tree))
+    from lib import esm
+
+    tempdir = tempfile.mkdtemp(prefix="omw-mm-bench")
+    try:
+        path = os.path.join(tempdir, "master.esm")
+        generate.generate_plugin(path, args.records, args.lists, args.entries, esm=True)
+        num_records = args.records + args.lists
+
+        plugin = esm.Esm(path)
+        plugin.unpack()
+        records = plugin.records
+        num_subrecords = sum(len(r.subrecords) for r in records)
+        lists = [r for r in records if r.id in ("LEVC", "LEVI")]
+
+        def scan():
+            for record in records:
+                record.subrecords
+
+        def repack():
+            for record in lists:
+                record.pack_data()
+
+        def parse():
+            esm.Esm(path).unpack()
+
+        results = {"tree": os.path.abspath(args.tree or "."),
+                   "records": num_records,
+                   "subrecords": num_subrecords}
+        for name, func, count, unit in (("parse", parse, num_records, "records"),
+                                        ("scan_subrecords", scan, num_subrecords, "subrecords"),
+                                        ("pack_lists", repack, len(lists), "lists")):
+            seconds = best_of(func, args.repeat)
+            results[name] = {"seconds": seconds, "%s_per_sec" % unit: count / seconds}
+    finally:
+        shutil.rmtree(tempdir)
+
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
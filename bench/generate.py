@@ -0,0 +1,170 @@
+# -*- coding: UTF-8 -*-
+# Generators for synthetic plugins, openmw.cfg files and mod directory trees.
+# Usage: python -m bench.generate plugin out.esp -n 10000 -m 500 -k 10
+#        python -m bench.generate config out_dir --mods 1000 --plugins 2
+import os
+import random
+from struct import pack
+from argparse import ArgumentParser
+
+HEDR_FORMAT = "<fi32s256si"
+
+
+def subrecord(id, data):
+    """Pack a subrecord.
+
+    :id: (str) Subrecord id.
+    :data: (str) Packed subrecord data.
+    :returns: (str)
+    """
+    return pack("<4si", id, len(data)) + data
+
+
+def record(id, data, flags=0):
+    """Pack a record from its already packed subrecords.
+
+    :id: (str) Record id.
+    :data: (str) Packed subrecords.
+    :returns: (str)
+    """
+    return pack("<4s3i", id, len(data), 0, flags) + data
+
+
+def header_record(num_records, masters=(), esm=False, desc="Synthetic benchmark plugin"):
+    """Build a TES3 header.
+
+    :num_records: (int) Number of records following the header.
+    :masters: (list) List of (name, size) tuples.
+    :esm: (bool) Flag the file as a master. Default: False
+    :returns: (str)
+    """
+    data = subrecord("HEDR", pack(HEDR_FORMAT, 1.3, int(esm), "omw-mm bench", desc, num_records))
+    for name, size in masters:
+        data += subrecord("MAST", name + "\x00")
+        data += subrecord("DATA", pack("<q", size))
+    return record("TES3", data)
+
+
+def misc_record(index, variant=0):
+    """Build a MISC record, :variant: changes its payload but not its id."""
+    name = "bench_misc_%06d" % index
+    data = subrecord("NAME", name + "\x00")
+    data += subrecord("MODL", "m\\misc\\bench_%d.nif\x00" % (index % 97))
+    data += subrecord("FNAM", "Bench item %d\x00" % index)
+    data += subrecord("MCDT", pack("<fii", 1.0 + variant, index % 1000, 0))
+    return record("MISC", data)
+
+
+def leveled_record(id, index, entries, rng, chance_none=0, flags=0):
+    """Build a LEVI or LEVC record.
+
+    :id: (str) "LEVI" or "LEVC".
+    :index: (int) List number, lists with the same number share a NAME.
+    :entries: (int) Number of entries in the list.
+    :rng: (Random) Source for the entry ids and levels.
+    :returns: (str)
+    """
+    otype = "INAM" if id == "LEVI" else "CNAM"
+    data = subrecord("NAME", "bench_%s_%05d\x00" % (id.lower(), index))
+    data += subrecord("DATA", pack("<i", flags))
+    data += subrecord("NNAM", pack("<B", chance_none))
+    data += subrecord("INDX", pack("<i", entries))
+    for _ in range(entries):
+        data += subrecord(otype, "bench_misc_%06d\x00" % rng.randint(0, 99999))
+        data += subrecord("INTV", pack("<h", rng.randint(1, 50)))
+    return record(id, data)
+
+
+def generate_plugin(path, records=1000, lists=100, entries=10, masters=(), esm=False, seed=0):
+    """Write a synthetic plugin.
+
+    :path: (str) Output file.
+    :records: (int) Number of generic MISC records.
+    :lists: (int) Number of leveled lists, split between LEVI and LEVC.
+    :entries: (int) Entries per leveled list.
+    :masters: (list) (name, size) tuples for the header.
+    :seed: (int) Plugins generated with different seeds have overlapping
+        list names but different entries, so they can be merged.
+    :returns: (int) Number of bytes written.
+    """
+    rng = random.Random(seed)
+    with open(path, "wb") as handle:
+        handle.write(header_record(records + lists, masters, esm))
+        for index in range(records):
+            handle.write(misc_record(index, seed))
+        for index in range(lists):
+            id = "LEVI" if index % 2 else "LEVC"
+            handle.write(leveled_record(id, index, entries, rng, rng.randint(0, 50), index % 2))
+        return handle.tell()
+
+
+def generate_config(path, mods_dir, mods=100, plugins=1, fallbacks=1000, plugin_size=None):
+    """Write a synthetic openmw.cfg along with a matching mod directory tree.
+
+    :path: (str) Path of the openmw.cfg to write.
+    :mods_dir: (str) Directory where the mod directories are created.
+    :mods: (int) Number of data= entries.
+    :plugins: (int) Plugins per mod, every other one is enabled.
+    :fallbacks: (int) Number of fallback= lines.
+    :plugin_size: (tuple) records, lists, entries of each plugin.
+        Default: empty plugins with a header only.
+    :returns: (list) Paths of the created mod directories.
+    """
+    records, lists, entries = plugin_size or (0, 0, 0)
+    mod_dirs = []
+    lines = ["# Synthetic openmw.cfg generated by bench.generate", ""]
+    for index in range(fallbacks):
+        lines.append("fallback=Bench_Setting_%d,%d" % (index, index))
+
+    content = []
+    for index in range(mods):
+        mod_dir = os.path.join(mods_dir, "BenchMod%05d" % index)
+        for sub in ("textures", "meshes"):
+            if not os.path.isdir(os.path.join(mod_dir, sub)):
+                os.makedirs(os.path.join(mod_dir, sub))
+        for pindex in range(plugins):
+            name = "BenchMod%05d_%d.esp" % (index, pindex)
+            generate_plugin(os.path.join(mod_dir, name), records, lists, entries, seed=index)
+            if pindex % 2 == 0:
+                content.append(name)
+        with open(os.path.join(mod_dir, "textures", "bench.dds"), "wb") as handle:
+            handle.write("\x00" * 128)
+        lines.append('data="%s"' % mod_dir)
+        mod_dirs.append(mod_dir)
+
+    lines += ["content=%s" % name for name in content]
+    with open(path, "w") as handle:
+        handle.write("\n".join(lines) + "\n")
+
+    return mod_dirs
+
+
+def main():
+    parser = ArgumentParser(prog="bench.generate")
+    subparser = parser.add_subparsers(dest="command", metavar="<command>")
+
+    parser_p = subparser.add_parser("plugin", help="Generate a synthetic plugin")
+    parser_p.add_argument("path")
+    parser_p.add_argument("-n", "--records", type=int, default=1000)
+    parser_p.add_argument("-m", "--lists", type=int, default=100)
+    parser_p.add_argument("-k", "--entries", type=int, default=10)
+    parser_p.add_argument("--esm", action="store_true", default=False)
+    parser_p.add_argument("--seed", type=int, default=0)
+
+    parser_c = subparser.add_parser("config", help="Generate openmw.cfg and a mod tree")
+    parser_c.add_argument("dir", help="Output directory")
+    parser_c.add_argument("--mods", type=int, default=100)
+    parser_c.add_argument("--plugins", type=int, default=1)
+    parser_c.add_argument("--fallbacks", type=int, default=1000)
+
+    args = parser.parse_args()
+    if args.command == "plugin":
+        generate_plugin(args.path, args.records, args.lists, args.entries, esm=args.esm, seed=args.seed)
+    else:
+        mods_dir = os.path.join(args.dir, "mods")
+        generate_config(os.path.join(args.dir, "openmw.cfg"), mods_dir, args.mods,
+                        args.plugins, args.fallbacks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+# -*- coding: UTF-8 -*-
+# Benchmark suite for the esm parser/merger, openmw.cfg loading and mod installs.
+# Every benchmark runs in its own process so peak memory can be measured.
+# Usage: python -m bench.run [-o results.json] [--compare old.json] [--only parse,merge]
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import tempfile
+import platform
+import subprocess
+from argparse import ArgumentParser, SUPPRESS
+
+from bench import generate
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> setup function, registered with @benchmark in the order they run
+BENCHMARKS = {}
+ORDER = []
+
+
+def benchmark(name):
+    """Register a benchmark function.
+    It takes the data directory and the scale settings and returns a tuple
+    of a callable to time and a dict of units processed per call, eg: {"records": 100}
+    """
+    def decorator(func):
+        BENCHMARKS[name] = func
+        ORDER.append(name)
+        return func
+    return decorator
+
+
+def peak_memory():
+    """Return the peak resident memory of this process in KiB, None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes instead of KiB
+        peak //= 1024
+    return peak
+
+
+# -- Data generation --
+def prepare(data_dir, scale):
+    """Generate every input the benchmarks need into :data_dir:."""
+    plugin_dir = os.path.join(data_dir, "plugins")
+    os.makedirs(plugin_dir)
+    generate.generate_plugin(os.path.join(plugin_dir, "master.esm"), scale["records"],
+                             scale["lists"], scale["entries"], esm=True)
+    for index in range(scale["merge_plugins"]):
+        generate.generate_plugin(os.path.join(plugin_dir, "merge_%03d.esp" % index),
+                                 scale["records"] // 10, scale["lists"], scale["entries"],
+                                 seed=index + 1)
+
+    generate.generate_config(os.path.join(data_dir, "openmw.cfg"), os.path.join(data_dir, "mods"),
+                             scale["mods"], 2, scale["fallbacks"])
+
+    # Mod source for the install benchmarks
+    src = os.path.join(data_dir, "install_src", "BenchInstall")
+    for sub in ("textures", "meshes"):
+        os.makedirs(os.path.join(src, sub))
+        for index in range(scale["install_files"] // 2):
+            with open(os.path.join(src, sub, "file_%05d.bin" % index), "wb") as handle:
+                handle.write(os.urandom(scale["install_file_size"]))
+    generate.generate_plugin(os.path.join(src, "BenchInstall.esp"), 10, 10, 5)
+    with tarfile.open(os.path.join(data_dir, "BenchInstall.tar.gz"), "w:gz") as archive:
+        archive.add(src, "BenchInstall")
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            total += os.path.getsize(os.path.join(root, fname))
+    return total
+
+
+# -- Benchmarks --
+@benchmark("parse")
+def bench_parse(data_dir, scale):
+    from lib.esm import Esm
+    path = os.path.join(data_dir, "plugins", "master.esm")
+
+    def run():
+        Esm(path).unpack()
+
+    return run, {"records": scale["records"] + scale["lists"], "bytes": os.path.getsize(path)}
+
+
+@benchmark("pack")
+def bench_pack(data_dir, scale):
+    from lib.esm import Esm
+    path = os.path.join(data_dir, "plugins", "master.esm")
+    esm = Esm(path)
+    esm.unpack()
+
+    def run():
+        esm.pack()
+
+    return run, {"records": scale["records"] + scale["lists"], "bytes": os.path.getsize(path)}
+
+
+@benchmark("merge")
+def bench_merge(data_dir, scale):
+    from lib.esm import Esm
+    plugin_dir = os.path.join(data_dir, "plugins")
+    paths = [os.path.join(plugin_dir, "merge_%03d.esp" % i) for i in range(scale["merge_plugins"])]
+
+    def run():
+        merged = Esm(os.path.join(BASE_DIR, "Merged.esp"))
+        merged.unpack()
+        for path in paths:
+            other = Esm(path)
+            other.unpack()
+            merged.merge_with(other)
+        merged.post_merge()
+        merged.pack()
+
+    return run, {"lists": scale["lists"] * len(paths),
+                 "bytes": sum(os.path.getsize(p) for p in paths)}
+
+
+@benchmark("config_load")
+def bench_config_load(data_dir, scale):
+    from lib.omw import ConfigFile
+    path = os.path.join(data_dir, "openmw.cfg")
+    with open(path) as handle:
+        lines = sum(1 for _ in handle)
+
+    def run():
+        ConfigFile(path)
+
+    return run, {"lines": lines, "mods": scale["mods"]}
+
+
+def _install_benchmark(data_dir, src):
+    from lib import core
+    dest_root = tempfile.mkdtemp(dir=data_dir)
+    counter = [0]
+
+    def run():
+        dest = os.path.join(dest_root, str(counter[0]))
+        os.makedirs(dest)
+        counter[0] += 1
+        core.get_modsource(src).install(dest)
+
+    return run, {"bytes": _dir_size(os.path.join(data_dir, "install_src"))}
+
+
+@benchmark("install_dir")
+def bench_install_dir(data_dir, scale):
+    return _install_benchmark(data_dir, os.path.join(data_dir, "install_src", "BenchInstall"))
+
+
+@benchmark("install_archive")
+def bench_install_archive(data_dir, scale):
+    return _install_benchmark(data_dir, os.path.join(data_dir, "BenchInstall.tar.gz"))
+
+
+def run_single(name, data_dir, scale, repeat):
+    """Run one benchmark in this process and return its result.
+
+    :returns: (dict)
+    """
+    func, units = BENCHMARKS[name](data_dir, scale)
+    wall, cpu = [], []
+    for _ in range(repeat):
+        start_wall, start_cpu = time.time(), time.clock()
+        func()
+        wall.append(time.time() - start_wall)
+        cpu.append(time.clock() - start_cpu)
+
+    wall.sort()
+    median = wall[len(wall) // 2]
+    result = {"name": name,
+              "repeat": repeat,
+              "wall_min": wall[0],
+              "wall_median": median,
+              "cpu_min": min(cpu),
+              "peak_rss_kib": peak_memory(),
+              "units": units,
+              "throughput": {}}
+    for unit, count in units.items():
+        result["throughput"]["%s_per_sec" % unit] = count / median if median else None
+
+    return result
+
+
+def compare(old, new):
+    """Print the median wall time ratio of every benchmark in both results to stderr."""
+    old_results = {r["name"]: r for r in old["results"] if "error" not in r}
+    sys.stderr.write("%-16s %12s %12s %8s\n" % ("benchmark", "old (s)", "new (s)", "ratio"))
+    for result in new["results"]:
+        prev = old_results.get(result["name"])
+        if prev is None or "error" in result:
+            continue
+        ratio = result["wall_median"] / prev["wall_median"] if prev["wall_median"] else 0
+        sys.stderr.write("%-16s %12.4f %12.4f %7.2fx\n" % (result["name"], prev["wall_median"],
+                                                         result["wall_median"], ratio))
+
+
+def git_revision():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BASE_DIR,
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(prog="bench.run")
+    parser.add_argument("-o", "--output", default=None, help="Write the JSON results here. Default: stdout")
+    parser.add_argument("--compare", metavar="file", default=None,
+            help="Print a comparison against older results")
+    parser.add_argument("--only", default=None, help="Comma separated list of benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--records", type=int, default=50000, help="Records in the synthetic master")
+    parser.add_argument("--lists", type=int, default=2000, help="Leveled lists per plugin")
+    parser.add_argument("--entries", type=int, default=20, help="Entries per leveled list")
+    parser.add_argument("--merge-plugins", type=int, default=10, dest="merge_plugins")
+    parser.add_argument("--mods", type=int, default=2000, help="data= entries in openmw.cfg")
+    parser.add_argument("--fallbacks", type=int, default=5000)
+    parser.add_argument("--install-files", type=int, default=500, dest="install_files")
+    parser.add_argument("--install-file-size", type=int, default=65536, dest="install_file_size")
+    # Internal, used to run a benchmark in a child process
+    parser.add_argument("--single", default=None, help=SUPPRESS)
+    parser.add_argument("--data-dir", default=None, dest="data_dir", help=SUPPRESS)
+    args = parser.parse_args()
+
+    scale = {k: getattr(args, k) for k in ("records", "lists", "entries", "merge_plugins", "mods",
+                                           "fallbacks", "install_files", "install_file_size")}
+
+    if args.single:
+        json.dump(run_single(args.single, args.data_dir, scale, args.repeat), sys.stdout)
+        return
+
+    names = args.only.split(",") if args.only else ORDER
+    data_dir = tempfile.mkdtemp(prefix="omw-mm-bench")
+    results = []
+    try:
+        prepare(data_dir, scale)
+        for name in names:
+            cmd = [sys.executable, "-m", "bench.run", "--single", name, "--data-dir", data_dir,
+                   "--repeat", str(args.repeat)]
+            for key, value in scale.items():
+                cmd += ["--%s" % key.replace("_", "-"), str(value)]
+            proc = subprocess.Popen(cmd, cwd=BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+            if proc.returncode:
+                results.append({"name": name, "error": err.strip().splitlines()[-1:]})
+            else:
+                results.append(json.loads(out))
+            sys.stderr.write("%s done\n" % name)
+    finally:
+        shutil.rmtree(data_dir)
+
+    report = {"revision": git_revision(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "scale": scale,
+              "results": results}
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(json.load(handle), report)
+
+
+if __name__ == "__main__":
+    main()
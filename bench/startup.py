@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+# Measure how long omw-mm-cli.py takes to start and run cheap commands.
+# Usage: python -m bench.startup [-n runs] [-f openmw.cfg]
+import os
+import sys
+import json
+import time
+import subprocess
+from argparse import ArgumentParser
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "omw-mm-cli.py")
+
+
+def time_command(argv, runs):
+    """Run the CLI :runs: times and return timing statistics.
+
+    :argv: (list) Arguments passed to omw-mm-cli.py.
+    :runs: (int) Number of runs.
+    :returns: (dict)
+    """
+    samples = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, CLI] + argv, stdout=devnull, stderr=devnull)
+            samples.append(time.time() - start)
+
+    samples.sort()
+    return {"argv": argv,
+            "runs": runs,
+            "min": samples[0],
+            "median": samples[len(samples) // 2],
+            "max": samples[-1]}
+
+
+def time_imports(runs):
+    """Time a bare interpreter start and the import of the CLI module alone.
+
+    :returns: (list) Results for the interpreter and the import.
+    """
+    results = []
+    for name, code in (("python", "pass"),
+                       ("import", "import imp; imp.load_source('cli', %r)" % CLI)):
+        samples = []
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, "-c", code])
+            samples.append(time.time() - start)
+        samples.sort()
+        results.append({"argv": [name], "runs": runs, "min": samples[0],
+                        "median": samples[len(samples) // 2], "max": samples[-1]})
+    return results
+
+
+def main():
+    parser = ArgumentParser(prog="bench.startup")
+    parser.add_argument("-n", "--runs", type=int, default=20, help="Runs per command. Default: 20")
+    parser.add_argument("-f", "--file", dest="cfg", default=None, help="openmw.cfg used by the commands")
+    args = parser.parse_args()
+
+    cfg_args = ["--no-daemon"]
+    if args.cfg:
+        cfg_args += ["-f", args.cfg]
+
+    results = time_imports(args.runs)
+    for argv in (["--help"], ["list"], ["list-plugins"]):
+        results.append(time_command(cfg_args + argv, args.runs))
+
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: UTF-8 -*-
+# The data files view OpenMW builds from openmw.cfg and the config files it
+# chains to: BSA archives listed in fallback-archive= entries, then loose
+# files of every data= directory.
+# Later sources override earlier ones and loose files override archives.
+import os
+from collections import OrderedDict, namedtuple
+
+import timings
+from bsa import BsaArchive
+from omw import ConfigChain
+
+ARCHIVE_EXTENSIONS = (".bsa",)
+
+LOOSE = "loose"
+ARCHIVE = "bsa"
+
+# :source: is the data directory or the archive providing the file.
+Provider = namedtuple("Provider", ("source", "kind"))
+
+
+def find_archives(chain):
+    """Resolve the fallback-archive= entries of the config chain to paths.
+    Like plugins, an archive is taken from the last data directory having it.
+
+    :chain: (ConfigChain)
+    :returns: (list) (name, path) in load order, path is None for missing archives.
+    """
+    found = {}
+    for mod in chain.mods:
+        for fname in mod.archives:
+            found[fname.lower()] = os.path.join(mod.path, fname)
+    return [(name, found.get(name.lower())) for name in chain.get("fallback-archive")]
+
+
+def collect_assets(cfg, cache=None, collisions=None):
+    """Build the data files view of openmw.cfg, see ConfigChain.
+
+    :cfg: (ConfigFile)
+    :cache: (FileCache) Optional, on-disk cache of BSA indexes.
+    :collisions: (list) Optional, filled with (mod path, relative paths)
+        for files of a mod whose names only differ by case.
+    :returns: (OrderedDict) Case insensitive path (see paths.normalize) ->
+        list of Provider, lowest priority first so the last one is the file
+        OpenMW uses.
+    """
+    chain = ConfigChain(cfg)
+    assets = OrderedDict()
+    with timings.phase("assets"):
+        for name, path in find_archives(chain):
+            if path is None:
+                continue
+            provider = Provider(path, ARCHIVE)
+            for rel in BsaArchive(path, cache).names:
+                assets.setdefault(rel, []).append(provider)
+        for mod in chain.mods:
+            if not os.path.isdir(mod.path):
+                continue
+            provider = Provider(mod.path, LOOSE)
+            for key, found in mod.data_files().iteritems():
+                assets.setdefault(key, []).append(provider)
+                if collisions is not None and len(found) > 1:
+                    collisions.append((mod.path, sorted(found)))
+    return assets
@@ -0,0 +1,169 @@
+# -*- coding: UTF-8 -*-
+# Morrowind BSA archives.
+# Layout: a 12 byte header (version, hash table offset, file count), the
+# file records (size, offset), name offsets, the names, the hash table and
+# then the file data. Only the index part is read (through mmap), it is
+# cached on disk, file data is sliced out of the mapping on demand.
+import os
+import mmap
+from array import array
+from struct import Struct
+
+import timings
+
+VERSION = 0x100
+
+_HEADER = Struct("<3I")
+
+
+def tes3_hash(name):
+    """Hash of a file name the way Morrowind stores it in the hash table.
+
+    :name: (str) Path inside the archive, eg: "textures\\tx_a.dds"
+    :returns: (tuple) (low, high)
+    """
+    name = name.lower().replace("/", "\\")
+    # The game hashes signed chars, non ascii characters are sign extended.
+    codes = [c | 0xFFFFFF00 if c > 127 else c for c in bytearray(name)]
+    half = len(codes) >> 1
+    low = off = 0
+    for i in range(half):
+        low ^= (codes[i] << (off & 0x1F)) & 0xFFFFFFFF
+        off += 8
+    high = off = 0
+    for i in range(half, len(codes)):
+        temp = (codes[i] << (off & 0x1F)) & 0xFFFFFFFF
+        high ^= temp
+        n = temp & 0x1F
+        high = ((high << (32 - n)) | (high >> n)) & 0xFFFFFFFF  # rotate right
+        off += 8
+    return low, high
+
+
+def read_index(path):
+    """Read the index of a BSA without touching the file data.
+
+    :path: (str) Path to the archive.
+    :returns: (dict) "names" (lowercase names, "/" separated, joined with
+        null characters), "sizes", "offsets" (offsets are absolute) and
+        "hashes" (low and high words interleaved) as raw uint32 arrays
+        (strings, arrays pickle as lists of ints), all in archive order.
+    :raises: (ValueError) If the file isn't a Morrowind BSA.
+    """
+    with timings.phase("bsa index", os.path.basename(path)) as timer, open(path, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if size < _HEADER.size:
+            raise ValueError("%s is not a BSA archive." % path)
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            version, hash_offset, count = _HEADER.unpack_from(data)
+            names_start = _HEADER.size + count * 12
+            hashes_start = _HEADER.size + hash_offset
+            data_start = hashes_start + count * 8
+            if version != VERSION or data_start > size or hash_offset < count * 12:
+                raise ValueError("%s is not a Morrowind BSA archive." % path)
+
+            records = array("I")
+            records.fromstring(data[_HEADER.size:_HEADER.size + count * 8])
+            name_offsets = array("I")
+            name_offsets.fromstring(data[_HEADER.size + count * 8:names_start])
+            hashes = array("I")
+            hashes.fromstring(data[hashes_start:data_start])
+            blob = data[names_start:hashes_start]
+            timer.read(data_start)
+        finally:
+            data.close()
+
+    names = []
+    for i in range(count):
+        start = name_offsets[i]
+        end = blob.find("\x00", start)
+        names.append(blob[start:end if end != -1 else len(blob)])
+    sizes = records[0::2]
+    offsets = array("I", (data_start + offset for offset in records[1::2]))
+    return {"names": "\x00".join(names).lower().replace("\\", "/"), "sizes": sizes.tostring(),
+            "offsets": offsets.tostring(), "hashes": hashes.tostring()}
+
+
+class BsaArchive(object):
+    """A Morrowind BSA archive, files are looked up through the hash table."""
+
+    def __init__(self, path, cache=None):
+        """
+        :path: (str) Path to the archive.
+        :cache: (FileCache) Optional, on-disk cache of indexes.
+        """
+        self._path = path
+        if cache is not None:
+            self._index = cache.get_or_compute(path, read_index)
+        else:
+            self._index = read_index(path)
+        self._sizes = array("I")
+        self._sizes.fromstring(self._index["sizes"])
+        self._offsets = array("I")
+        self._offsets.fromstring(self._index["offsets"])
+        self._names = None
+        self._lookup = None
+        self._handle = None
+        self._data = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def name(self):
+        return os.path.basename(self._path)
+
+    @property
+    def names(self):
+        """Lowercase names of every file in the archive, "/" separated."""
+        if self._names is None:
+            self._names = self._index["names"].split("\x00") if self._index["names"] else []
+        return self._names
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def find(self, name):
+        """Return the position of a file in the archive, None if it isn't there.
+
+        :name: (str) Path inside the archive, case and separators don't matter.
+        """
+        if self._lookup is None:
+            hashes = array("I")
+            hashes.fromstring(self._index["hashes"])
+            self._lookup = dict(zip(zip(hashes[0::2], hashes[1::2]), xrange(len(self))))
+        i = self._lookup.get(tes3_hash(name))
+        if i is None or self.names[i] != name.lower().replace("\\", "/"):
+            return None
+        return i
+
+    def size(self, name):
+        """Return the size of a file, None if it isn't in the archive."""
+        i = self.find(name)
+        return None if i is None else self._sizes[i]
+
+    def read(self, name):
+        """Return the contents of a file.
+
+        :name: (str) Path inside the archive.
+        :raises: (KeyError) If the file isn't in the archive.
+        """
+        i = self.find(name)
+        if i is None:
+            raise KeyError(name)
+        if self._data is None:
+            self._handle = open(self._path, "rb")
+            self._data = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = self._offsets[i]
+        return self._data[offset:offset + self._sizes[i]]
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._handle.close()
+            self._data = self._handle = None
@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+# On-disk cache of values computed from files (plugin indexes, hashes...).
+# Every entry is tied to the size and mtime of the file it was computed
+# from, so changing a file only invalidates its own entries.
+import os
+import hashlib
+import cPickle as pickle
+
+import core
+
+
+def file_key(path):
+    """Return the (size, mtime) signature used to validate cache entries.
+
+    :path: (str) Path to the file.
+    :returns: (tuple)
+    """
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime)
+
+
+class FileCache(object):
+    """A named cache storing one pickle per source file."""
+
+    # Bump when the layout of cached values changes.
+    VERSION = 2
+
+    def __init__(self, name, cache_dir=None):
+        """
+        :name: (str) Cache name, also the name of its directory.
+        :cache_dir: (str) Base directory. Default: core.get_cache_dir()
+        """
+        self._name = name
+        self._dir = os.path.join(cache_dir or core.get_cache_dir(), name)
+        self._memory = {}  # path -> (key, value)
+
+    @property
+    def name(self):
+        return self._name
+
+    def _entry_path(self, path):
+        digest = hashlib.sha1(os.path.abspath(path)).hexdigest()
+        return os.path.join(self._dir, digest + ".pickle")
+
+    def get(self, path):
+        """Return the cached value for :path:, None if missing or stale.
+
+        :path: (str) Source file the value was computed from.
+        """
+        try:
+            key = file_key(path)
+        except OSError:
+            return None
+
+        entry = self._memory.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        try:
+            with open(self._entry_path(path), "rb") as handle:
+                version, stored_key, value = pickle.load(handle)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if version != self.VERSION or stored_key != key:
+            return None
+
+        self._memory[path] = (key, value)
+        return value
+
+    def set(self, path, value):
+        """Store :value: for :path:, failures to write are ignored.
+
+        :path: (str) Source file the value was computed from.
+        :value: (picklable)
+        """
+        key = file_key(path)
+        self._memory[path] = (key, value)
+        entry_path = self._entry_path(path)
+        tmp_path = entry_path + ".tmp%d" % os.getpid()
+        try:
+            if not os.path.isdir(self._dir):
+                os.makedirs(self._dir)
+            with open(tmp_path, "wb") as handle:
+                pickle.dump((self.VERSION, key, value), handle, pickle.HIGHEST_PROTOCOL)
+            if os.name == "nt" and os.path.exists(entry_path):
+                os.remove(entry_path)
+            os.rename(tmp_path, entry_path)
+        except (IOError, OSError):
+            pass
+
+    def get_or_compute(self, path, func):
+        """Return the cached value for :path:, computing and storing it if needed.
+
+        :path: (str) Source file.
+        :func: (callable) Called with :path: to compute the value.
+        """
+        value = self.get(path)
+        if value is None:
+            value = func(path)
+            self.set(path, value)
+        return value
+
+    def clear(self):
+        """Remove every entry of this cache."""
+        self._memory.clear()
+        if os.path.isdir(self._dir):
+            for fname in os.listdir(self._dir):
+                os.remove(os.path.join(self._dir, fname))
+
+
+class HashCache(object):
+    """Content hashes of many files in a single pickle, for caches with an
+    entry per file where FileCache's file per entry would be too many files.
+    Entries are tied to the (size, mtime) of their file.
+    """
+
+    VERSION = 1
+
+    def __init__(self, name, cache_dir=None):
+        """
+        :name: (str) Cache name, also the name of its file.
+        :cache_dir: (str) Base directory. Default: core.get_cache_dir()
+        """
+        self._path = os.path.join(cache_dir or core.get_cache_dir(), name + ".pickle")
+        self._entries = None  # path -> (size, mtime, {kind: digest})
+        self._dirty = False
+
+    def _load(self):
+        self._entries = {}
+        try:
+            with open(self._path, "rb") as handle:
+                version, entries = pickle.load(handle)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return
+        if version == self.VERSION:
+            self._entries = entries
+
+    def get(self, path, size, mtime, kind):
+        """Return the :kind: hash of a file, None if missing or stale.
+
+        :path: (str) Path to the file.
+        :size: (int) Current size of the file.
+        :mtime: (float) Current mtime of the file.
+        :kind: (str) Name of the hash, eg: "full"
+        """
+        if self._entries is None:
+            self._load()
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != size or entry[1] != mtime:
+            return None
+        return entry[2].get(kind)
+
+    def set(self, path, size, mtime, kind, digest):
+        """Store the :kind: hash of a file, see get()."""
+        if self._entries is None:
+            self._load()
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != size or entry[1] != mtime:
+            entry = self._entries[path] = (size, mtime, {})
+        entry[2][kind] = digest
+        self._dirty = True
+
+    def save(self):
+        """Write the cache if anything changed, failures to write are ignored."""
+        if not self._dirty:
+            return
+        tmp_path = self._path + ".tmp%d" % os.getpid()
+        try:
+            if not os.path.isdir(os.path.dirname(self._path)):
+                os.makedirs(os.path.dirname(self._path))
+            with open(tmp_path, "wb") as handle:
+                pickle.dump((self.VERSION, self._entries), handle, pickle.HIGHEST_PROTOCOL)
+            if os.name == "nt" and os.path.exists(self._path):
+                os.remove(self._path)
+            os.rename(tmp_path, self._path)
+            self._dirty = False
+        except (IOError, OSError):
+            pass
@@ -28,6 +28,9 @@ def set_defaults(config):
     config.set("General", "openmw_cfg", core.get_full_path(openmw_cfg))
     config.set("General", "mods_dir", core.get_full_path(mods_dir))
     config.set("General", "never_merge", "Morrowind.esm,Tribunal.esm,Bloodmoon.esm,Merged_Lists.esp")
+    config.set("General", "cache_dir", core.get_default_cache_dir())
+    config.set("General", "sort_rules", "")
+    config.set("General", "trash_days", "7")
 
     return config
 
@@ -91,11 +94,22 @@ def write_config(config, path):
         config.write(fp)
 
 
-# Present the config object to be imported here.
-path = get_config_path()
-if not os.path.exists(path):
-    # No config file detected, create a new one
-    config = init(path)
-else:
-    # Config file already exists.
-    config = read_config(path)
+_config = None
+
+
+def get_config():
+    """Return the omw-mm config object, reading (or creating) it on first use.
+
+    :returns: (SafeConfigParser)
+    """
+    global _config
+    if _config is None:
+        path = get_config_path()
+        if not os.path.exists(path):
+            # No config file detected, create a new one
+            _config = init(path)
+        else:
+            # Config file already exists.
+            _config = read_config(path)
+
+    return _config
@@ -4,8 +4,16 @@
 # functions that call them.
 import os
 import sys
-import shutil
+import stat
 import platform
+import tempfile
+
+# Set by the daemon so commands can be served from its in-memory state.
+# Takes a full path and returns an object, see open_config and open_esm_header.
+config_provider = None
+header_provider = None
+
+DAEMON_SOCKET_ENV = "OMW_MM_SOCKET"
 
 
 def get_modsource(path):
@@ -23,6 +31,34 @@ def get_modsource(path):
         return ModSourceArchive(path)
 
 
+def open_config(path):
+    """Return a ConfigFile for openmw.cfg at :path:.
+    If a daemon is serving the command the cached object is returned instead.
+
+    :path: (str) Path to openmw.cfg.
+    :returns: (ConfigFile)
+    """
+    path = get_full_path(path)
+    if config_provider is not None:
+        return config_provider(path)
+
+    from omw import ConfigFile
+    return ConfigFile(path)
+
+
+def open_esm_header(path):
+    """Return the parsed TES3 header of a plugin.
+
+    :path: (str) Path to the plugin.
+    :returns: (EsmTES3Record)
+    """
+    if header_provider is not None:
+        return header_provider(path)
+
+    from esm import Esm
+    return Esm(path).header
+
+
 def get_full_path(path):
     """Return the full expanded path of :path:.
 
@@ -43,19 +79,39 @@ def get_full_path(path):
     return path
 
 
-# TODO: Make this function safer.
-def rm_mod_dir(mod_dir):
-    """Delete a mod directory
+def atomic_write(path, data):
+    """Replace the contents of :path: with :data: without ever leaving a
+    partially written file behind.
+    The data goes to a temp file in the same directory which is synced to
+    disk and renamed over :path:, the original permissions are kept.
 
-    :mod_dir: (str) Path to the mod directory to be deleted.
-    :raises: (ValueError)
+    :path: (str) Path to the file.
+    :data: (str) New contents.
     """
-    if not os.path.exists(mod_dir):
-        raise ValueError("'%s' does not exist." % mod_dir)
-    if not os.path.isdir(mod_dir):
-        raise ValueError("'%s' is not a directory." % mod_dir)
-
-    shutil.rmtree(mod_dir)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), dir=directory)
+    try:
+        with os.fdopen(fd, "w") as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+            if os.name == "nt":  # rename doesn't replace files on windows.
+                os.remove(path)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # Make the rename itself durable.
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
 
 def get_plugins(cfg):
@@ -75,6 +131,28 @@ def get_plugins_enabled(cfg):
     return [p for p in cfg.plugins if not p.is_orphan]
 
 
+def get_load_order(cfg):
+    """Paths of the plugins OpenMW loads, following the config= chain of
+    openmw.cfg. Plugins no data directory has are left out.
+
+    :cfg: (ConfigFile) openmw.cfg object.
+    :returns: (list)
+    """
+    from omw import ConfigChain
+    return [path for _, path in ConfigChain(cfg).plugin_paths() if path is not None]
+
+
+def get_installed_plugins(cfg):
+    """Paths of every plugin in the data directories, following the config=
+    chain of openmw.cfg, eg: to find masters.
+
+    :cfg: (ConfigFile) openmw.cfg object.
+    :returns: (dict) lowercase plugin name -> path
+    """
+    from omw import ConfigChain
+    return ConfigChain(cfg).installed_plugins()
+
+
 def get_plugins_disabled(cfg):
     """Get a list of plugins that are installed but not enabled.
 
@@ -116,6 +194,77 @@ def get_base_dir():
     return os.path.realpath(sys.path[0])
 
 
+def get_default_daemon_socket():
+    """Return the default path of the daemon's UNIX socket.
+
+    :returns: (str) Path
+    """
+    return os.path.join(get_base_dir(), "omw-mm.sock")
+
+
+def get_daemon_socket():
+    """Return the path of the daemon's UNIX socket, $OMW_MM_SOCKET or the default.
+    omw-mm.cfg isn't read, every command looks for a daemon before parsing
+    its arguments and most of them don't need the config.
+
+    :returns: (str) Path
+    """
+    path = os.environ.get(DAEMON_SOCKET_ENV)
+    if path:
+        return get_full_path(path)
+
+    return get_default_daemon_socket()
+
+
+def get_default_cache_dir():
+    """Return the default directory for on-disk caches.
+
+    :returns: (str) Path
+    """
+    return os.path.join(get_base_dir(), "cache")
+
+
+def get_cache_dir():
+    """Return the configured directory for on-disk caches.
+
+    :returns: (str) Path
+    """
+    from config import get_config
+    config = get_config()
+    if config.has_option("General", "cache_dir"):
+        return get_full_path(config.get("General", "cache_dir"))
+
+    return get_default_cache_dir()
+
+
+def get_sort_rules():
+    """Return the configured mlox rule files used to sort the load order.
+
+    :returns: (list) Paths
+    """
+    from config import get_config
+    config = get_config()
+    if not config.has_option("General", "sort_rules"):
+        return []
+
+    rules = config.get("General", "sort_rules")
+    return [get_full_path(path.strip()) for path in rules.split(",") if path.strip()]
+
+
+def get_trash_days():
+    """Return how many days uninstalled mods stay in the trash before the
+    reaper deletes them.
+
+    :returns: (float)
+    """
+    from config import get_config
+    config = get_config()
+    if config.has_option("General", "trash_days"):
+        return config.getfloat("General", "trash_days")
+
+    return 7.0
+
+
 # This function exists because whoever wrote the libarchive module
 # didn't take into consideration cross-platform support for libarchive.
 # so im shipping pre-compiled libarchive libraries and manually setting
@@ -123,7 +272,9 @@ def get_base_dir():
 # TODO: Test the rest of the platforms if they are working
 # So far tested linux64 windows32 and OSX Snow Leopard
 def setup_libarchive():
-    """Setup the path variable to point to the bundled libarchive libs."""
+    """Setup the path variable to point to the bundled libarchive libs.
+    Use get_libarchive() instead so this only happens once.
+    """
     OS = platform.system()
     ARCH = platform.architecture()[0]
     libdir = os.path.join(get_base_dir(), "lib/bin/%s/%s" % (OS, ARCH))
@@ -141,3 +292,18 @@ def setup_libarchive():
         return libarchive
     finally:
         os.chdir(curdir)
+
+
+_libarchive = None
+
+
+def get_libarchive():
+    """Return the libarchive module, loading the bundled library on first use.
+
+    :returns: (module) libarchive.public
+    """
+    global _libarchive
+    if _libarchive is None:
+        _libarchive = setup_libarchive()
+
+    return _libarchive
@@ -0,0 +1,423 @@
+# -*- coding: UTF-8 -*-
+# Background service that keeps openmw.cfg, the mod/plugin indexes and plugin
+# headers in memory and serves CLI commands over a local UNIX socket.
+# The protocol is one JSON object per line in each direction:
+#   request:  {"argv": [...], "cwd": "..."}
+#   response: {"output": "...", "status": 0}
+import os
+import sys
+import json
+import errno
+import select
+import socket
+import struct
+from StringIO import StringIO
+
+import core
+
+
+# -- Filesystem watchers --
+class PollWatcher(object):
+    """Fallback watcher that compares mtimes of watched paths on every poll."""
+
+    def __init__(self):
+        self._watches = {}  # path -> (stat signature, key)
+
+    def fileno(self):
+        return None
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def watch(self, path, key):
+        """Start watching :path:, changes are reported as :key:.
+
+        :path: (str) File or directory to watch.
+        :key: (hashable) Value returned by poll() when path changes.
+        """
+        self._watches[path] = (self._stat(path), key)
+
+    def unwatch(self, path):
+        self._watches.pop(path, None)
+
+    def poll(self):
+        """Return the set of keys whose path changed since the last poll.
+
+        :returns: (set)
+        """
+        changed = set()
+        for path, (sig, key) in self._watches.items():
+            new_sig = self._stat(path)
+            if new_sig != sig:
+                self._watches[path] = (new_sig, key)
+                changed.add(key)
+        return changed
+
+
+class InotifyWatcher(object):
+    """Linux inotify watcher, only touches the kernel queue when something changed."""
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_NONBLOCK = 0x00000800
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    _event = struct.Struct("iIII")
+
+    def __init__(self):
+        # ctypes is only imported here so that CLI clients stay cheap to start.
+        import ctypes
+        import ctypes.util
+        self._ctypes = ctypes
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        # Without argtypes a unicode path would be passed as a wchar_t*.
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._libc = libc
+        self._fd = libc.inotify_init1(self.IN_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._wds = {}  # watch descriptor -> directory path
+        self._dir_watches = {}  # directory path -> watch descriptor
+        # (directory, name or None) -> key, None matches any name in the dir.
+        self._keys = {}
+
+    def fileno(self):
+        return self._fd
+
+    def watch(self, path, key):
+        """Start watching :path:, changes are reported as :key:.
+        Files are watched through their parent directory so atomic renames
+        over the file are noticed as well.
+
+        :path: (str) File or directory to watch.
+        :key: (hashable) Value returned by poll() when path changes.
+        """
+        path = _fs_path(path)
+        if os.path.isdir(path):
+            directory, name = path, None
+        else:
+            directory, name = os.path.split(path)
+
+        if directory not in self._dir_watches:
+            wd = self._libc.inotify_add_watch(self._fd, directory, self.MASK)
+            if wd < 0:
+                raise OSError(self._ctypes.get_errno(), "Cannot watch %s" % directory)
+            self._wds[wd] = directory
+            self._dir_watches[directory] = wd
+        self._keys[(directory, name)] = key
+
+    def unwatch(self, path):
+        path = _fs_path(path)
+        if os.path.isdir(path):
+            self._keys.pop((path, None), None)
+        else:
+            self._keys.pop(os.path.split(path), None)
+
+    def poll(self):
+        """Drain pending events and return the set of changed keys.
+
+        :returns: (set)
+        """
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not buf:
+                break
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = self._event.unpack_from(buf, offset)
+                offset += self._event.size
+                name = buf[offset:offset + length].rstrip("\x00")
+                offset += length
+
+                directory = self._wds.get(wd)
+                if directory is None:
+                    continue
+                for lookup in ((directory, None), (directory, name)):
+                    if lookup in self._keys:
+                        changed.add(self._keys[lookup])
+
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    # The directory is gone, a new watch is needed if it comes back.
+                    del self._wds[wd]
+                    del self._dir_watches[directory]
+        return changed
+
+
+def _fs_path(path):
+    # Event names are read as bytes, watched paths must be bytes too.
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or "utf-8")
+    return path
+
+
+def get_watcher():
+    """Return the best available filesystem watcher for this platform."""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return PollWatcher()
+
+
+# -- Cached state --
+class DaemonState(object):
+    """In-memory ConfigFile and plugin header cache, invalidated by a watcher."""
+
+    def __init__(self, watcher=None):
+        self._watcher = watcher or get_watcher()
+        self._configs = {}  # openmw.cfg path -> ConfigFile
+        self._headers = {}  # plugin path -> EsmTES3Record
+
+    @property
+    def watcher(self):
+        return self._watcher
+
+    def refresh(self):
+        """Drop every cached object whose files changed on disk."""
+        for key in self._watcher.poll():
+            kind, path = key
+            if kind == "config":
+                self._drop_config(path)
+            elif kind == "header":
+                self._headers.pop(path, None)
+                self._watcher.unwatch(path)
+
+    def _drop_config(self, path):
+        cfg = self._configs.pop(path, None)
+        if cfg is None:
+            return
+        self._watcher.unwatch(path)
+        for mod in cfg.mods:
+            self._watcher.unwatch(mod.path)
+
+    def get_config(self, path):
+        """Return the cached ConfigFile for :path:, loading it if needed.
+
+        :path: (str) Full path to openmw.cfg.
+        :returns: (ConfigFile)
+        """
+        self.refresh()
+        cfg = self._configs.get(path)
+        if cfg is None:
+            from omw import ConfigFile
+            cfg = ConfigFile(path)
+            key = ("config", path)
+            self._watcher.watch(path, key)
+            # Plugins are only looked up in the root of each data directory,
+            # so a change there is all that can alter the mod/plugin index.
+            for mod in cfg.mods:
+                if os.path.isdir(mod.path):
+                    self._watcher.watch(mod.path, key)
+            self._configs[path] = cfg
+        return cfg
+
+    def get_header(self, path):
+        """Return the cached TES3 header of the plugin at :path:.
+
+        :path: (str) Path to the plugin.
+        :returns: (EsmTES3Record)
+        """
+        self.refresh()
+        header = self._headers.get(path)
+        if header is None:
+            from esm import Esm
+            header = Esm(path).header
+            self._watcher.watch(path, ("header", path))
+            self._headers[path] = header
+        return header
+
+
+# -- Server and client --
+class Daemon(object):
+    """Serve CLI commands over a UNIX socket using a shared DaemonState."""
+
+    def __init__(self, sock_path, handler, state=None):
+        """
+        :sock_path: (str) Path to the UNIX socket.
+        :handler: (callable) Called with an argv list, runs a CLI command.
+        :state: (DaemonState) Default: a new DaemonState.
+        """
+        self._sock_path = sock_path
+        self._handler = handler
+        self._state = state or DaemonState()
+        self._sock = None
+
+    @property
+    def state(self):
+        return self._state
+
+    def _bind(self):
+        if os.path.exists(self._sock_path):
+            if is_running(self._sock_path):
+                raise ValueError("A daemon is already listening on %s" % self._sock_path)
+            os.remove(self._sock_path)  # Stale socket from a dead daemon.
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self._sock_path)
+        os.chmod(self._sock_path, 0o600)
+        sock.listen(16)
+        return sock
+
+    def serve_forever(self):
+        """Accept and run commands until a "daemon-stop" request arrives."""
+        self._sock = self._bind()
+        core.config_provider = self._state.get_config
+        core.header_provider = self._state.get_header
+        try:
+            while True:
+                fds = [self._sock]
+                if self._state.watcher.fileno() is not None:
+                    fds.append(self._state.watcher)
+                readable, _, _ = select.select(fds, [], [])
+                if self._state.watcher in readable:
+                    self._state.refresh()
+                if self._sock in readable:
+                    conn, _ = self._sock.accept()
+                    try:
+                        if not self._serve_client(conn):
+                            break
+                    finally:
+                        conn.close()
+        finally:
+            core.config_provider = None
+            core.header_provider = None
+            self._sock.close()
+            if os.path.exists(self._sock_path):
+                os.remove(self._sock_path)
+
+    def _serve_client(self, conn):
+        """Run a single request, returns False if the daemon should stop."""
+        try:
+            request = json.loads(conn.makefile("r").readline())
+            argv = request["argv"]
+            if not isinstance(argv, list):
+                raise ValueError("argv is not a list")
+            # JSON strings are unicode, the commands work with byte strings.
+            argv = [_fs_path(arg) for arg in argv]
+        except socket.error:
+            # The client went away, nothing to answer.
+            return True
+        except (ValueError, TypeError, KeyError) as e:
+            _reply(conn, {"output": "Error: malformed request: %s\n" % e, "status": 1})
+            return True
+
+        if argv == ["daemon-stop"]:
+            _reply(conn, {"output": "Daemon stopped\n", "status": 0})
+            return False
+
+        output, status = self._run(argv, _fs_path(request.get("cwd")))
+        _reply(conn, {"output": output, "status": status})
+        return True
+
+    def _reset_state(self):
+        # A half applied command may have left the cached objects dirty.
+        self._state = DaemonState(self._state.watcher)
+        core.config_provider = self._state.get_config
+        core.header_provider = self._state.get_header
+
+    def _run(self, argv, cwd=None):
+        """Run :argv: through the handler capturing its output.
+
+        :returns: (tuple) output, exit status
+        """
+        prev_stdout, prev_stderr, prev_dir = sys.stdout, sys.stderr, os.getcwd()
+        out = StringIO()
+        sys.stdout = sys.stderr = out
+        status = 0
+        try:
+            if cwd:
+                os.chdir(cwd)
+            self._handler(argv)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                status = e.code
+            elif e.code:
+                out.write("%s\n" % e.code)
+                status = 1
+            if status:
+                self._reset_state()
+        except Exception as e:
+            out.write("Error: %s\n" % e)
+            status = 1
+            self._reset_state()
+        finally:
+            sys.stdout, sys.stderr = prev_stdout, prev_stderr
+            os.chdir(prev_dir)
+
+        return out.getvalue(), status
+
+
+def _send(conn, message):
+    conn.sendall(json.dumps(message) + "\n")
+
+
+def _reply(conn, message):
+    # The client may have gone away, it must not take the daemon down.
+    try:
+        _send(conn, message)
+    except socket.error:
+        pass
+
+
+def _connect(sock_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def is_running(sock_path):
+    """Check if a daemon is listening on :sock_path:.
+
+    :returns: (bool)
+    """
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(sock_path):
+        return False
+    sock = _connect(sock_path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+def send_command(sock_path, argv):
+    """Run a command in the daemon listening on :sock_path:.
+
+    :sock_path: (str) Path to the UNIX socket.
+    :argv: (list) Command line arguments.
+    :returns: (tuple or None) output, status. None if no daemon is reachable.
+    """
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(sock_path):
+        return None
+    sock = _connect(sock_path)
+    if sock is None:
+        return None
+    try:
+        _send(sock, {"argv": list(argv), "cwd": os.getcwd()})
+        response = json.loads(sock.makefile("r").readline())
+    finally:
+        sock.close()
+
+    return response["output"], response["status"]
@@ -0,0 +1,107 @@
+# -*- coding: UTF-8 -*-
+# Byte identical files across data directories.
+# Files are grouped by size first (a stat each), only same size files are
+# read: the first PARTIAL_SIZE bytes, then the whole file for the ones that
+# still match. Hashes are cached per (path, size, mtime) so rescans only
+# read what changed.
+import os
+import hashlib
+from collections import defaultdict
+
+import timings
+
+PARTIAL_SIZE = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_file(path, limit=None):
+    digest = hashlib.md5()
+    remaining = limit
+    with open(path, "rb") as handle:
+        while remaining is None or remaining > 0:
+            chunk = handle.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.digest()
+
+
+def _map(func, items, jobs):
+    if jobs < 2 or len(items) < 2:
+        return [func(item) for item in items]
+    # Reading and stating files is mostly waiting on the disk, threads are enough.
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(func, items, chunksize=32)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def find_duplicates(paths, cache=None, jobs=4, min_size=1):
+    """Find groups of byte identical files.
+
+    Hard links to the same file are counted once, they don't waste space.
+
+    :paths: (list) Files to compare.
+    :cache: (HashCache) Optional, on-disk cache of file hashes.
+    :jobs: (int) Number of files read at once.
+    :min_size: (int) Ignore files smaller than this.
+    :returns: (list) List of (size, paths) sorted by wasted space, largest first.
+    """
+    def stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        # Python 2 on windows reports 0 for every inode, links can't be told apart there.
+        link = (st.st_dev, st.st_ino) if st.st_ino else None
+        return path, st.st_size, st.st_mtime, link
+
+    def hasher(kind, limit):
+        def run(item):
+            path, size, mtime = item
+            digest = cache.get(path, size, mtime, kind) if cache is not None else None
+            if digest is None:
+                try:
+                    digest = _hash_file(path, limit)
+                except (IOError, OSError):
+                    return None  # Gone or unreadable, it just isn't compared.
+                if cache is not None:
+                    cache.set(path, size, mtime, kind, digest)
+            return digest
+        return run
+
+    def regroup(groups, kind, limit):
+        items = [item for group in groups for item in group]
+        digests = _map(hasher(kind, limit), items, jobs)
+        split = defaultdict(list)
+        for item, digest in zip(items, digests):
+            if digest is not None:
+                split[(item[1], digest)].append(item)
+        return [group for group in split.values() if len(group) > 1]
+
+    with timings.phase("dupes stat"):
+        by_size = defaultdict(list)
+        seen = set()
+        for found in _map(stat, paths, jobs):
+            if found is None or found[1] < min_size or found[3] in seen:
+                continue
+            if found[3] is not None:
+                seen.add(found[3])
+            by_size[found[1]].append(found[:3])
+        groups = [group for group in by_size.values() if len(group) > 1]
+
+    with timings.phase("dupes hash"):
+        # Large files are compared on their first bytes before reading them whole.
+        large = [g for g in groups if g[0][1] > PARTIAL_SIZE]
+        small = [g for g in groups if g[0][1] <= PARTIAL_SIZE]
+        large = regroup(large, "partial", PARTIAL_SIZE)
+        groups = regroup(small + large, "full", None)
+
+    result = [(group[0][1], sorted(item[0] for item in group)) for group in groups]
+    result.sort(key=lambda r: (-r[0] * (len(r[1]) - 1), r[1]))
+    return result
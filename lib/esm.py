@@ -1,26 +1,155 @@
 # -*- coding: UTF-8 -*-
 # Contains the Esm class that describes morrowinds esm/esp files.
 import os.path
-from StringIO import StringIO
-from struct import unpack, pack
+from array import array
+from struct import Struct
+
+
+import timings
+from schema import get_schema, iter_subrecords, RecordView
+
+
+# Precompiled codecs for the hot paths, all esm data is little endian.
+RECORD_HEADER = Struct("<4s3i")  # id, size, delflag, recflag
+SUBRECORD_HEADER = Struct("<4si")  # id, size
+HEDR = Struct("<fi32s256si")  # version, type, author, description, record count
+MASTER_SIZE = Struct("<q")
+LEV_FIELDS = Struct("<4si i 4si B 4si i")  # DATA, NNAM and INDX subrecords of leveled lists
+LEV_LEVEL = Struct("<4si h")  # INTV subrecord
+
+_structs = {}
+
+
+def get_struct(fmt):
+    """Return a cached Struct for :fmt:, little endian unless :fmt: says otherwise.
+
+    :fmt: (str) struct format string.
+    :returns: (Struct)
+    """
+    codec = _structs.get(fmt)
+    if codec is None:
+        if fmt[0] in "@=<>!":
+            codec = _structs[fmt] = Struct(fmt)
+        else:
+            codec = _structs[fmt] = Struct("<" + fmt)
+    return codec
+
+
+def stream_records(path):
+    """Read the records of a plugin one at a time, without keeping the file
+    in memory.
+
+    :path: (str) Path to the plugin.
+    :returns: (generator) offset (of the record header in the file), id,
+        delflag, recflag, data. The file header (TES3) is skipped.
+    """
+    with timings.phase("stream", os.path.basename(path)) as timer, \
+            open(path, "rb", 1024 * 1024) as handle:
+        read, unpack = handle.read, RECORD_HEADER.unpack
+        offset = 0
+        while True:
+            header = read(16)
+            if len(header) < 16:
+                break
+            id, size, delflag, recflag = unpack(header)
+            data = read(size)
+            timer.read(16 + len(data))
+            if id != "TES3":
+                yield offset, id, delflag, recflag, data
+            offset += 16 + size
+
+
+def read_record(handle, offset):
+    """Read one record of an open plugin, eg: at an offset from stream_records().
+
+    :handle: (file) Plugin opened in binary mode.
+    :offset: (int) Offset of the record header.
+    :returns: (tuple) id, delflag, recflag, data
+    """
+    handle.seek(offset)
+    id, size, delflag, recflag = RECORD_HEADER.unpack(handle.read(16))
+    return id, delflag, recflag, handle.read(size)
+
+
+# Record types that get their own EsmRecord subclass when materialized.
+LEV_RECORDS = ("LEVC", "LEVI")
+
+
+def record_class(id):
+    """Return the EsmRecord class used for records of type :id:."""
+    if id in LEV_RECORDS:
+        return EsmLEVRecord
+    return EsmRecord
 
 
 class Esm(object):
     def __init__(self, path):
         """This class describes a morrowind esm/esp file.
 
+        Records are kept in a compact index (parallel arrays of type codes,
+        offsets, sizes and flags into the raw file contents) and EsmRecord
+        objects are only created for the records that are asked for.
+
         :path: (str) Path to the file.
         """
         self._path = path
         self._records = []
+        self._reset_index()
         self.header = self.unpack_file_header()
 
+    def _reset_index(self):
+        self._buffer = ''
+        self._type_names = []  # type code -> record id
+        self._type_codes = {}  # record id -> type code
+        self._types = array("H")
+        self._offsets = array("L")  # offset of the record's data in _buffer
+        self._sizes = array("l")
+        self._delflags = array("l")
+        self._recflags = array("l")
+        self._cache = {}  # index -> materialized record
+
+    def __len__(self):
+        if self._records is None:
+            return len(self._types)
+        return len(self._records)
+
+    def _type_code(self, id):
+        code = self._type_codes.get(id)
+        if code is None:
+            code = self._type_codes[id] = len(self._type_names)
+            self._type_names.append(id)
+        return code
+
+    def record_at(self, index):
+        """Return the record at :index:, creating it from the raw data if needed.
+
+        :index: (int) Position of the record in the file (the header excluded).
+        :returns: (EsmRecord)
+        """
+        if self._records is not None:
+            return self._records[index]
+
+        record = self._cache.get(index)
+        if record is None:
+            id = self._type_names[self._types[index]]
+            offset, size = self._offsets[index], self._sizes[index]
+            record = record_class(id)(id, size, self._delflags[index], self._recflags[index],
+                                      self._buffer[offset:offset + size])
+            self._cache[index] = record
+        return record
+
     def find_records(self, id):
         """Search for a record by id.
 
         :id: (str) id of the record to search for
         :returns: (list) list of matched records
         """
+        if self._records is None:
+            code = self._type_codes.get(id)
+            if code is None:
+                return []
+            return [self.record_at(i) for i, t in enumerate(self._types) if t == code]
+
         records = []
         for record in self._records:
             if record.id == id:
@@ -28,42 +157,115 @@ class Esm(object):
 
         return records
 
+    def iter_raw(self, ids=None):
+        """Iterate over records without creating record objects.
+
+        :ids: (iterable) Only yield records of these types. Default: every record.
+        :returns: (generator) index, id, delflag, recflag, data
+        """
+        if self._records is not None:
+            for index, record in enumerate(self._records):
+                if ids is None or record.id in ids:
+                    yield index, record.id, record._delflag, record._recflag, record.data
+            return
+
+        names, buf = self._type_names, self._buffer
+        if ids is None:
+            wanted = None
+        else:
+            wanted = set(self._type_codes[id] for id in ids if id in self._type_codes)
+            if not wanted:
+                return
+        offsets, sizes = self._offsets, self._sizes
+        for index, code in enumerate(self._types):
+            if wanted is None or code in wanted:
+                offset = offsets[index]
+                yield (index, names[code], self._delflags[index], self._recflags[index],
+                       buf[offset:offset + sizes[index]])
+
+    def remove_records(self, indexes):
+        """Remove the records at :indexes: and update the header's record count.
+        Records that were never materialized stay in the index.
+
+        :indexes: (iterable) Positions of the records, see record_at().
+        """
+        drop = set(indexes)
+        if self._records is not None:
+            self._records = [r for i, r in enumerate(self._records) if i not in drop]
+        else:
+            keep = [i for i in range(len(self._types)) if i not in drop]
+            for name in ("_types", "_offsets", "_sizes", "_delflags", "_recflags"):
+                old = getattr(self, name)
+                setattr(self, name, array(old.typecode, [old[i] for i in keep]))
+            cache = self._cache
+            self._cache = dict((new, cache[old]) for new, old in enumerate(keep) if old in cache)
+        self.header.record_count = len(self)
+
     @property
     def records(self):
+        """Every record in the file, this materializes the whole index.
+        Prefer find_records() or record_at() when only a few records are needed.
+
+        :returns: (list)
+        """
+        if self._records is None:
+            records = []
+            append = records.append
+            buf, cache, names = self._buffer, self._cache, self._type_names
+            classes = [record_class(id) for id in names]
+            for index, code in enumerate(self._types):
+                record = cache.get(index)
+                if record is None:
+                    offset, size = self._offsets[index], self._sizes[index]
+                    record = classes[code](names[code], size, self._delflags[index],
+                                           self._recflags[index], buf[offset:offset + size])
+                append(record)
+            self._records = records
+            self._reset_index()
         return self._records
 
     def unpack(self):
-        """Unpack the file's records"""
-        with open(self._path, "rb") as fh:
-            EOF = len(fh.read())
-            fh.seek(0)
-            records = []
-            while not fh.tell() == EOF:  # Because python doesn't support EOF
-                # Record
-                header = fh.read(16)
-                id, size, delflag, recflag = unpack("4s3i", header)
-                data = fh.read(size)
+        """Unpack the file's records into the compact index."""
+        self._reset_index()
+        with timings.phase("parse", os.path.basename(self._path)) as timer:
+            with open(self._path, "rb") as fh:
+                buf = fh.read()
+            EOF = len(buf)
+            timer.read(EOF)
+
+            types, offsets, sizes = self._types, self._offsets, self._sizes
+            delflags, recflags = self._delflags, self._recflags
+            type_code = self._type_code
+            unpack_header = RECORD_HEADER.unpack_from
+            pos = 0
+            while pos < EOF:
+                id, size, delflag, recflag = unpack_header(buf, pos)
+                pos += 16
                 if id == "TES3":  # Seperate the file header
-                    self.header = EsmTES3Record(id, size, delflag, recflag, data)
-                    continue
-                if id in ("LEVC", "LEVI"):
-                    record = EsmLEVRecord(id, size, delflag, recflag, data)
+                    self.header = EsmTES3Record(id, size, delflag, recflag, buf[pos:pos + size])
                 else:
-                    record = EsmRecord(id, size, delflag, recflag, data)
-                records.append(record)
+                    types.append(type_code(id))
+                    offsets.append(pos)
+                    sizes.append(size)
+                    delflags.append(delflag)
+                    recflags.append(recflag)
+                pos += size
 
-        self._records = records
+        self._buffer = buf
+        self._records = None
 
     def unpack_file_header(self):
         """Unpack the file header only.
 
         :returns: (EsmTES3Record)
         """
-        with open(self._path, "rb") as handle:
-            id, size, delflag, recflag = unpack("4s3i", handle.read(16))
+        with timings.phase("parse header", os.path.basename(self._path)) as timer, \
+                open(self._path, "rb") as handle:
+            id, size, delflag, recflag = RECORD_HEADER.unpack(handle.read(16))
             assert id == "TES3"
 
             data = handle.read(size)
+            timer.read(16 + len(data))
             return EsmTES3Record(id, size, delflag, recflag, data)
 
     def pack(self):
@@ -71,14 +273,22 @@ class Esm(object):
 
         :returns: (str)
         """
-        out = ''
-        # Pack the header.
-        out += self.header.pack()
-        # Pack the records.
-        for record in self._records:
-            out += record.pack()
+        with timings.phase("pack", os.path.basename(self._path)):
+            out = [self.header.pack()]
+            if self._records is not None:
+                for record in self._records:
+                    out.append(record.pack())
+            else:
+                # Records that were never materialized are copied as they are.
+                buf, cache = self._buffer, self._cache
+                for index, offset in enumerate(self._offsets):
+                    record = cache.get(index)
+                    if record is None:
+                        out.append(buf[offset - 16:offset + self._sizes[index]])
+                    else:
+                        out.append(record.pack())
 
-        return out
+        return "".join(out)
 
     def write(self, path=None):
         """Write the contents of the Esm to a file.
@@ -88,18 +298,26 @@ class Esm(object):
         if not path:
             path = self._path
 
-        with open(path, "wb") as handle:
-            handle.write(self.pack())
+        data = self.pack()
+        with timings.phase("write", os.path.basename(path)) as timer, open(path, "wb") as handle:
+            handle.write(data)
+            timer.written(len(data))
 
-    def merge_with(self, other):
+    def merge_with(self, other, report=None):
         """Merge leveled lists from another esm with this one.
 
         :other: (Esm) esm instance to be merged with this.
+        :report: (MergeReport) Optional, records every list of :other: as it is merged.
         :returns: (dict) merged and Added leveled lists
         """
         if not isinstance(other, Esm):
             raise ValueError("Expecting Esm object, got %s" % other)
 
+        with timings.phase("merge", os.path.basename(other._path)):
+            return self._merge_with(other, report)
+
+    def _merge_with(self, other, report):
+        plugin = os.path.basename(other._path)
         diff = {}
         num_diff = 0
         for rec in ("LEVC", "LEVI"):
@@ -107,6 +325,8 @@ class Esm(object):
             my_records = {r._name: r for r in self.find_records(rec)}
             other_records = {r._name: r for r in other.find_records(rec)}
             for id, record in other_records.items():
+                if report is not None:  # Before merging changes the records.
+                    report.add(plugin, record)
                 if id not in my_records:  # Add all LEV records so we can tell which ones need merging in the future
                     my_records[id] = record
                     diff[rec]["Added"][id] = my_records[id]
@@ -118,11 +338,11 @@ class Esm(object):
             for index, record in enumerate(self.records):
                 if record.id == rec:
                     if record._name in diff[rec]["Merged"]:
-                        self._records[index] = diff[rec]["Merged"][record._name]
+                        self.records[index] = diff[rec]["Merged"][record._name]
 
             # Add the new records (to the bottom of the file?)
             for _, record in diff[rec]["Added"].items():
-                self._records.append(record)
+                self.records.append(record)
 
             num_diff += len(diff[rec]["Merged"]) + len(diff[rec]["Added"])
 
@@ -138,13 +358,15 @@ class Esm(object):
         for rec in ("LEVC", "LEVI"):
             unmerged = [r for r in self.find_records(rec) if not r._merged]
             for record in unmerged:
-                self._records.remove(record)
+                self.records.remove(record)
 
 
 # This class is intended as read-only, Create a subclass so you can tell it how to
 # repack its data by redefining the pack_data() method.
 class EsmRecord(object):
     """Describes a esm record"""
+    # Large masters have hundreds of thousands of records, no per instance __dict__.
+    __slots__ = ("_id", "_size", "__data", "_delflag", "_recflag", "_changed")
 
     def __init__(self, id, size, delflag, recflag, data):
         """Takes a record id size flags and its raw data, parses the data into subrecords.
@@ -182,16 +404,16 @@ class EsmRecord(object):
 
         :returns: (list) List of subrecords
         """
-        subrecords = []
         data = self.data
-        stream = StringIO(data)
-        EOF = len(data)
-        while not stream.tell() == EOF:
-            header = stream.read(8)
-            id, size = unpack("4si", header)
-            data = stream.read(size)
-            subrecords.append(EsmSubrecord(id, size, data))
-        return subrecords
+        return [EsmSubrecord(id, size, data[offset:offset + size])
+                for id, offset, size in iter_subrecords(data)]
+
+    def view(self):
+        """Return a lazily decoded view of the record's subrecords, see lib.schema.
+
+        :returns: (RecordView)
+        """
+        return RecordView(self.id, self.data)
 
     def pack_subrecord(self, id, data, data_format=None):
         """Calculate the size of a subrecord and pack into the specified format.
@@ -201,25 +423,21 @@ class EsmRecord(object):
         :data_format: (str) Data format, Default: len(data)s
         :returns: (str) Packed subrecord.
         """
-        if not data_format:
-            data_format = "%ds" % len(data)
-
-        if isinstance(data, tuple):
-            packed_data = pack(data_format, *data)
+        if not data_format:  # Raw string, nothing to pack.
+            packed_data = data
+        elif isinstance(data, tuple):
+            packed_data = get_struct(data_format).pack(*data)
         else:
-            packed_data = pack(data_format, data)
-
-        out = pack("4si", id, len(packed_data))
-        out += packed_data
+            packed_data = get_struct(data_format).pack(data)
 
-        return out
+        return SUBRECORD_HEADER.pack(id, len(packed_data)) + packed_data
 
     def pack_header(self):
         """Convert the records header back into binary format.
 
         :returns: (str)
         """
-        return pack("4s3i", self.id, self.size, self._delflag, self._recflag)
+        return RECORD_HEADER.pack(self.id, self.size, self._delflag, self._recflag)
 
     def pack(self):
         """Convert the record back to binary format.
@@ -239,6 +457,8 @@ class EsmRecord(object):
 
 class EsmSubrecord(object):
     """Class representing a generic subrecord."""
+    __slots__ = ("_id", "_size", "_data")
+
     def __init__(self, id, size, data):
         """Takes the subrecords id, size and raw data.
 
@@ -267,7 +487,7 @@ class EsmSubrecord(object):
 
         :returns: (str)
         """
-        return pack("4si", self.id, self.size)
+        return SUBRECORD_HEADER.pack(self.id, self.size)
 
     def pack(self):
         """Convert the subrecord to binary format.
@@ -280,6 +500,8 @@ class EsmSubrecord(object):
 # -- Specific Records.
 class EsmLEVRecord(EsmRecord):
     """Leveled Items/Creatures Record."""
+    __slots__ = ("_name", "_objects", "_calc_all_levels", "_calc_all_items", "_chance_none",
+                 "_count", "_merged", "_extra")
 
     def __init__(self, *args, **kwargs):
         super(EsmLEVRecord, self).__init__(*args, **kwargs)
@@ -287,56 +509,56 @@ class EsmLEVRecord(EsmRecord):
         self._merged = False
 
     def unpack_data(self):
-        """Unpack the data into meaningful values."""
+        """Unpack the data into meaningful values.
+        Numeric fields are decoded with the compiled codecs from lib.schema,
+        ids are kept raw so they are packed back byte for byte.
+        """
         self._objects = []
-        subrecords = self.subrecords
-        for sub in subrecords:
+        self._extra = []  # (sub_id, raw) of subrecords that aren't part of the list, eg: DELE
+        self._calc_all_levels = self._calc_all_items = False
+        codec = get_schema(self.id).codec
+        data = self.data
+        for sub_id, offset, size in iter_subrecords(data):
+            raw = data[offset:offset + size]
             # List ID
-            if sub.id == "NAME":
-                self._name = sub.data
+            if sub_id == "NAME":
+                self._name = raw
 
             # List specific flags
-            elif sub.id == "DATA":
-                self._calc_all_levels = False
-                self._calc_all_items = False
-                flag = unpack("i", sub.data)
+            elif sub_id == "DATA":
+                flag = codec(sub_id).decode(raw)
                 # Verify the correct value of these flags.
                 # wrye mash uses 1: for all_items and 2: for all_levels
                 # while every other source on the esm format says the opposite
                 # Note: openmw-cs also uses the same values as wrye mash.
                 if self.id == "LEVI":
-                    if flag == 1:
-                        self._calc_all_items = True
-                    elif flag == 2:
-                        self._calc_all_levels = True
-                    elif flag == 3:
-                        self._calc_all_items = self._calc_all_levels = True
+                    self._calc_all_items = bool(flag & 1)
+                    self._calc_all_levels = bool(flag & 2)
                 elif self.id == "LEVC":
-                    if flag == 1:
-                        self._calc_all_levels = True
+                    self._calc_all_levels = bool(flag & 1)
+
             # Chance None
-            elif sub.id == "NNAM":
-                self._chance_none = unpack("B", sub.data)[0]
+            elif sub_id == "NNAM":
+                self._chance_none = codec(sub_id).decode(raw)
 
             # Number of creatures/items in the list
-            elif sub.id == "INDX":
-                self._count = unpack("i", sub.data)[0]
+            elif sub_id == "INDX":
+                self._count = codec(sub_id).decode(raw)
 
             # Creatue/Item ID
-            elif sub.id == "CNAM" or sub.id == "INAM":
-                object_id = sub.data
+            elif sub_id == "CNAM" or sub_id == "INAM":
+                object_id = raw
 
             # PC Level for the object
-            elif sub.id == "INTV":
-                pc_level = unpack("h", sub.data)[0]
+            elif sub_id == "INTV":
+                pc_level = codec(sub_id).decode(raw)
                 self._objects.append((pc_level, object_id))
-            # Unknown
+
+            # Anything else isn't part of the list, it is written back after NAME.
             else:
-                raise ValueError("Unknown subrecord %s" % sub.id)
+                self._extra.append((sub_id, raw))
 
     def pack_data(self):
-        out = ''
-        out += self.pack_subrecord("NAME", self._name)
         # List specific flags
         if self.id == "LEVC":
             flag = 1 * self._calc_all_levels
@@ -344,20 +566,37 @@ class EsmLEVRecord(EsmRecord):
         else:
             flag = 1 * self._calc_all_items + 2 * self._calc_all_levels
             otype = "INAM"
-        out += self.pack_subrecord("DATA", flag, "i")
 
-        # Chance None
-        out += self.pack_subrecord("NNAM", self._chance_none, "B")
-
-        # Count
-        out += self.pack_subrecord("INDX", self._count, "i")
+        # Everything is packed into one preallocated buffer.
+        name, objects, extra = self._name, self._objects, self._extra
+        size = 8 + len(name) + LEV_FIELDS.size
+        size += sum(8 + len(raw) for _, raw in extra)
+        size += sum(8 + len(obj) + LEV_LEVEL.size for _, obj in objects)
+        out = bytearray(size)
+
+        SUBRECORD_HEADER.pack_into(out, 0, "NAME", len(name))
+        pos = 8 + len(name)
+        out[8:pos] = name
+        for sub_id, raw in extra:
+            SUBRECORD_HEADER.pack_into(out, pos, sub_id, len(raw))
+            pos += 8
+            out[pos:pos + len(raw)] = raw
+            pos += len(raw)
+        # Flags, Chance None and Count
+        LEV_FIELDS.pack_into(out, pos, "DATA", 4, flag, "NNAM", 1, self._chance_none,
+                             "INDX", 4, self._count)
+        pos += LEV_FIELDS.size
 
         # Objects
-        for lvl, obj in self._objects:
-            out += self.pack_subrecord(otype, obj)
-            out += self.pack_subrecord("INTV", lvl, "h")
+        for lvl, obj in objects:
+            SUBRECORD_HEADER.pack_into(out, pos, otype, len(obj))
+            pos += 8
+            out[pos:pos + len(obj)] = obj
+            pos += len(obj)
+            LEV_LEVEL.pack_into(out, pos, "INTV", 2, lvl)
+            pos += LEV_LEVEL.size
 
-        return out
+        return str(out)
 
     def merge_with(self, other):
         """Merge this leveled list with another list.
@@ -394,6 +633,8 @@ class EsmLEVRecord(EsmRecord):
 
 class EsmTES3Record(EsmRecord):
     """Header record, contains auth and description of the plugin along with its dependencies"""
+    __slots__ = ("_ver", "_ftype", "_auth", "_desc", "_num_records", "_masters")
+
     def __init__(self, *args, **kwargs):
         super(EsmTES3Record, self).__init__(*args, **kwargs)
         self.unpack_data()
@@ -402,13 +643,14 @@ class EsmTES3Record(EsmRecord):
         """Unpack the record."""
         mname = []
         msize = []
-        for sub in self.subrecords:
-            if sub.id == "HEDR":
-                ver, ftype, auth, desc, num_records = unpack("fi32s256si", sub.data)
-            if sub.id == "MAST":
-                mname.append(sub.data.rstrip("\x00"))
-            if sub.id == "DATA":
-                msize.append(unpack("l", sub.data)[0])
+        data = self.data
+        for id, offset, size in iter_subrecords(data):
+            if id == "HEDR":
+                ver, ftype, auth, desc, num_records = HEDR.unpack_from(data, offset)
+            if id == "MAST":
+                mname.append(data[offset:offset + size].rstrip("\x00"))
+            if id == "DATA":
+                msize.append(MASTER_SIZE.unpack_from(data, offset)[0])
 
         self._ver = ver
         self._ftype = ftype
@@ -421,12 +663,12 @@ class EsmTES3Record(EsmRecord):
         out = ''
         # Pack HEDR subrecord
         data = (self._ver, self._ftype, self._auth, self._desc, self._num_records)
-        out += self.pack_subrecord("HEDR", data, "fi32s256si")
+        out += self.pack_subrecord("HEDR", data, "<fi32s256si")
 
         # Pack the masters list
         for master, size in self._masters:
-            out += self.pack_subrecord("MAST", master, "%ds" % (len(master) + 1))
-            out += self.pack_subrecord("DATA", size, "l")
+            out += self.pack_subrecord("MAST", master + "\x00")
+            out += self.pack_subrecord("DATA", size, "<q")
 
         return out
 
@@ -456,7 +698,8 @@ class EsmTES3Record(EsmRecord):
         self._changed = True
 
     def add_master(self, path):
-        """Add a master to the dependencies list.
+        """Add a master to the dependencies list, a master already listed
+        (case insensitive) only gets its size updated.
 
         :path: (str) Path to the master file.
         """
@@ -466,6 +709,11 @@ class EsmTES3Record(EsmRecord):
         name = os.path.basename(path)
         size = os.path.getsize(path)
 
-        self._masters.append((name, size))
+        for n, (master, _) in enumerate(self._masters):
+            if master.lower() == name.lower():
+                self._masters[n] = (master, size)
+                break
+        else:
+            self._masters.append((name, size))
 
         self._changed = True
@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+# Pipelined archive extraction.
+# One thread reads the archive (libarchive decompresses outside the GIL) and
+# cuts files into segments, a small pool of writer threads puts them on disk.
+# The queue between them is bounded, so memory use is capped at about
+# QUEUE_SEGMENTS * SEGMENT_SIZE whatever the size of the archive.
+import os
+import zlib
+import shutil
+import threading
+from Queue import Queue
+
+import core
+from manifest import Manifest
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+QUEUE_SEGMENTS = 16
+WRITERS = 3
+
+
+def _entry_mtime(entry):
+    """Modification time of an archive entry as a timestamp, None if unknown."""
+    import time
+    mtime = entry.mtime
+    if hasattr(mtime, "timetuple"):  # libarchive.public returns a local datetime.
+        return time.mktime(mtime.timetuple())
+    return mtime
+
+
+def iter_entries(path, prefix=""):
+    """Yield the files of an archive under :prefix:.
+
+    :path: (str) Path to the archive.
+    :prefix: (str) Directory inside the archive, eg: "Data Files/". Default: everything.
+    :returns: (generator) (relative path, size, mtime, blocks), blocks must be
+        consumed before the next entry.
+    """
+    libarchive = core.get_libarchive()
+    with libarchive.file_reader(path) as archive:
+        for entry in archive:
+            pathname = entry.pathname.lstrip("/")
+            if pathname.endswith("/") or not pathname.startswith(prefix):
+                continue
+            filetype = entry.filetype
+            if filetype.IFDIR or filetype.IFLNK:
+                continue
+            yield (pathname[len(prefix):].replace("/", os.path.sep), entry.size,
+                   _entry_mtime(entry), entry.get_blocks())
+
+
+def _writer(queue, errors):
+    while True:
+        item = queue.get()
+        try:
+            if item is None:
+                return
+            if errors:
+                continue  # Keep draining so the reader never blocks on a full queue.
+            target, offset, data = item
+            with open(target, "r+b") as handle:
+                handle.seek(offset)
+                handle.write(data)
+        except (IOError, OSError) as e:
+            errors.append(e)
+        finally:
+            queue.task_done()
+
+
+def extract(entries, dest, writers=WRITERS, progress=None, rename=None):
+    """Write archive entries to a new directory.
+
+    :entries: (iterable) See iter_entries().
+    :dest: (str) Destination directory, must not exist.
+    :writers: (int) Number of writer threads.
+    :progress: (callable) Optional, called with the number of bytes read
+        each time a segment is queued.
+    :rename: (callable) Optional, maps relative paths to the ones they are
+        written to, eg: str.lower. Paths it merges overwrite each other.
+    :returns: (Manifest) Manifest of the extracted files.
+    """
+    os.makedirs(dest)
+    manifest = Manifest(dest)
+    queue = Queue(QUEUE_SEGMENTS)
+    errors = []
+    threads = [threading.Thread(target=_writer, args=(queue, errors)) for _ in range(writers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    mtimes = []
+    try:
+        for rel, _, mtime, blocks in entries:
+            if rename is not None:
+                rel = rename(rel)
+            if rel in manifest.files:
+                queue.join()  # Merged by :rename:, the earlier copy must be done first.
+            target = os.path.join(dest, rel)
+            directory = os.path.dirname(target)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            open(target, "wb").close()  # Writers fill it in at their offsets.
+
+            crc = 0
+            offset = 0
+            segment = []
+            pending = 0
+            for block in blocks:
+                crc = zlib.crc32(block, crc)
+                segment.append(block)
+                pending += len(block)
+                if pending >= SEGMENT_SIZE:
+                    if errors:
+                        raise errors[0]
+                    queue.put((target, offset, "".join(segment)))
+                    if progress is not None:
+                        progress(pending)
+                    offset += pending
+                    segment = []
+                    pending = 0
+            if pending:
+                queue.put((target, offset, "".join(segment)))
+                if progress is not None:
+                    progress(pending)
+            manifest.add(rel, offset + pending, None, "%08x" % (crc & 0xffffffff))
+            mtimes.append((rel, mtime))
+    except:
+        errors.append(None)  # Stops the writers from writing anything else.
+        raise
+    finally:
+        for _ in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        if errors:
+            shutil.rmtree(dest, ignore_errors=True)
+    if errors:
+        raise errors[0]
+
+    # Writers may finish a file in any order, its times are only set once they are done.
+    for rel, mtime in mtimes:
+        target = os.path.join(dest, rel)
+        if mtime is not None:
+            os.utime(target, (mtime, mtime))
+        size, _, crc = manifest.files[rel]
+        manifest.add(rel, size, os.stat(target).st_mtime, crc)
+    return manifest
@@ -0,0 +1,194 @@
+# -*- coding: UTF-8 -*-
+# Leveled list resolution: what a leveled list can spawn at each PC level.
+# A list picks one of its entries the way the game does (chance none, then
+# the entries at or below the PC level, only the highest of them unless
+# "calc from all levels" is set) and entries can be other leveled lists.
+# Every list is resolved once for all levels at the same time, as one
+# probability vector per reachable item/creature, and memoized so nested
+# lists shared by many lists are only expanded once. Chances only change at
+# levels some entry starts at, so vectors hold one value per such level
+# range rather than one per level.
+# NumPy is used for the vectors when it is installed.
+from bisect import bisect_right
+from operator import add, mul
+
+import timings
+from merge import index_leveled_lists
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAX_LEVEL = 100
+
+
+def _id(raw):
+    return raw.split("\x00", 1)[0].lower()
+
+
+def _weights(entries, all_levels, chance_none, levels):
+    """Probability of picking each entry, per level.
+
+    :entries: (list) (pc level, id) in list order.
+    :levels: (list) PC levels to compute, ascending.
+    :returns: (list) One vector per entry, indexed like :levels:.
+    """
+    keep = 1.0 - min(max(chance_none or 0, 0), 100) / 100.0
+    if numpy is not None:
+        entry_levels = numpy.array([level for level, _ in entries])[:, None]
+        pc_levels = numpy.array(levels)[None, :]
+        eligible = entry_levels <= pc_levels
+        if not all_levels:
+            highest = numpy.where(eligible, entry_levels, 0).max(axis=0)
+            eligible &= entry_levels == highest[None, :]
+        counts = eligible.sum(axis=0)
+        return list(eligible * (keep / numpy.maximum(counts, 1)))
+
+    weights = [[0.0] * len(levels) for _ in entries]
+    for n, pc_level in enumerate(levels):
+        eligible = [i for i, (level, _) in enumerate(entries) if level <= pc_level]
+        if eligible and not all_levels:
+            highest = max(entries[i][0] for i in eligible)
+            eligible = [i for i in eligible if entries[i][0] == highest]
+        for i in eligible:
+            weights[i][n] = keep / len(eligible)
+    return weights
+
+
+def _add(total, vector, scale=None):
+    """total + vector * scale, element wise. :total: may be None."""
+    if numpy is not None:
+        scaled = vector if scale is None else vector * scale
+        return scaled.copy() if total is None else total + scaled
+    # map() keeps the loops in C.
+    if scale is not None:
+        vector = map(mul, vector, scale)
+    if total is None:
+        return list(vector)
+    return map(add, total, vector)
+
+
+class LeveledLists(object):
+    """The leveled lists of a load order and what they resolve to."""
+
+    def __init__(self, lists, levels=MAX_LEVEL):
+        """
+        :lists: (dict) (record id, lowercase name) -> (chance_none,
+            calc_all_levels, calc_all_items, entries), see merge.list_state.
+        :levels: (int) Resolve PC levels 1 to :levels:.
+        """
+        self._lists = lists
+        self._levels = levels
+        # Levels where chances may change, each one stands for the levels up to the next.
+        starts = set([1])
+        for _, _, _, entries in lists.itervalues():
+            starts.update(level for level, _ in entries if 1 < level <= levels)
+        self._starts = sorted(starts)
+        self._resolved = {}
+        self._cycles = []
+
+    @classmethod
+    def from_plugins(cls, paths, cache=None, levels=MAX_LEVEL):
+        """Collect the lists of plugins, the last plugin's version of a list wins.
+        Load a merged leveled lists plugin last to resolve merged lists.
+
+        :paths: (list) Plugin paths in load order.
+        :cache: (FileCache) Optional, on-disk cache of leveled list indexes.
+        """
+        lists = {}
+        for path in paths:
+            if cache is not None:
+                lists.update(cache.get_or_compute(path, index_leveled_lists))
+            else:
+                lists.update(index_leveled_lists(path))
+        return cls(lists, levels)
+
+    @property
+    def keys(self):
+        return sorted(self._lists)
+
+    @property
+    def cycles(self):
+        """Lists that contain themselves, as paths of list keys. Each loop is
+        cut where it closes, the entry closing it resolves to nothing."""
+        return self._cycles
+
+    def __contains__(self, key):
+        return key in self._lists
+
+    def calc_each_item(self, key):
+        """Whether a stack from this list is rolled per item rather than once
+        for the whole stack. The probabilities of a single roll are the same."""
+        return self._lists[key][2]
+
+    def resolve(self, key):
+        """Return what a list spawns.
+
+        :key: (tuple) (record id, lowercase name)
+        :returns: (dict) lowercase item/creature id -> probabilities, index 0
+            being PC level 1. What's missing to 1 is the chance of nothing.
+        """
+        with timings.phase("resolve lists"):
+            resolved = self._resolve(key, [])
+        ranges = [bisect_right(self._starts, level) - 1 for level in range(1, self._levels + 1)]
+        if numpy is not None:
+            return dict((item, vector[ranges]) for item, vector in resolved.iteritems())
+        return dict((item, [vector[i] for i in ranges]) for item, vector in resolved.iteritems())
+
+    def resolve_all(self):
+        """Resolve every list, then resolve() only looks results up.
+
+        :returns: (int) Number of lists resolved.
+        """
+        with timings.phase("resolve lists"):
+            for key in self._lists:
+                self._resolve(key, [])
+        return len(self._lists)
+
+    def _resolve(self, key, stack):
+        resolved = self._resolved.get(key)
+        if resolved is not None:
+            return resolved
+
+        # Iterative depth first walk, children are resolved before their parent.
+        on_stack = set(stack)
+        todo = [(key, False)]
+        while todo:
+            current, expanded = todo.pop()
+            if current in self._resolved:
+                continue
+            chance_none, all_levels, _, entries = self._lists[current]
+            children = [(current[0], _id(raw)) for _, raw in entries]
+            if not expanded:
+                todo.append((current, True))
+                on_stack.add(current)
+                stack.append(current)
+                for child in children:
+                    if child not in self._lists or child in self._resolved:
+                        continue
+                    if child in on_stack:
+                        self._cycles.append(stack[stack.index(child):] + [child])
+                        continue
+                    todo.append((child, False))
+                continue
+
+            stack.pop()
+            on_stack.discard(current)
+            result = {}
+            if entries:
+                weights = _weights(entries, all_levels, chance_none, self._starts)
+                for weight, child in zip(weights, children):
+                    if not any(weight):
+                        continue  # Never picked, eg: always outleveled.
+                    if child not in self._lists:
+                        result[child[1]] = _add(result.get(child[1]), weight)
+                        continue
+                    nested = self._resolved.get(child)
+                    if nested is None:  # Closes a cycle, cut here.
+                        continue
+                    for item, probability in nested.iteritems():
+                        result[item] = _add(result.get(item), probability, weight)
+            self._resolved[current] = result
+        return self._resolved[key]
+
@@ -0,0 +1,249 @@
+# -*- coding: UTF-8 -*-
+# Load order sorting from plugin masters and mlox style rule files.
+# Rule files are parsed once into a compiled form (plain lists of lowercase
+# names and wildcard patterns) which is cached on disk, sorting is a stable
+# topological sort: plugins only move when a master or a rule requires it.
+import os
+import re
+import heapq
+from fnmatch import translate
+
+import core
+import timings
+
+# Rules used for sorting, every other rule ([Note], [Conflict]...) is skipped.
+ORDER_RULES = ("order", "nearstart", "nearend")
+
+_HEADER = re.compile(r"^\[(\w+)\]")
+_COMMENT = re.compile(r"\s*;.*$")
+
+
+def compile_rules(path):
+    """Parse an mlox rule file into its compiled form.
+
+    :path: (str) Path to the rule file, eg: mlox_base.txt
+    :returns: (dict) "order": list of blocks (lists of patterns),
+        "nearstart" and "nearend": lists of patterns.
+    """
+    rules = {"order": [], "nearstart": [], "nearend": []}
+    with timings.phase("rules parse", os.path.basename(path)) as timer, open(path, "r") as handle:
+        current = None
+        for line in handle:
+            timer.read(len(line))
+            line = _COMMENT.sub("", line).strip()
+            if not line:
+                continue
+            match = _HEADER.match(line)
+            if match:
+                name = match.group(1).lower()
+                current = None
+                if name == "order":
+                    current = []
+                    rules["order"].append(current)
+                elif name in ORDER_RULES:
+                    current = rules[name]
+                continue
+            if current is not None:
+                current.append(line.lower())
+
+    rules["order"] = [block for block in rules["order"] if len(block) > 1]
+    return rules
+
+
+def load_rules(paths, cache=None):
+    """Compile rule files, reusing cached results for files that didn't change.
+    Rules from later files are applied after the ones from earlier files.
+
+    :paths: (list) Paths to rule files.
+    :cache: (FileCache) Optional, on-disk cache of compiled rules.
+    :returns: (dict) Compiled rules of every file combined.
+    """
+    combined = {"order": [], "nearstart": [], "nearend": []}
+    for path in paths:
+        if cache is not None:
+            rules = cache.get_or_compute(path, compile_rules)
+        else:
+            rules = compile_rules(path)
+        for key in combined:
+            combined[key].extend(rules[key])
+    return combined
+
+
+class _Matcher(object):
+    """Resolves rule patterns to the plugins being sorted."""
+
+    def __init__(self, names):
+        self._names = names  # lowercase names in load order
+        self._lookup = dict((name, i) for i, name in enumerate(names))
+        self._patterns = {}
+
+    def match(self, pattern):
+        """Return the positions of the plugins matched by :pattern:."""
+        if "*" not in pattern and "?" not in pattern and "<" not in pattern:
+            index = self._lookup.get(pattern)
+            return [] if index is None else [index]
+
+        matched = self._patterns.get(pattern)
+        if matched is None:
+            regex = re.compile(translate(pattern.replace("<ver>", "*")))
+            matched = [i for i, name in enumerate(self._names) if regex.match(name)]
+            self._patterns[pattern] = matched
+        return matched
+
+
+class SortResult(object):
+    """Result of sort_plugins().
+
+    :order: (list) Sorted plugin names.
+    :conflicts: (list) Messages about rules that couldn't be applied.
+    """
+
+    def __init__(self, order, conflicts):
+        self.order = order
+        self.conflicts = conflicts
+
+
+def sort_plugins(plugins, rules=None):
+    """Sort plugins so masters load before their dependents and rules are followed.
+
+    Masters are applied first, then rules in the order they were read. A
+    rule contradicting what was applied before it is skipped and reported.
+
+    :plugins: (list) List of (name, masters) in the current load order,
+        masters being a list of plugin names.
+    :rules: (dict) Compiled rules, see load_rules(). Default: masters only.
+    :returns: (SortResult)
+    """
+    names = [name for name, _ in plugins]
+    matcher = _Matcher([name.lower() for name in names])
+    graph = _Graph(len(names))
+    conflicts = []
+
+    with timings.phase("sort"):
+        for i, (name, masters) in enumerate(plugins):
+            for master in masters:
+                found = matcher.match(master.lower())
+                if not found:
+                    conflicts.append("%s: missing master %s" % (name, master))
+                for j in found:
+                    path = graph.add(j, i)
+                    if path:
+                        conflicts.append("Plugins depend on each other: %s"
+                                         % " -> ".join(names[x] for x in path + [i]))
+
+        rank = [1] * len(names)
+        if rules:
+            for block in rules["order"]:
+                previous = []
+                for pattern in block:
+                    present = matcher.match(pattern)
+                    if not present:
+                        continue
+                    for a in previous:
+                        for b in present:
+                            path = graph.add(a, b)
+                            if path:
+                                conflicts.append("Ignoring rule %s before %s, already: %s"
+                                                 % (names[a], names[b],
+                                                    " -> ".join(names[x] for x in path)))
+                    previous = present
+            for pattern in rules["nearstart"]:
+                for i in matcher.match(pattern):
+                    rank[i] = 0
+            for pattern in rules["nearend"]:
+                for i in matcher.match(pattern):
+                    rank[i] = 2
+
+        order = graph.sorted(rank)
+
+    return SortResult([names[i] for i in order], conflicts)
+
+
+class _Graph(object):
+    """Acyclic "loads before" graph over plugin positions.
+
+    A topological order is kept up to date as edges are added (Pearce-Kelly),
+    so checking a new edge only walks the part of the graph between its two
+    ends, and most edges (already in load order) cost nothing.
+    """
+
+    def __init__(self, size):
+        self.children = [set() for _ in range(size)]
+        self.parents = [set() for _ in range(size)]
+        self.pos = list(range(size))  # a valid topological order
+
+    def add(self, a, b):
+        """Add "a loads before b".
+
+        :returns: (list) None if added, otherwise the path from b to a that
+            the edge would close into a cycle.
+        """
+        if a == b or b in self.children[a]:
+            return None
+        pos = self.pos
+        if pos[a] > pos[b]:
+            low, high = pos[b], pos[a]
+            # Everything b leads to, up to a's position.
+            forward, came_from, stack = set(), {b: None}, [b]
+            while stack:
+                node = stack.pop()
+                if node in forward:
+                    continue
+                forward.add(node)
+                for child in self.children[node]:
+                    if child == a:
+                        path = [a, node]
+                        while came_from[path[-1]] is not None:
+                            path.append(came_from[path[-1]])
+                        path.reverse()
+                        return path
+                    if pos[child] < high and child not in forward:
+                        came_from.setdefault(child, node)
+                        stack.append(child)
+            # Everything leading to a, down to b's position.
+            backward, stack = set(), [a]
+            while stack:
+                node = stack.pop()
+                if node in backward:
+                    continue
+                backward.add(node)
+                stack.extend(p for p in self.parents[node] if pos[p] > low and p not in backward)
+            # Reuse their slots, a's side first.
+            moved = sorted(backward, key=pos.__getitem__) + sorted(forward, key=pos.__getitem__)
+            for node, slot in zip(moved, sorted(pos[n] for n in moved)):
+                pos[node] = slot
+
+        self.children[a].add(b)
+        self.parents[b].add(a)
+        return None
+
+    def sorted(self, rank):
+        """Return positions in a topological order that keeps the current one
+        as much as possible, lower :rank: first when there is a choice."""
+        remaining = [len(p) for p in self.parents]
+        ready = [(rank[i], i) for i, count in enumerate(remaining) if count == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            _, i = heapq.heappop(ready)
+            order.append(i)
+            for child in self.children[i]:
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    heapq.heappush(ready, (rank[child], child))
+        return order
+
+
+def plugin_masters(plugin):
+    """Return the names of the masters of an installed plugin.
+
+    :plugin: (OmwPlugin)
+    :returns: (list)
+    """
+    if not plugin.path:
+        return []
+    try:
+        header = core.open_esm_header(plugin.path)
+    except (IOError, OSError, AssertionError):
+        return []
+    return [name for name, _ in header.masters]
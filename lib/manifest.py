@@ -0,0 +1,338 @@
+# -*- coding: UTF-8 -*-
+# Install manifests: every file written by an install with its size, mtime
+# and a checksum computed while the file is copied (no second read pass).
+# Manifests live in cache_dir/manifests, one JSON file per mod directory.
+# Paths are byte strings of any encoding, they are stored decoded as
+# latin-1 which maps every byte to a character and back.
+import os
+import json
+import zlib
+import shutil
+import hashlib
+
+import core
+import paths
+
+VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+PATH_ENCODING = "latin-1"
+
+# Renames an install can apply to the paths of a mod, by the name stored in its manifest.
+RENAMES = {"lowercase": paths.lowercase}
+
+
+def _to_json(path):
+    return path.decode(PATH_ENCODING) if isinstance(path, str) else path
+
+
+def _from_json(path, encoding):
+    return path.encode(encoding)
+
+
+def checksum(path):
+    """Return the checksum of a file, the same one used in manifests.
+
+    :path: (str)
+    :returns: (str) crc32 as hex.
+    """
+    crc = 0
+    with open(path, "rb") as handle:
+        while True:
+            chunk = handle.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return "%08x" % (crc & 0xffffffff)
+
+
+def copy_file(src, dst):
+    """Copy a file with its permissions and times, computing its checksum on the way.
+
+    :src: (str) Source file.
+    :dst: (str) Destination file.
+    :returns: (tuple) size, checksum
+    """
+    crc = 0
+    size = 0
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        while True:
+            chunk = fsrc.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            fdst.write(chunk)
+    shutil.copystat(src, dst)
+    return size, "%08x" % (crc & 0xffffffff)
+
+
+def copy_tree(src, dest, progress=None, rename=None):
+    """Copy a directory tree like shutil.copytree and build its manifest.
+
+    :src: (str) Source directory.
+    :dest: (str) Destination directory, must not exist.
+    :progress: (callable) Optional, called with the size of each copied file.
+    :rename: (callable) Optional, maps relative paths to the ones they are
+        copied to, eg: str.lower. Paths it merges overwrite each other.
+    :returns: (Manifest)
+    """
+    manifest = Manifest(dest)
+    os.makedirs(dest)
+    if rename is None:
+        rename = lambda rel: rel
+    for root, dirs, files in os.walk(src):
+        src_root = os.path.relpath(root, src)
+        src_root = "" if src_root == os.curdir else src_root
+        out_root = os.path.join(dest, rename(src_root)) if src_root else dest
+        for dname in dirs:
+            out_dir = os.path.join(dest, rename(os.path.join(src_root, dname)))
+            if not os.path.isdir(out_dir):
+                os.mkdir(out_dir)
+        for fname in files:
+            rel = rename(os.path.join(src_root, fname))
+            target = os.path.join(dest, rel)
+            size, crc = copy_file(os.path.join(root, fname), target)
+            manifest.add(rel, size, os.stat(target).st_mtime, crc)
+            if progress is not None:
+                progress(size)
+        shutil.copystat(root, out_root)
+    return manifest
+
+
+def _write_temp(target, blocks):
+    # Written next to the target and renamed over it by _replace(), an
+    # interrupted update never leaves a half written file behind.
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = target + ".omw-mm-tmp"
+    crc = 0
+    size = 0
+    try:
+        with open(tmp_path, "wb") as handle:
+            for block in blocks:
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                handle.write(block)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return tmp_path, size, "%08x" % (crc & 0xffffffff)
+
+
+def _replace(tmp_path, target, mtime=None):
+    try:
+        if mtime is not None:
+            os.utime(tmp_path, (mtime, mtime))
+        if os.path.exists(target):
+            os.chmod(tmp_path, os.stat(target).st_mode & 0o7777)
+            if os.name == "nt":  # rename doesn't replace files on windows.
+                os.remove(target)
+        os.rename(tmp_path, target)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def update_tree(entries, dest, old=None):
+    """Bring an installed mod up to date with a new version of its files,
+    only new and changed files are written.
+
+    A file is unchanged when its size and mtime match the installed copy, or
+    when its size and checksum do. The installed checksum comes from :old:
+    when the file wasn't touched since, it is only computed otherwise.
+    Files skipped on size and mtime that :old: doesn't list get no checksum
+    in the new manifest, reading them would cost what the skip saves.
+
+    :entries: (iterable) (relative path, size, mtime, blocks) for every file
+        of the new version, blocks being an iterable of strings.
+    :dest: (str) Installed mod directory.
+    :old: (Manifest) Manifest of the installed version, None if there is none.
+        Files it lists that the new version doesn't have are removed, without
+        it every file missing from the new version is.
+    :returns: (tuple) (Manifest, dict) the new manifest and "added",
+        "changed", "removed" (lists of relative paths), "total" and "written" (bytes).
+    """
+    new = Manifest(dest)
+    stats = {"added": [], "changed": [], "removed": [], "total": 0, "written": 0}
+    known = old.files if old is not None else {}
+
+    for rel, size, mtime, blocks in entries:
+        target = os.path.join(dest, rel)
+        stats["total"] += size
+        try:
+            st = os.stat(target)
+        except OSError:
+            st = None
+
+        entry = known.get(rel)
+        if entry is not None and (st is None or entry[:2] != (st.st_size, st.st_mtime)):
+            entry = None  # Touched since the manifest was written.
+        if st is not None and st.st_size == size and mtime is not None \
+                and int(st.st_mtime) == int(mtime):
+            new.add(rel, size, st.st_mtime, entry[2] if entry is not None else None)
+            continue
+
+        # Streamed to disk whatever happens, same size files are compared
+        # on their checksum once written and the copy dropped if they match.
+        tmp_path, written, crc = _write_temp(target, blocks)
+        if st is not None and st.st_size == size:
+            installed = entry[2] if entry is not None and entry[2] else checksum(target)
+            if crc == installed:
+                os.remove(tmp_path)
+                if mtime is not None:  # Next updates can skip it on size and mtime.
+                    os.utime(target, (mtime, mtime))
+                new.add(rel, size, os.stat(target).st_mtime, crc)
+                continue
+        _replace(tmp_path, target, mtime)
+        stats["written"] += written
+        stats["changed" if st is not None else "added"].append(rel)
+        new.add(rel, written, os.stat(target).st_mtime, crc)
+
+    if old is not None:
+        gone = [rel for rel in old.files if rel not in new.files]
+    else:
+        gone = []
+        for root, _, files in os.walk(dest):
+            for fname in files:
+                rel = os.path.relpath(os.path.join(root, fname), dest)
+                if rel not in new.files:
+                    gone.append(rel)
+    for rel in sorted(gone):
+        path = os.path.join(dest, rel)
+        if os.path.lexists(path):
+            os.remove(path)
+            stats["removed"].append(rel)
+        # Drop directories the update emptied.
+        parent = os.path.dirname(path)
+        while parent != os.path.normpath(dest) and os.path.isdir(parent) and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+    return new, stats
+
+
+def manifest_path(mod_path):
+    """Return where the manifest of a mod directory is stored.
+
+    :mod_path: (str) Path to the installed mod.
+    :returns: (str)
+    """
+    digest = hashlib.sha1(os.path.abspath(mod_path)).hexdigest()
+    return os.path.join(core.get_cache_dir(), "manifests", digest + ".json")
+
+
+class Manifest(object):
+    """Files of an installed mod, relative path -> (size, mtime, checksum).
+    The checksum is None for files update_tree() never had to read."""
+
+    def __init__(self, mod_path, files=None, rename=None):
+        """
+        :mod_path: (str) Path to the installed mod.
+        :files: (dict) relative path -> (size, mtime, checksum)
+        :rename: (str) Name of the RENAMES entry the install applied, updates apply it too.
+        """
+        self._path = mod_path
+        self._files = files if files is not None else {}
+        self.rename = rename
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def files(self):
+        return self._files
+
+    @property
+    def size(self):
+        return sum(entry[0] for entry in self._files.itervalues())
+
+    def add(self, rel_path, size, mtime, crc):
+        self._files[rel_path] = (size, mtime, crc)
+
+    def remove(self, rel_path):
+        self._files.pop(rel_path, None)
+
+    def save(self):
+        """Write the manifest to cache_dir/manifests."""
+        path = manifest_path(self._path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        data = {"version": VERSION, "path": _to_json(self._path), "checksum": "crc32",
+                "encoding": PATH_ENCODING, "rename": self.rename,
+                "files": [[_to_json(rel)] + list(entry) for rel, entry in sorted(self._files.items())]}
+        core.atomic_write(path, json.dumps(data, separators=(",", ":")))
+
+    def delete(self):
+        """Remove the stored manifest."""
+        path = manifest_path(self._path)
+        if os.path.exists(path):
+            os.remove(path)
+
+    @classmethod
+    def load(cls, mod_path):
+        """Load the manifest of a mod directory.
+
+        :mod_path: (str) Path to the installed mod.
+        :returns: (Manifest or None) None if the mod has no manifest.
+        """
+        try:
+            with open(manifest_path(mod_path)) as handle:
+                data = json.load(handle)
+        except (IOError, ValueError):
+            return None
+        if data.get("version") != VERSION:
+            return None
+        # Manifests written before "encoding" was stored hold utf-8 paths.
+        encoding = data.get("encoding", "utf-8")
+        files = dict((_from_json(rel, encoding), (size, mtime, crc))
+                     for rel, size, mtime, crc in data["files"])
+        return cls(mod_path, files, data.get("rename"))
+
+    def verify(self, jobs=4):
+        """Compare the installed files against the manifest.
+        Files are only read when their size or mtime changed.
+
+        :jobs: (int) Number of files checked at once.
+        :returns: (dict) "missing", "modified", "added": lists of relative paths.
+        """
+        root = self._path
+
+        def check(item):
+            rel, (size, mtime, crc) = item
+            try:
+                st = os.stat(os.path.join(root, rel))
+            except OSError:
+                return rel, "missing"
+            if st.st_size == size and st.st_mtime == mtime:
+                return rel, None
+            if st.st_size != size or crc is None or checksum(os.path.join(root, rel)) != crc:
+                return rel, "modified"  # Without a checksum a touched file can't be told apart.
+            return rel, None  # Touched but identical.
+
+        items = list(self._files.items())
+        if jobs > 1 and len(items) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(jobs, len(items)))
+            try:
+                results = pool.map(check, items, chunksize=64)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [check(item) for item in items]
+
+        report = {"missing": [], "modified": [], "added": []}
+        for rel, problem in results:
+            if problem:
+                report[problem].append(rel)
+        for dirpath, _, files in os.walk(root):
+            for fname in files:
+                rel = os.path.relpath(os.path.join(dirpath, fname), root)
+                if rel not in self._files:
+                    report["added"].append(rel)
+        for problems in report.values():
+            problems.sort()
+        return report
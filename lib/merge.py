@@ -0,0 +1,318 @@
+# -*- coding: UTF-8 -*-
+# Helpers for merging leveled lists across plugins.
+import os
+import json
+from collections import Counter
+
+import timings
+from esm import Esm, LEV_RECORDS
+
+
+def list_key(record):
+    """Return the key identifying a leveled list across plugins.
+    Ids are case insensitive in Morrowind.
+
+    :record: (EsmLEVRecord)
+    :returns: (tuple) record type, lowercase name
+    """
+    return (record.id, record._name.rstrip("\x00").lower())
+
+
+def list_state(record):
+    """Return the mergeable state of a leveled list.
+
+    :record: (EsmLEVRecord)
+    :returns: (tuple) chance_none, calc_all_levels, calc_all_items, entries
+    """
+    return (record._chance_none, record._calc_all_levels, record._calc_all_items,
+            tuple(record._objects))
+
+
+def index_leveled_lists(path):
+    """Index every leveled list of a plugin, used as baselines for three-way merging.
+    Only the leveled list records are materialized.
+
+    :path: (str) Path to the plugin.
+    :returns: (dict) list_key -> list_state
+    """
+    with timings.phase("index lists", os.path.basename(path)):
+        plugin = Esm(path)
+        plugin.unpack()
+        index = {}
+        for rec in LEV_RECORDS:
+            for record in plugin.find_records(rec):
+                index[list_key(record)] = list_state(record)
+    return index
+
+
+def decode_id(raw):
+    """Turn a raw id from a plugin into text suitable for reports.
+
+    :raw: (str) Raw, null terminated id.
+    :returns: (unicode)
+    """
+    return raw.rstrip("\x00").decode("cp1252", "replace")
+
+
+class MergeReport(object):
+    """Collects who contributed what to each leveled list while Esm.merge_with runs.
+
+    Pass it to Esm.merge_with(other, report) for every merged plugin, the
+    lists are recorded in the same pass as the merge, then call finish()
+    with the merged Esm after post_merge(). ThreeWayMerger passes the
+    entries each plugin removed as well, removals are then honoured by the
+    merge and reported against the plugin that made them.
+    """
+
+    def __init__(self):
+        # (type, name) -> {"plugins": [...], "entries": {entry: [plugins]}, "last": set,
+        #                  "removed": {entry: plugin} or None unless three-way}
+        self._lists = {}
+        self._order = []
+        self._result = None
+
+    def add(self, plugin, record, removed=None):
+        """Record the version of a leveled list as found in :plugin:.
+
+        :plugin: (str) Plugin name.
+        :record: (EsmLEVRecord) The plugin's version of the list.
+        :removed: (iterable) Three-way merges only, entries :plugin: removed
+            from the version of the list in its masters.
+        """
+        key = list_key(record)
+        info = self._lists.get(key)
+        if info is None:
+            info = self._lists[key] = {"plugins": [], "entries": {}, "last": None,
+                                       "removed": None}
+            self._order.append(key)
+        if removed is not None:
+            if info["removed"] is None:
+                info["removed"] = {}
+            for entry in removed:
+                info["removed"][entry] = plugin
+
+        info["plugins"].append(plugin)
+        entries = info["entries"]
+        for entry in record._objects:
+            contributors = entries.get(entry)
+            if contributors is None:
+                entries[entry] = [plugin]
+            elif contributors[-1] != plugin:
+                contributors.append(plugin)
+        info["last"] = set(record._objects)
+
+    def finish(self, merged):
+        """Build the report from the final merged lists.
+
+        :merged: (Esm) Merged plugin, after post_merge().
+        :returns: (list) One dict per list present in the merged plugin.
+        """
+        result = []
+        final = {}
+        for rec in ("LEVC", "LEVI"):
+            for record in merged.find_records(rec):
+                final[list_key(record)] = record
+
+        for key in self._order:
+            record = final.get(key)
+            if record is None:  # Not merged, only one plugin had it.
+                continue
+            info = self._lists[key]
+            report = {"type": key[0],
+                      "name": decode_id(record._name),
+                      "plugins": info["plugins"],
+                      "chance_none": record._chance_none,
+                      "calc_all_levels": record._calc_all_levels,
+                      "calc_all_items": record._calc_all_items,
+                      "count": len(record._objects)}
+            if info["removed"] is None:
+                report["entries"], report["removed_by_last"] = self._union_entries(info)
+            else:
+                report["entries"], report["removed"] = self._three_way_entries(info, record)
+            result.append(report)
+
+        self._result = result
+        return result
+
+    @staticmethod
+    def _union_entries(info):
+        last_plugin = info["plugins"][-1]
+        entries = []
+        removed = []
+        for entry, contributors in sorted(info["entries"].items()):
+            level, id = entry
+            entries.append({"level": level, "id": decode_id(id), "plugins": contributors})
+            if entry not in info["last"]:
+                # The last loaded plugin dropped it, the union merge brings it back.
+                removed.append({"level": level, "id": decode_id(id), "removed_by": last_plugin})
+        return entries, removed
+
+    @staticmethod
+    def _three_way_entries(info, record):
+        # Only what the merged list holds, removals were applied by the merge.
+        final = set(record._objects)
+        entries = []
+        for entry in sorted(final):
+            level, id = entry
+            entries.append({"level": level, "id": decode_id(id),
+                            "plugins": info["entries"].get(entry, [])})
+        removed = []
+        for entry, plugin in sorted(info["removed"].items()):
+            if entry not in final:
+                level, id = entry
+                removed.append({"level": level, "id": decode_id(id), "removed_by": plugin})
+        return entries, removed
+
+    def write(self, handle):
+        """Write the finished report as JSON to a file object."""
+        json.dump(self._result, handle, indent=2, sort_keys=True)
+        handle.write("\n")
+
+
+class ThreeWayMerger(object):
+    """Deletion aware leveled list merging.
+
+    Every plugin's version of a list is diffed against the version in its
+    closest master (the last one in its MAST list that defines the list),
+    and the resulting additions and removals are applied in load order.
+    Lists that don't exist in any master are merged as a union.
+    """
+
+    def __init__(self, resolve_master, cache=None, report=None):
+        """
+        :resolve_master: (callable) Takes a master name, returns its path or None.
+        :cache: (FileCache) Optional, on-disk cache of master indexes.
+        :report: (MergeReport) Optional, records every list as it is added.
+        """
+        self._resolve = resolve_master
+        self._cache = cache
+        self._report = report
+        self._master_indexes = {}  # path -> index
+        self._lists = {}  # list_key -> merge state
+        self._order = []  # list keys in the order they were first seen
+        self._plugins = []  # plugin paths in load order
+
+    def master_index(self, path):
+        """Return the leveled list index of a master, computed once per master.
+
+        :path: (str) Path to the master.
+        :returns: (dict)
+        """
+        index = self._master_indexes.get(path)
+        if index is None:
+            if self._cache is not None:
+                index = self._cache.get_or_compute(path, index_leveled_lists)
+            else:
+                index = index_leveled_lists(path)
+            self._master_indexes[path] = index
+        return index
+
+    def add(self, plugin):
+        """Merge the leveled lists of the next plugin in load order.
+
+        :plugin: (Esm) Unpacked plugin.
+        """
+        name = os.path.basename(plugin._path)
+        indexes = []
+        for master, _ in plugin.header.masters:
+            path = self._resolve(master)
+            if path:
+                indexes.append(self.master_index(path))
+        indexes.reverse()  # Closest master first.
+
+        self._plugins.append(plugin._path)
+        for rec in LEV_RECORDS:
+            for record in plugin.find_records(rec):
+                key = list_key(record)
+                base = None
+                for index in indexes:
+                    if key in index:
+                        base = index[key]
+                        break
+                if self._report is not None:
+                    removed = []
+                    if base is not None:
+                        removed = list(Counter(base[3]) - Counter(record._objects))
+                    self._report.add(name, record, removed)
+                self._apply(key, base, record, plugin._path)
+
+    def _apply(self, key, base, record, path):
+        mine = list_state(record)
+        info = self._lists.get(key)
+        if info is None:
+            start = base if base is not None else mine
+            info = {"chance_none": start[0], "all_levels": start[1], "all_items": start[2],
+                    "entries": Counter(start[3]), "order": list(start[3]), "plugins": [],
+                    "record": record}
+            self._lists[key] = info
+            self._order.append(key)
+
+        entries, mine_entries = info["entries"], Counter(mine[3])
+        for entry in mine[3]:
+            if entry not in entries:
+                info["order"].append(entry)
+
+        if base is None:
+            # Nothing to diff against, fall back to a union.
+            for entry, count in mine_entries.items():
+                entries[entry] = max(entries[entry], count)
+            info["chance_none"] = min(info["chance_none"], mine[0])
+            info["all_levels"] = info["all_levels"] or mine[1]
+            info["all_items"] = info["all_items"] or mine[2]
+        else:
+            base_entries = Counter(base[3])
+            for entry, count in (mine_entries - base_entries).items():  # Added
+                entries[entry] = max(entries[entry], base_entries[entry] + count)
+            for entry, count in (base_entries - mine_entries).items():  # Removed
+                entries[entry] = max(0, entries[entry] - count)
+            # Scalars: the last plugin that changed them wins.
+            if mine[0] != base[0]:
+                info["chance_none"] = mine[0]
+            if mine[1] != base[1]:
+                info["all_levels"] = mine[1]
+            if mine[2] != base[2]:
+                info["all_items"] = mine[2]
+
+        info["plugins"].append(path)
+        info["record"] = record
+
+    def result(self):
+        """Return the merged lists, only lists changed by more than one plugin are included.
+
+        :returns: (list) EsmLEVRecord objects.
+        """
+        records = []
+        for key in self._order:
+            info = self._lists[key]
+            if len(info["plugins"]) < 2:
+                continue
+            objects = []
+            counts = Counter(info["entries"])
+            for entry in info["order"]:
+                count = counts[entry]
+                if count > 0:
+                    objects.extend([entry] * count)
+                    counts[entry] = 0  # Don't emit duplicates twice.
+            objects.sort(key=lambda obj: obj[0])
+
+            record = info["record"]
+            record._objects = objects
+            record._count = len(objects)
+            record._chance_none = info["chance_none"]
+            record._calc_all_levels = info["all_levels"]
+            record._calc_all_items = info["all_items"]
+            record._changed = True
+            record._merged = True
+            records.append(record)
+        return records
+
+    def contributors(self, records):
+        """Return the plugins that define any of :records:, in load order.
+
+        :records: (list) Result of result().
+        :returns: (list) Paths.
+        """
+        used = set()
+        for record in records:
+            used.update(self._lists[list_key(record)]["plugins"])
+        return [p for p in self._plugins if p in used]
@@ -2,12 +2,11 @@
 # This module is used to create an abstraction layer between mods stored in
 # directories and mods stored in archives.
 import os
-import tempfile
-import shutil
 import core
-
-# see core.py to understand why this was done.
-libarchive = core.setup_libarchive()
+import timings
+import manifest
+import paths
+import extract
 
 
 class ModSource(object):
@@ -21,6 +20,7 @@ class ModSource(object):
 
         self._files = self._get_files()
         self._dirs = sorted(self._files.keys())
+        self._manifest = None
 
     @property
     def name(self):
@@ -42,6 +42,23 @@ class ModSource(object):
     def dirs(self):
         return self._dirs
 
+    @property
+    def collisions(self):
+        """Directories and files of the mod source whose names only differ by case.
+
+        :returns: (dict) See paths.find_collisions()
+        """
+        listing = []
+        for dirpath, files in self._files.iteritems():
+            listing.append(dirpath)
+            listing.extend(dirpath.rstrip("/\\") + "/" + fname for fname in files)
+        return paths.find_collisions(listing)
+
+    @property
+    def manifest(self):
+        """Manifest of the last install(), None before that."""
+        return self._manifest
+
     def _get_resource_dirs(self):
         resources = ("textures", "meshes", "icons", "fonts", "sound", "bookart",
                      "splash", "video")
@@ -62,6 +79,15 @@ class ModSource(object):
 
         return plugins
 
+    def _get_archives(self):
+        archives = []
+        for dirpath in self.dirs:
+            for fname in self.files[dirpath]:
+                if fname.lower().endswith(".bsa"):
+                    archives.append(os.path.join(dirpath, fname))
+
+        return archives
+
     def _get_mod_dir(self):
         """Find the root directory where the mod is located.
 
@@ -71,6 +97,8 @@ class ModSource(object):
         plugins = self._get_plugins()
         if plugins:
             root = os.path.split(plugins[0])[0]
+        elif self._get_archives():  # Assets packed in a BSA, no plugin.
+            root = os.path.split(self._get_archives()[0])[0]
         else:
             if len(resources) == 1:
                 root = os.path.split(resources[0])[0]
@@ -78,19 +106,57 @@ class ModSource(object):
                 root = os.path.commonprefix(resources)
         return root
 
-    def install(self, dest):
+    def install(self, dest, progress=None, lowercase=False):
         """Install the mod to the destination directory.
 
         :dest: (str) Destination.
+        :progress: (callable) Optional, called with the number of bytes
+            processed as the install goes.
+        :lowercase: (bool) Lowercase directory and file names (see
+            paths.lowercase), names only differing by case are merged.
         :returns: (str) The path of the newly installed mod
         """
         if not self.is_mod:
             raise ValueError("%s is not detected as a valid mod" % self.name)
 
-        return self._install(dest)
+        rename = "lowercase" if lowercase else None
+        new_dir = self._install(dest, progress, manifest.RENAMES.get(rename))
+        self._manifest.rename = rename
+        return new_dir
+
+    def update(self, mod_path):
+        """Update an installed copy of the mod to this version, writing only
+        the files that changed and removing the ones this version dropped.
+        Names are changed the way the install did, eg: lowercased.
+
+        :mod_path: (str) Path of the installed mod.
+        :returns: (dict) See manifest.update_tree()
+        """
+        if not self.is_mod:
+            raise ValueError("%s is not detected as a valid mod" % self.name)
+
+        old = manifest.Manifest.load(mod_path)
+        rename = old.rename if old is not None else None
+        entries = self._iter_files()
+        if rename is not None:
+            func = manifest.RENAMES[rename]
+            entries = ((func(rel), size, mtime, blocks) for rel, size, mtime, blocks in entries)
+        with timings.phase("update", self.name) as timer:
+            self._manifest, stats = manifest.update_tree(entries, mod_path, old)
+            timer.read(stats["total"])
+            timer.written(stats["written"])
+        self._manifest.rename = rename
+        self._manifest.save()
+        return stats
 
     # --- Implement these methods in subclasses! ---
-    def _install(self, dest):
+    def _install(self, dest, progress=None, rename=None):
+        raise NotImplementedError
+
+    def _iter_files(self):
+        """Yield (relative path, size, mtime, blocks) for every file of the
+        mod directory, blocks being an iterable of strings that must be
+        consumed before the next file."""
         raise NotImplementedError
 
     def _get_files(self):
@@ -118,19 +184,41 @@ class ModSourceDir(ModSource):
 
     def _get_files(self):
         my_files = dict()
-        for root, _, files in os.walk(self.path):
-            if root == self.path:
-                my_files["/"] = files
-            else:
-                my_files[root[len(self.path):]] = files
+        with timings.phase("source scan", self.path):
+            for root, _, files in os.walk(self.path):
+                if root == self.path:
+                    my_files["/"] = files
+                else:
+                    my_files[root[len(self.path):]] = files
         return my_files
 
-    def _install(self, dest):
+    def _install(self, dest, progress=None, rename=None):
         new_dir = os.path.join(dest, self.name)
         src_dir = os.path.join(self.path, self._get_mod_dir()[1:])
-        shutil.copytree(src_dir, new_dir)
+        with timings.phase("copy", self.name) as timer:
+            self._manifest = manifest.copy_tree(src_dir, new_dir, progress, rename)
+            timer.read(self._manifest.size)
+            timer.written(self._manifest.size)
         return new_dir
 
+    def _iter_files(self):
+        src_dir = os.path.join(self.path, self._get_mod_dir()[1:])
+        for root, _, files in os.walk(src_dir):
+            for fname in files:
+                path = os.path.join(root, fname)
+                st = os.stat(path)
+                yield (os.path.relpath(path, src_dir), st.st_size, st.st_mtime,
+                       self._read_blocks(path))
+
+    @staticmethod
+    def _read_blocks(path):
+        with open(path, "rb") as handle:
+            while True:
+                block = handle.read(manifest.CHUNK_SIZE)
+                if not block:
+                    break
+                yield block
+
 
 class ModSourceArchive(ModSource):
     """Class representing a mod stored in an archive."""
@@ -138,8 +226,12 @@ class ModSourceArchive(ModSource):
         super(ModSourceArchive, self).__init__(*args, **kwargs)
 
     def _get_files(self):
+        libarchive = core.get_libarchive()
         files = dict()
-        with libarchive.file_reader(self.path) as archive:
+        with timings.phase("archive list", self.name) as timer, \
+                libarchive.file_reader(self.path) as archive:
+            if timings.is_enabled():
+                timer.read(os.path.getsize(self.path))
             # Note using entry.isdir or other bool occasionally does not work
             for entry in archive:
                 dir, file = os.path.split(entry.pathname)
@@ -151,30 +243,27 @@ class ModSourceArchive(ModSource):
 
         return files
 
-    def _install(self, dest):
+    def _prefix(self):
+        root = self._get_mod_dir().strip("/")
+        return root + "/" if root else ""
+
+    def _install(self, dest, progress=None, rename=None):
         root = self._get_mod_dir()
-        tempdir = tempfile.mkdtemp()
-
-        # Because libarchive doesn't support extracting to a specific directory
-        prev_dir = os.path.abspath(os.getcwd())
-        os.chdir(tempdir)
-        try:
-            for _ in libarchive.file_pour(self.path):
-                pass
-            if root == "/":
-                src = tempdir
-                name = os.path.splitext(self.name)[0]
-            else:
-                src = os.path.join(tempdir, root[1:])
-                name = os.path.split(root)[-1]
-
-            # Figure out a proper name for the mod.
-            dest = os.path.join(dest, name)
-
-            # Copy to the destination
-            shutil.copytree(src, dest)
-        finally:
-            # Cleanup
-            os.chdir(prev_dir)
-            shutil.rmtree(tempdir)
+        # Figure out a proper name for the mod.
+        if root == "/":
+            name = os.path.splitext(self.name)[0]
+        else:
+            name = os.path.split(root)[-1]
+        dest = os.path.join(dest, name)
+
+        # Decompression and writes overlap, the files go straight to the destination.
+        with timings.phase("extract", self.name) as timer:
+            self._manifest = extract.extract(extract.iter_entries(self.path, self._prefix()),
+                                             dest, progress=progress, rename=rename)
+            if timings.is_enabled():
+                timer.read(os.path.getsize(self.path))
+            timer.written(self._manifest.size)
         return dest
+
+    def _iter_files(self):
+        return extract.iter_entries(self.path, self._prefix())
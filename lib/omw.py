@@ -1,6 +1,76 @@
 # -*- coding: UTF-8 -*-
 # Classes that represent openmw config files and mods/plugins
 import os
+from collections import namedtuple
+
+import core
+import paths
+import timings
+
+# Line kinds
+BLANK, COMMENT, ENTRY, DATA, CONTENT = "BLANK", "COMMENT", "ENTRY", "DATA", "CONTENT"
+
+# One parsed line of openmw.cfg, :raw: is the line as it was read (without
+# the newline) so unchanged lines are written back exactly.
+ConfigLine = namedtuple("ConfigLine", "kind key value raw")
+
+
+def parse_line(raw):
+    """Split a line of openmw.cfg into a ConfigLine.
+    Like OpenMW, only lines starting with # are comments and the value is
+    everything after the first =, so values may contain both.
+
+    :raw: (str) Line without its newline.
+    :returns: (ConfigLine)
+    """
+    stripped = raw.strip()
+    if not stripped:
+        return ConfigLine(BLANK, None, None, raw)
+    if stripped[0] == "#":
+        return ConfigLine(COMMENT, None, None, raw)
+
+    key, sep, value = stripped.partition("=")
+    if not sep:
+        raise ValueError("Expected key=value, got %s" % raw)
+    key, value = key.strip(), value.strip()
+    if key == "data":
+        return ConfigLine(DATA, key, unquote(value), raw)
+    if key == "content":
+        return ConfigLine(CONTENT, key, value, raw)
+    return ConfigLine(ENTRY, key, value, raw)
+
+
+def unquote(value):
+    """Remove OpenMW path quoting, & escapes the next character inside quotes.
+
+    :value: (str) eg: "C:\\Games\\Morrowind &"GOTY&"\\Data Files"
+    :returns: (str)
+    """
+    if not value.startswith('"'):
+        return value
+
+    out = []
+    i, end = 1, len(value)
+    while i < end:
+        char = value[i]
+        if char == "&" and i + 1 < end:
+            out.append(value[i + 1])
+            i += 2
+            continue
+        if char == '"':
+            break
+        out.append(char)
+        i += 1
+    return "".join(out)
+
+
+def quote(path):
+    """Quote a path for a data= line, the reverse of unquote().
+
+    :path: (str)
+    :returns: (str)
+    """
+    return '"%s"' % path.replace("&", "&&").replace('"', '&"')
 
 
 # -- Config file --
@@ -8,12 +78,18 @@ class ConfigFile(object):
     def __init__(self, path=None):
         """OpenMW config file openmw.cfg.
 
+        Lines are parsed into compact ConfigLine tuples, ConfigEntry objects
+        for the generic entries are only created when entries is used.
+
         :path: (str): Path to openmw.cfg, Default: None
         """
-        self._entries = []
+        self._lines = []  # ConfigLine for every line
+        self._entries = None  # materialized lazily, see entries
+        self._line_entries = None  # line index -> entry it was materialized into
         self._mods = []
         self._plugins = []
         self._plugins_orphaned = []
+        self._newline = True  # end the file with a newline
 
         if path:
             self._path = path
@@ -23,14 +99,44 @@ class ConfigFile(object):
     def path(self):
         return self._path
 
+    @property
+    def lines(self):
+        """The parsed lines of the file as loaded, see ConfigLine.
+
+        :returns: (list)
+        """
+        return self._lines
+
     @property
     def entries(self):
-        """Get the list of entries in the config file
+        """Get the list of entries in the config file, data and content excluded.
 
         :returns: (list)
         """
+        if self._entries is None:
+            entries = []
+            line_entries = {}
+            for i, line in enumerate(self._lines):
+                if line.kind == ENTRY:
+                    entry = ConfigEntry(line.key, line.value, config=self)
+                elif line.kind in (BLANK, COMMENT):
+                    entry = ConfigRawEntry(line.raw, line.kind, config=self)
+                else:
+                    continue
+                entries.append(entry)
+                line_entries[i] = entry
+            self._entries = entries
+            self._line_entries = line_entries
         return self._entries
 
+    def get(self, key):
+        """Return the values of every :key: entry, in order.
+
+        :key: (str) eg: "fallback-archive"
+        :returns: (list)
+        """
+        return [line.value for line in self._lines if line.key == key]
+
     @property
     def mods(self):
         """Get the list of installed mods
@@ -50,59 +156,226 @@ class ConfigFile(object):
     def load(self):
         """Load the openmw.cfg file into the instance."""
         enabled_plugins = []
-        with open(self.path, "r") as fh:
-            for line in fh.readlines():
-                if line.isspace():  # Blank line.
-                    entry = ConfigRawEntry(line, "BLANK", config=self)
-                elif line.strip().startswith("#"):  # Comment
-                    entry = ConfigRawEntry(line, "COMMENT", config=self)
-                else:  # Normal entry
-                    entry = ConfigEntry(line, config=self)
-
-                    # -- Seperate mods and plugins from self.entries
-                    if entry.key == "data":  # Mod
-                        self.mods.append(OmwMod(entry.value, self))
-                        continue
-                    elif entry.key == "content":  # plugins list is populated later
-                        enabled_plugins.append(entry.value)
-                        continue
-
-                self.entries.append(entry)
+        lines = self._lines = []
+        self._entries = self._line_entries = None
+        with timings.phase("config load", self.path) as timer, open(self.path, "r") as fh:
+            data = fh.read()
+            timer.read(len(data))
+
+        self._newline = data.endswith("\n")
+        raw_lines = data.split("\n")
+        if self._newline:
+            raw_lines.pop()
+        append = lines.append
+        new_line = tuple.__new__  # skips namedtuple's argument handling
+        for raw in raw_lines:
+            if raw.endswith("\r"):
+                raw = raw[:-1]
+            # Fast path for key=value lines, the rest goes through parse_line.
+            key, sep, value = raw.partition("=")
+            key = key.strip()
+            if not sep or not key or key[0] == "#":
+                append(parse_line(raw))
+            elif key == "data":  # Mod
+                value = unquote(value.strip())
+                append(new_line(ConfigLine, (DATA, key, value, raw)))
+                self.mods.append(OmwMod(value, self))
+            elif key == "content":  # plugins list is populated later
+                value = value.strip()
+                append(new_line(ConfigLine, (CONTENT, key, value, raw)))
+                enabled_plugins.append(value)
+            else:
+                append(new_line(ConfigLine, (ENTRY, key, value.strip(), raw)))
 
         # Populate plugins list
         self._load_plugins(enabled_plugins)
 
     def _load_plugins(self, plist):
-        enabled = []
+        wanted = set(plist)
+        enabled = set()
         for mod in self.mods:
             for plugin in mod.plugins:
-                if plugin.name in plist:
+                if plugin.name in wanted:
                     plugin.enable()
-                    enabled.append(plugin.name)
+                    enabled.add(plugin.name)
 
-        orphans = tuple(p for p in plist if p not in enabled)
-        for pname in orphans:
-            plugin = OmwPlugin(pname, self)
-            plugin.enable()
+        for pname in plist:
+            if pname not in enabled:
+                plugin = OmwPlugin(pname, self)
+                plugin.enable()
+                enabled.add(pname)
 
-        self.plugins.sort(key=lambda p: plist.index(p.name))
+        position = {}
+        for i, pname in enumerate(plist):
+            position.setdefault(pname, i)
+        self.plugins.sort(key=lambda p: position[p.name])
+
+    def render(self):
+        """Return the contents of the config file.
+        Lines keep their original place, data= and content= lines are filled
+        in with the current mods and plugins, new ones go after the last
+        existing line of their kind.
+
+        :returns: (str)
+        """
+        values = {DATA: [m.path for m in self.mods], CONTENT: [p.name for p in self.plugins]}
+        formats = {DATA: lambda path: "data=" + quote(path), CONTENT: "content=".__add__}
+        used = {DATA: 0, CONTENT: 0}
+        last = {}
+        for i, line in enumerate(self._lines):
+            last[line.kind] = i
+
+        out = []
+        line_entries = self._line_entries
+        current = set(id(e) for e in self._entries) if self._entries is not None else None
+        written = set()
+        for i, line in enumerate(self._lines):
+            kind = line.kind
+            if kind not in values:
+                if current is None:
+                    out.append(line.raw)
+                else:
+                    entry = line_entries[i]
+                    if id(entry) in current:  # entries removed since load are dropped
+                        out.append(line.raw)
+                        written.add(id(entry))
+                continue
+
+            pending = values[kind]
+            if used[kind] < len(pending):
+                new = pending[used[kind]]
+                out.append(line.raw if new == line.value else formats[kind](new))
+                used[kind] += 1
+            if last[kind] == i:
+                out.extend(formats[kind](v) for v in pending[used[kind]:])
+                used[kind] = len(pending)
+
+        if current is not None:
+            for entry in self._entries:
+                if id(entry) not in written:
+                    out.append(str(entry))
+        for kind in (DATA, CONTENT):
+            out.extend(formats[kind](v) for v in values[kind][used[kind]:])
+
+        text = "\n".join(out)
+        if self._newline and out:
+            text += "\n"
+        return text
 
     def write(self, path=None):
         """Save the config file to a location on disk.
+        The file is replaced atomically and left untouched if nothing changed.
 
         :path: (str) Path to save to. Default: original path
+        :returns: (bool) False if the file already had the same contents.
         """
         if not path:
             path = self.path
 
-        out = "\n".join((str(e) for e in self.entries)).rstrip("\n")
+        out = self.render()
+        try:
+            with open(path, "r") as handle:
+                if handle.read() == out:
+                    return False
+        except IOError:
+            pass
+
+        with timings.phase("config write", path) as timer:
+            core.atomic_write(path, out)
+            timer.written(len(out))
+        return True
+
+
+class ConfigChain(object):
+    """The chain of config files OpenMW reads, starting from one openmw.cfg.
+
+    Every config= entry names a directory whose openmw.cfg is read after the
+    current file, and replace=key drops the values of key collected from
+    the files read before it. Tokens like ?userconfig? can't be resolved
+    outside of OpenMW, directories using them are skipped.
+    Only reading goes through the chain, changes are made to the first file.
+    """
+
+    def __init__(self, config):
+        """
+        :config: (ConfigFile or str) The first openmw.cfg or its path.
+        """
+        if isinstance(config, basestring):
+            config = core.open_config(config)
+        self._files = []
+        self._load(config, set())
+
+    def _load(self, cfg, seen):
+        seen.add(cfg.path)
+        self._files.append(cfg)
+        base = os.path.dirname(cfg.path)
+        for directory in cfg.get("config"):
+            directory = unquote(directory)
+            if directory.startswith("?"):
+                continue
+            directory = os.path.join(base, os.path.expandvars(os.path.expanduser(directory)))
+            path = core.get_full_path(os.path.join(directory, "openmw.cfg"))
+            if path not in seen and os.path.isfile(path):
+                self._load(core.open_config(path), seen)
+
+    @property
+    def files(self):
+        """ConfigFile objects in the order OpenMW reads them."""
+        return self._files
+
+    def _collect(self, key):
+        values = []  # (ConfigFile, value)
+        for cfg in self._files:
+            own = []
+            for line in cfg.lines:
+                if line.key == "replace" and line.value == key:
+                    values = []  # Earlier files only, this file's values stay.
+                elif line.key == key:
+                    own.append((cfg, line.value))
+            values.extend(own)
+        return values
+
+    def get(self, key):
+        """Return the effective values of :key: across the chain.
+
+        :key: (str) eg: "content"
+        :returns: (list)
+        """
+        return [value for _, value in self._collect(key)]
+
+    @property
+    def mods(self):
+        """The effective data directories as OmwMod objects, the first
+        file's own objects for its directories.
+
+        :returns: (list)
+        """
+        own = dict((mod.path, mod) for mod in self._files[0].mods)
+        mods = []
+        for cfg, value in self._collect("data"):
+            path = os.path.join(os.path.dirname(cfg.path), value)
+            mods.append(own.get(path) or OmwMod(path, cfg))
+        return mods
+
+    def installed_plugins(self):
+        """Every plugin of the data directories, enabled or not, taken from
+        the last data directory having it like OpenMW does.
+
+        :returns: (dict) lowercase plugin name -> path
+        """
+        found = {}
         for mod in self.mods:
-            out = out + '\ndata="%s"' % mod.path
-        for plugin in self.plugins:
-            out = out + '\ncontent=%s' % plugin.name
+            for plugin in mod.plugins:
+                found[plugin.name.lower()] = plugin.path
+        return found
+
+    def plugin_paths(self):
+        """Resolve the effective content= entries.
 
-        with open(path, "w") as handle:
-            handle.write(out)
+        :returns: (list) (name, path) in load order, path is None for missing plugins.
+        """
+        found = self.installed_plugins()
+        return [(name, found.get(name.lower())) for name in self.get("content")]
 
 
 # TODO: Simplify the following two classes since they will no longer be used
@@ -118,7 +391,7 @@ class ConfigEntry(object):
     """
 
     def __init__(self, key, value=None, config=None):
-        if not value:  # Value was not given so assuming key is a raw line
+        if value is None:  # Value was not given so assuming key is a raw line
             key, value, comment = self.unpack_line(key)
         else:
             comment = None
@@ -148,19 +421,13 @@ class ConfigEntry(object):
         :line: (str): Raw line from openmw.cfg
         :returns: (set) key, value, type
         """
-        key, value = (i.strip() for i in line.split("="))
-        if "#" in value:
-            value, comment = value.split("#")
-            value = value.strip()
-            comment = "#" + comment
-        else:
-            comment = None
-
-        if "#" in key:
-            raise ValueError("ConfigEntry key cannot contain a comment, got %s" % line)
-        if value.isspace():
-            raise ValueError("ConfigEntry value cannot be empty, got %s" % line)
+        parsed = parse_line(line.rstrip("\n"))
+        if parsed.kind not in (ENTRY, DATA, CONTENT):
+            raise ValueError("ConfigEntry expects a key=value line, got %s" % line)
 
+        key, value, comment = parsed.key, parsed.value, None
+        if parsed.kind == DATA:
+            value = quote(value)
         return (key, value, comment)
 
     def process_key_value(self, key, value):
@@ -249,15 +516,22 @@ class OmwMod(object):
         """
         plugins = []
         plugin_extensions = [".esm", ".esp", ".omwaddon"]
-        for fname in self.files:
-            for ext in plugin_extensions:
-                if fname.lower().endswith(ext):
-                    plugins.append(OmwPlugin(fname, self.config, self))
+        with timings.phase("mod scan", self.path):
+            for fname in self.files:
+                for ext in plugin_extensions:
+                    if fname.lower().endswith(ext):
+                        plugins.append(OmwPlugin(fname, self.config, self))
 
         return plugins
 
-    def enable(self):
-        self.config.mods.append(self)
+    def enable(self, order=None):
+        """Add the mod's data entry to openmw.cfg.
+
+        :order: (int) Position in the data entries. Default: last.
+        """
+        if order is None:
+            order = len(self.config.mods)
+        self.config.mods.insert(order, self)
 
     def disable(self):
         self.config.mods.remove(self)
@@ -278,6 +552,8 @@ class OmwMod(object):
         """
         dirs = []
         path = self.path
+        if not os.path.isdir(path):  # Removed since it was added, see clean_mods.
+            return dirs
         for fname in os.listdir(path):
             if os.path.isdir(os.path.join(path, fname)):
                 dirs.append(fname)
@@ -292,6 +568,8 @@ class OmwMod(object):
         """
         files = []
         path = self.path
+        if not os.path.isdir(path):  # Removed since it was added, see clean_mods.
+            return files
         for fname in os.listdir(path):
             if os.path.isfile(os.path.join(path, fname)):
                 files.append(fname)
@@ -302,6 +580,33 @@ class OmwMod(object):
     def plugins(self):
         return self._plugins
 
+    @property
+    def archives(self):
+        """Get the BSA archives in the mod directory, enable them with fallback-archive=.
+
+        :returns: (list) File names.
+        """
+        return [f for f in self.files if f.lower().endswith(".bsa")]
+
+    def data_files(self):
+        """Walk the mod directory for data files, plugins and archives at
+        the top of the directory excluded.
+
+        :returns: (dict) Case insensitive key (see paths.normalize) -> paths
+            relative to the mod directory, more than one path means their
+            names only differ by case.
+        """
+        found = {}
+        top_level = (".esm", ".esp", ".omwaddon", ".bsa")
+        for root, _, files in os.walk(self.path):
+            rel_root = "" if root == self.path else os.path.relpath(root, self.path) + os.path.sep
+            for fname in files:
+                if not rel_root and fname.lower().endswith(top_level):
+                    continue
+                rel = rel_root + fname
+                found.setdefault(paths.normalize(rel), []).append(rel)
+        return found
+
     @property
     def plugins_enabled(self):
         plugins = [p for p in self.plugins if p.is_enabled]
@@ -0,0 +1,376 @@
+# -*- coding: UTF-8 -*-
+# Bashed patch style merging of any record type.
+# Every record type that can be merged registers a strategy describing its
+# mergeable parts: collections (inventories, spell lists, faction reactions,
+# leveled list entries) and scalars (single subrecords). Plugins are read
+# once in load order, streamed, records of registered types are indexed by
+# (type, name) and only records edited by more than one plugin are read
+# again, decoded and merged, each plugin's edits are diffed against its
+# closest master.
+import os
+from collections import OrderedDict
+
+import timings
+import core
+from esm import EsmRecord, SUBRECORD_HEADER, stream_records, read_record
+from records import record_hash, DELETED
+from schema import get_schema, iter_subrecords, find_subrecord, record_name
+
+STRATEGIES = {}
+
+
+def register(*ids):
+    """Class decorator registering a merge strategy for record types :ids:."""
+    def decorator(cls):
+        for id in ids:
+            STRATEGIES[id] = cls(id)
+        return cls
+    return decorator
+
+
+def get_strategy(id):
+    """Return the merge strategy of record type :id:, None if it can't be merged."""
+    return STRATEGIES.get(id)
+
+
+class Collection(object):
+    """A repeated group of subrecords merged entry by entry.
+
+    An entry starts with a :sub_ids:[0] subrecord, the following subrecords
+    listed in :sub_ids:[1:] belong to the same entry, eg: ANAM then INTV.
+    """
+
+    def __init__(self, name, sub_ids, key, after=()):
+        """
+        :name: (str) Name of the collection, eg: "inventory"
+        :sub_ids: (tuple) Subrecord ids making an entry.
+        :key: (callable) Takes the decoded values of an entry, returns its key.
+            Entries with the same key are the same entry in different plugins.
+        :after: (tuple) Subrecords the collection follows, used when the
+            winning record doesn't have the collection.
+        """
+        self.name = name
+        self.sub_ids = sub_ids
+        self.key = key
+        self.after = after
+
+
+def _id_key(values):
+    # Item/spell ids are case insensitive.
+    value = values[0]
+    if isinstance(value, dict):
+        value = value["id"]
+    return value.split("\x00", 1)[0].lower()
+
+
+class ParsedRecord(object):
+    """Record data split into plain subrecords, collections and scalars.
+    Subrecords are kept as raw chunks (header included) so unmerged parts
+    are written back untouched.
+    """
+    __slots__ = ("layout", "collections", "scalars")
+
+    def __init__(self):
+        self.layout = []  # (sub_id, chunk), collections are ("", name) placeholders
+        self.collections = {}  # name -> OrderedDict(key -> chunk)
+        self.scalars = {}  # sub_id -> chunk
+
+
+class MergeStrategy(object):
+    """Merges the versions of one record type. Subclasses list their
+    collections and scalars, and register() themselves."""
+
+    collections = ()
+    scalars = ()
+
+    def __init__(self, id):
+        self.id = id
+        self._schema = get_schema(id)
+        self._starts = dict((c.sub_ids[0], c) for c in self.collections)
+
+    def _decode(self, sub_id, data):
+        return self._schema.codec(sub_id).decode(data)
+
+    def parse(self, data):
+        """Split raw record data into a ParsedRecord.
+
+        :data: (str) Raw record data.
+        """
+        parsed = ParsedRecord()
+        current, entry, values = None, None, None
+
+        def close():
+            if current is not None:
+                key = current.key(values)
+                entries = parsed.collections[current.name]
+                # Repeated keys (eg: the same item twice in a leveled list) are numbered.
+                n = 0
+                while (key, n) in entries:
+                    n += 1
+                entries[(key, n)] = "".join(entry)
+
+        for sub_id, offset, size in iter_subrecords(data):
+            chunk = data[offset - 8:offset + size]
+            if current is not None and sub_id in current.sub_ids[1:]:
+                entry.append(chunk)
+                values.append(self._decode(sub_id, data[offset:offset + size]))
+                continue
+            close()
+            current = self._starts.get(sub_id)
+            if current is not None:
+                if current.name not in parsed.collections:
+                    parsed.collections[current.name] = OrderedDict()
+                    parsed.layout.append(("", current.name))
+                entry = [chunk]
+                values = [self._decode(sub_id, data[offset:offset + size])]
+                continue
+            if sub_id in self.scalars and sub_id not in parsed.scalars:
+                parsed.scalars[sub_id] = chunk
+            parsed.layout.append((sub_id, chunk))
+        close()
+        return parsed
+
+    def merge(self, versions):
+        """Merge the versions of a record.
+
+        :versions: (list) (base, mine) ParsedRecords in load order, base is
+            the closest master's version, None if no master has the record.
+        :returns: (str) Merged record data.
+        """
+        first_base, first = versions[0]
+        start = first_base if first_base is not None else first
+        collections = dict((c.name, OrderedDict(start.collections.get(c.name, ())))
+                           for c in self.collections)
+        scalars = dict(start.scalars)
+
+        for base, mine in versions:
+            for collection in self.collections:
+                state = collections[collection.name]
+                entries = mine.collections.get(collection.name, {})
+                if base is None:  # Nothing to diff against, fall back to a union.
+                    state.update(entries)
+                    continue
+                base_entries = base.collections.get(collection.name, {})
+                for key, chunk in entries.items():
+                    if base_entries.get(key) != chunk:
+                        state[key] = chunk
+                for key in base_entries:
+                    if key not in entries:
+                        state.pop(key, None)
+            # Scalars: the last plugin that changed them wins.
+            for sub_id in self.scalars:
+                if base is None or mine.scalars.get(sub_id) != base.scalars.get(sub_id):
+                    if sub_id in mine.scalars:
+                        scalars[sub_id] = mine.scalars[sub_id]
+                    elif base is not None:
+                        scalars.pop(sub_id, None)
+
+        return self.build(versions[-1][1], collections, scalars)
+
+    def build(self, winner, collections, scalars):
+        """Write the merged collections and scalars into the layout of the
+        last loaded version.
+
+        :winner: (ParsedRecord)
+        :collections: (dict) name -> OrderedDict of entries.
+        :scalars: (dict) sub_id -> chunk
+        :returns: (str) Record data.
+        """
+        out = []  # one list of chunks per subrecord or collection
+        written = set()
+        ends = {}  # sub_id -> position in out right after it
+        for sub_id, chunk in winner.layout:
+            if not sub_id:
+                written.add(chunk)
+                out.append(self.entries(chunk, collections[chunk]))
+                ends.update((id, len(out)) for id in self._sub_ids(chunk))
+                continue
+            if sub_id in scalars and sub_id not in written:
+                written.add(sub_id)
+                out.append([scalars[sub_id]])
+            elif sub_id not in self.scalars:
+                out.append([chunk])
+            ends[sub_id] = len(out)
+
+        for collection in self.collections:
+            if collection.name in written or not collections[collection.name]:
+                continue
+            # The winner dropped the whole collection, put it back after its neighbours.
+            pos = max([ends[id] for id in collection.after if id in ends] or [len(out)])
+            out.insert(pos, self.entries(collection.name, collections[collection.name]))
+            for id, end in ends.items():
+                if end >= pos:
+                    ends[id] = end + 1
+            ends.update((id, pos + 1) for id in collection.sub_ids)
+        for sub_id, chunk in scalars.items():
+            if sub_id not in written:
+                out.append([chunk])
+        return "".join("".join(chunks) for chunks in out)
+
+    def _sub_ids(self, name):
+        for collection in self.collections:
+            if collection.name == name:
+                return collection.sub_ids
+        return ()
+
+    def entries(self, name, entries):
+        """Return the chunks of a merged collection in output order."""
+        return list(entries.values())
+
+
+@register("CONT")
+class ContainerStrategy(MergeStrategy):
+    collections = (Collection("inventory", ("NPCO",), _id_key, after=("FLAG",)),)
+
+
+@register("NPC_", "CREA")
+class ActorStrategy(MergeStrategy):
+    collections = (Collection("inventory", ("NPCO",), _id_key, after=("FLAG", "NPDT")),
+                   Collection("spells", ("NPCS",), _id_key, after=("NPCO", "FLAG", "NPDT")))
+
+
+@register("FACT")
+class FactionStrategy(MergeStrategy):
+    collections = (Collection("reactions", ("ANAM", "INTV"), _id_key, after=("RNAM", "FADT")),)
+
+
+def _level_key(values):
+    level = values[1] if len(values) > 1 else 0
+    return (level, values[0].lower())
+
+
+@register("LEVI", "LEVC")
+class LeveledListStrategy(MergeStrategy):
+    scalars = ("DATA", "NNAM")
+
+    def __init__(self, id):
+        entry = "INAM" if id == "LEVI" else "CNAM"
+        self.collections = (Collection("entries", (entry, "INTV"), _level_key, after=("INDX",)),)
+        MergeStrategy.__init__(self, id)
+
+    def entries(self, name, entries):
+        # Sorted by level like the game expects, stable for equal levels.
+        ordered = sorted(entries.items(), key=lambda item: item[0][0][0])
+        return [chunk for _, chunk in ordered]
+
+    def build(self, winner, collections, scalars):
+        data = super(LeveledListStrategy, self).build(winner, collections, scalars)
+        # Keep the entry count in sync.
+        count = SUBRECORD_HEADER.pack("INDX", 4) + get_schema(self.id).codec("INDX").encode(
+                len(collections["entries"]))
+        out = []
+        for sub_id, offset, size in iter_subrecords(data):
+            chunk = data[offset - 8:offset + size]
+            out.append(count if sub_id == "INDX" else chunk)
+        return "".join(out)
+
+
+class RecordPatcher(object):
+    """Builds a patch merging every record edited by more than one plugin.
+
+    Plugins are added in load order and streamed, only the (type, name),
+    hash and offset of records of types with a strategy are kept. Records
+    needing a merge are read back from their plugins in result(), so the
+    cost of merging scales with the number of conflicting records.
+    """
+
+    def __init__(self, strategies=None):
+        """
+        :strategies: (dict) Record id -> MergeStrategy. Default: every registered strategy.
+        """
+        self._strategies = STRATEGIES if strategies is None else strategies
+        self._plugins = []  # paths in load order
+        self._masters = []  # set of lowercase master names, per plugin
+        self._names = {}  # lowercase plugin name -> index
+        # (type, name) -> [(plugin index, deleted, recflag, record_hash, offset)]
+        self._records = OrderedDict()
+
+    def add(self, path):
+        """Index the records of the next plugin in load order.
+
+        :path: (str) Path to the plugin.
+        """
+        header = core.open_esm_header(path)
+        with timings.phase("patch index", os.path.basename(path)):
+            index = len(self._plugins)
+            self._plugins.append(path)
+            self._masters.append(set(name.lower() for name, _ in header.masters))
+            self._names[os.path.basename(path).lower()] = index
+            records, strategies = self._records, self._strategies
+            for offset, id, delflag, recflag, data in stream_records(path):
+                if id not in strategies:
+                    continue
+                name = record_name(id, data)
+                if name is None:
+                    continue
+                deleted = bool(recflag & DELETED or find_subrecord(data, "DELE") is not None)
+                version = (index, deleted, recflag, record_hash(delflag, recflag, data), offset)
+                key = (id, name)
+                versions = records.get(key)
+                if versions is None:
+                    records[key] = [version]
+                else:
+                    versions.append(version)
+
+    def _base(self, versions, i):
+        # Latest earlier version coming from one of the plugin's masters.
+        masters = self._masters[versions[i][0]]
+        for j in range(i - 1, -1, -1):
+            if os.path.basename(self._plugins[versions[j][0]]).lower() in masters:
+                return j
+        return None
+
+    def conflicts(self):
+        """Yield (key, versions, bases) for every record needing a merge.
+
+        A record needs merging when two plugins edit it, or when two plugins
+        that don't know about each other define it.
+        """
+        for key, versions in self._records.items():
+            if len(versions) < 2 or any(v[1] for v in versions):
+                continue  # Defined once, or deleted by someone.
+            bases = [self._base(versions, i) for i in range(len(versions))]
+            edits = [i for i in range(1, len(versions))
+                     if bases[i] is None or versions[bases[i]][3] != versions[i][3]]
+            if len(edits) >= 2 or (edits and bases[edits[0]] is None):
+                yield key, versions, bases
+
+    def result(self):
+        """Merge every conflicting record.
+
+        :returns: (list) List of (EsmRecord, plugin paths it was merged from)
+        """
+        merged = []
+        handles = {}  # plugin index -> open file, only plugins with conflicts are opened
+        try:
+            with timings.phase("patch merge"):
+                for key, versions, bases in self.conflicts():
+                    strategy = self._strategies[key[0]]
+                    datas = []
+                    for index, _, _, _, offset in versions:
+                        handle = handles.get(index)
+                        if handle is None:
+                            handle = handles[index] = open(self._plugins[index], "rb")
+                        datas.append(read_record(handle, offset)[3])
+                    parsed = [strategy.parse(data) for data in datas]
+                    pairs = [(parsed[b] if b is not None else None, parsed[i])
+                             for i, b in enumerate(bases)]
+                    data = strategy.merge(pairs)
+                    if data == datas[-1]:
+                        continue  # The last plugin already has everything.
+                    record = EsmRecord(key[0], len(data), 0, versions[-1][2], data)
+                    merged.append((record, [self._plugins[v[0]] for v in versions]))
+        finally:
+            for handle in handles.values():
+                handle.close()
+        return merged
+
+    def contributors(self, merged):
+        """Return the plugins any of the merged records comes from, in load order.
+
+        :merged: (list) Result of result().
+        """
+        used = set()
+        for _, paths in merged:
+            used.update(paths)
+        return [p for p in self._plugins if p in used]
@@ -0,0 +1,56 @@
+# -*- coding: UTF-8 -*-
+# Case insensitive data paths.
+# The game looks data files up case insensitively but linux filesystems are
+# case sensitive, so "Textures/a.dds" and "textures/A.dds" are two files on
+# disk and one for the game. Every listing goes through normalize() to get
+# the key the game would use, keys are interned and cached since listings
+# repeat the same directory names over and over.
+import os
+from collections import defaultdict
+
+MAX_KEYS = 200000
+_keys = {}  # raw path -> key, emptied when it reaches MAX_KEYS
+
+
+def normalize(path):
+    """Return the case insensitive key of a data path: lowercase, "/"
+    separated, without leading or trailing "/".
+
+    :path: (str) eg: "\\Textures\\Tx_A.dds"
+    :returns: (str) eg: "textures/tx_a.dds"
+    """
+    key = _keys.get(path)
+    if key is None:
+        key = path.replace("\\", "/").strip("/").lower()
+        if isinstance(key, str):
+            key = intern(key)
+        if len(_keys) >= MAX_KEYS:  # A long running daemon would grow it forever.
+            _keys.clear()
+        _keys[path] = key
+    return key
+
+
+def find_collisions(paths):
+    """Find paths that are different on disk but the same file for the game.
+
+    :paths: (iterable) Raw paths, eg: the files and directories of a listing.
+    :returns: (dict) key -> sorted list of the raw paths sharing it, only
+        keys with more than one path.
+    """
+    found = defaultdict(set)
+    for path in paths:
+        found[normalize(path)].add(path)
+    return dict((key, sorted(raw)) for key, raw in found.iteritems() if len(raw) > 1)
+
+
+def lowercase(rel_path):
+    """Lowercase a path relative to a data directory for installing it.
+    Plugins and archives at the top of the directory keep their names,
+    content= and fallback-archive= entries refer to them.
+
+    :rel_path: (str)
+    """
+    if os.path.sep not in rel_path and "/" not in rel_path and \
+            rel_path.lower().endswith((".esm", ".esp", ".omwaddon", ".bsa")):
+        return rel_path
+    return rel_path.lower()
@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+# Record level diff between two versions of a plugin.
+# The old plugin is streamed into an index of record_key -> (hash, offset),
+# then the new one is streamed against it (a hash join): records whose
+# hash matches are unchanged and never decoded. Only changed records are
+# read back from the old plugin and compared subrecord by subrecord.
+# Memory is bounded by the index of the old plugin, neither plugin is
+# loaded whole.
+import os
+
+import timings
+from esm import Esm, stream_records, read_record
+from records import record_key, record_hash
+from schema import RecordView
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+
+def _index_plugin(path):
+    index = {}
+    with timings.phase("diff index", os.path.basename(path)):
+        for offset, id, delflag, recflag, data in stream_records(path):
+            key = record_key(id, data)
+            if key is not None:
+                index[key] = (record_hash(delflag, recflag, data), offset)
+    return index
+
+
+def _grouped(id, data):
+    # subrecord id -> decoded values in order, subrecord ids in order of appearance.
+    groups, order = {}, []
+    for sub_id, value in RecordView(id, data).items():
+        if sub_id not in groups:
+            groups[sub_id] = []
+            order.append(sub_id)
+        groups[sub_id].append(value)
+    return groups, order
+
+
+def diff_subrecords(id, old, new):
+    """Compare the subrecords of two versions of a record.
+    Subrecords are matched by id and position among the subrecords with that
+    id, fields of subrecords decoded to a dict are compared one by one.
+
+    :id: (str) Record id.
+    :old: (str) Raw data of the old version.
+    :new: (str) Raw data of the new version.
+    :returns: (list) (name, old value, new value), old/new value is None
+        when the subrecord was added/removed. name is the subrecord id,
+        "id[n]" for repeated subrecords and "id.field" for fields.
+    """
+    old_groups, old_order = _grouped(id, old)
+    new_groups, new_order = _grouped(id, new)
+    changes = []
+    for sub_id in new_order + [s for s in old_order if s not in new_groups]:
+        old_values = old_groups.get(sub_id, [])
+        new_values = new_groups.get(sub_id, [])
+        repeated = max(len(old_values), len(new_values)) > 1
+        for n in range(max(len(old_values), len(new_values))):
+            name = "%s[%d]" % (sub_id, n) if repeated else sub_id
+            old_value = old_values[n] if n < len(old_values) else None
+            new_value = new_values[n] if n < len(new_values) else None
+            if old_value == new_value:
+                continue
+            if isinstance(old_value, dict) and isinstance(new_value, dict):
+                for field in sorted(set(old_value) | set(new_value)):
+                    if old_value.get(field) != new_value.get(field):
+                        changes.append(("%s.%s" % (name, field), old_value.get(field),
+                                        new_value.get(field)))
+            else:
+                changes.append((name, old_value, new_value))
+    return changes
+
+
+def diff_plugins(old_path, new_path):
+    """Diff two versions of a plugin, record by record.
+
+    :old_path: (str) Path to the old version.
+    :new_path: (str) Path to the new version.
+    :returns: (generator) (status, record_key, changes). Records of the new
+        plugin come first, in its order, as ADDED, CHANGED or UNCHANGED,
+        then the REMOVED ones in the order of the old plugin. changes is the
+        diff_subrecords() of CHANGED records, None otherwise. A changed
+        file header comes first as ("TES3", None).
+    """
+    old_header = Esm(old_path).unpack_file_header()
+    new_header = Esm(new_path).unpack_file_header()
+    if old_header.data != new_header.data:
+        yield CHANGED, ("TES3", None), diff_subrecords("TES3", old_header.data, new_header.data)
+
+    index = _index_plugin(old_path)
+    with open(old_path, "rb") as old_handle, timings.phase("diff", os.path.basename(new_path)):
+        for _, id, delflag, recflag, data in stream_records(new_path):
+            key = record_key(id, data)
+            if key is None:
+                continue
+            found = index.pop(key, None)
+            if found is None:
+                yield ADDED, key, None
+                continue
+            if found[0] == record_hash(delflag, recflag, data):
+                yield UNCHANGED, key, None
+                continue
+            _, old_delflag, old_recflag, old_data = read_record(old_handle, found[1])
+            changes = diff_subrecords(id, old_data, data)
+            if (old_delflag, old_recflag) != (delflag, recflag):
+                changes.insert(0, ("flags", (old_delflag, old_recflag), (delflag, recflag)))
+            yield CHANGED, key, changes
+
+    for key, _ in sorted(index.iteritems(), key=lambda item: item[1][1]):
+        yield REMOVED, key, None
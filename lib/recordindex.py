@@ -0,0 +1,219 @@
+# -*- coding: UTF-8 -*-
+# Which plugins define a record: an inverted index from lowercase record
+# names to (plugin, record type, offset).
+# Each plugin is read once, streamed, into its own cached list of records.
+# They are combined into one index kept in a single pickle with the
+# (size, mtime) of every plugin it was built from, it is only rebuilt when
+# a plugin changed (and only changed plugins are read again).
+# The combined index is made of a few flat strings and arrays, quick to
+# load whatever the number of records:
+#  - names: every name once, sorted, each followed by "\n". Prefix queries
+#    bisect it, substring queries let str.find() scan it.
+#  - starts: offset of each name in :names:, plus the end.
+#  - postings: entries of name n are firsts[n] to firsts[n + 1] in the
+#    plugins / types / offsets arrays, in load order.
+import os
+import cPickle as pickle
+from array import array
+from bisect import bisect_right
+
+import core
+import timings
+from cache import file_key
+from esm import stream_records
+from records import record_key
+
+EXACT = "exact"
+PREFIX = "prefix"
+SUBSTRING = "substring"
+
+
+def index_record_ids(path):
+    """Stream a plugin and list its records by name.
+
+    :path: (str) Path to the plugin.
+    :returns: (dict) names: "\\x00" joined lowercase names, types: joined
+        record types (4 characters each), offsets: array("L") as a string,
+        offset of each record header in the file.
+    """
+    names, types, offsets = [], [], array("L")
+    for offset, id, _, _, data in stream_records(path):
+        key = record_key(id, data)
+        if key is None:
+            continue
+        names.append(key[1].replace("\n", " "))
+        types.append(id)
+        offsets.append(offset)
+    return {"names": "\x00".join(names), "types": "".join(types),
+            "offsets": offsets.tostring()}
+
+
+def _load_array(typecode, data):
+    values = array(typecode)
+    values.fromstring(data)
+    return values
+
+
+class RecordIndex(object):
+    """Record names of a load order and the plugins defining them."""
+
+    # Bump when the layout of the stored index changes.
+    VERSION = 2
+
+    def __init__(self, plugins, names, starts, firsts, owners, types, offsets):
+        self.plugins = plugins
+        self._names = names
+        self._starts = starts
+        self._firsts = firsts
+        self._owners = owners
+        self._types = types
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._starts) - 1
+
+    @classmethod
+    def build(cls, paths, cache=None):
+        """Combine the records of plugins into an index.
+
+        :paths: (list) Plugin paths in load order.
+        :cache: (FileCache) Optional, on-disk cache of per plugin indexes.
+        """
+        with timings.phase("record index"):
+            names, owners, types, offsets = [], array("H"), [], array("L")
+            for n, path in enumerate(paths):
+                if cache is not None:
+                    plugin = cache.get_or_compute(path, index_record_ids)
+                else:
+                    plugin = index_record_ids(path)
+                if not plugin["types"]:
+                    continue
+                plugin_names = plugin["names"].split("\x00")
+                names.extend(plugin_names)
+                owners.extend([n] * len(plugin_names))
+                types.append(plugin["types"])
+                offsets.fromstring(plugin["offsets"])
+            types = "".join(types)
+
+            # The sort is stable, records sharing a name stay in load order.
+            order = sorted(xrange(len(names)), key=names.__getitem__)
+            owners = array("H", [owners[i] for i in order])
+            types = "".join([types[i * 4:i * 4 + 4] for i in order])
+            offsets = array("L", [offsets[i] for i in order])
+            starts, firsts, keys = array("L", [0]), array("L"), []
+            previous = None
+            for position, i in enumerate(order):
+                name = names[i]
+                if name != previous:
+                    keys.append(name)
+                    starts.append(starts[-1] + len(name) + 1)
+                    firsts.append(position)
+                    previous = name
+            firsts.append(len(order))
+            names = "".join(key + "\n" for key in keys)
+        return cls(list(paths), names, starts, firsts, owners, types, offsets)
+
+    @classmethod
+    def load(cls, paths, cache=None, path=None):
+        """Return the index of plugins, from disk when none of them changed
+        since it was stored, built and stored otherwise.
+
+        :paths: (list) Plugin paths in load order.
+        :cache: (FileCache) Optional, on-disk cache of per plugin indexes.
+        :path: (str) Stored index. Default: <cache dir>/record_index.pickle
+        """
+        path = path or os.path.join(core.get_cache_dir(), "record_index.pickle")
+        signature = [(p, file_key(p)) for p in paths]
+        try:
+            with open(path, "rb") as handle:
+                stored = pickle.load(handle)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            stored = None
+        if stored is not None and stored[0] == cls.VERSION and stored[1] == signature:
+            _, _, names, starts, firsts, owners, types, offsets = stored
+            return cls(list(paths), names, _load_array("L", starts), _load_array("L", firsts),
+                       _load_array("H", owners), types, _load_array("L", offsets))
+
+        index = cls.build(paths, cache)
+        index.save(path, signature)
+        return index
+
+    def save(self, path, signature):
+        """Store the index, failures to write are ignored.
+
+        :signature: (list) (plugin path, file_key) it was built from.
+        """
+        tmp_path = path + ".tmp%d" % os.getpid()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmp_path, "wb") as handle:
+                pickle.dump((self.VERSION, signature, self._names, self._starts.tostring(),
+                             self._firsts.tostring(), self._owners.tostring(), self._types,
+                             self._offsets.tostring()), handle, pickle.HIGHEST_PROTOCOL)
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass
+
+    def _name(self, n):
+        return self._names[self._starts[n]:self._starts[n + 1] - 1]
+
+    def _lower_bound(self, text):
+        # First name >= :text:, bisecting the names in place.
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < text:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _matches(self, text, mode):
+        if mode == SUBSTRING:
+            names, starts = self._names, self._starts
+            pos = names.find(text)
+            while pos != -1:
+                n = bisect_right(starts, pos) - 1
+                yield n
+                # Carry on after this name, it is only listed once.
+                pos = names.find(text, starts[n + 1])
+            return
+
+        n = self._lower_bound(text)
+        while n < len(self):
+            name = self._name(n)
+            if name == text or (mode == PREFIX and name.startswith(text)):
+                yield n
+                n += 1
+            else:
+                return
+
+    def find(self, text, mode=EXACT, type=None, limit=None):
+        """Find records by name.
+
+        :text: (str) Name, prefix or part of the name, case insensitive.
+        :mode: (str) EXACT, PREFIX or SUBSTRING.
+        :type: (str) Optional, only records of this type, eg: "NPC_".
+        :limit: (int) Optional, maximum number of names returned.
+        :returns: (list) (name, [(plugin path, record type, offset)]) sorted
+            by name, plugins in load order.
+        """
+        text = text.lower()
+        found = []
+        with timings.phase("find record"):
+            for n in self._matches(text, mode):
+                if limit is not None and len(found) >= limit:
+                    break
+                entries = []
+                for i in xrange(self._firsts[n], self._firsts[n + 1]):
+                    record_type = self._types[i * 4:i * 4 + 4]
+                    if type is None or record_type == type:
+                        entries.append((self.plugins[self._owners[i]], record_type,
+                                        self._offsets[i]))
+                if entries:
+                    found.append((self._name(n), entries))
+        found.sort()
+        return found
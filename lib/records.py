@@ -0,0 +1,174 @@
+# -*- coding: UTF-8 -*-
+# Per plugin record indexes: (type, id) -> flags and a hash of the record.
+# Indexes are cached on disk (see cache.py), building one is the only part
+# that reads the plugin, so commands comparing plugins (conflicts, cleaning)
+# only pay for the plugins that changed since the last run.
+import os
+import hashlib
+from struct import Struct
+
+import timings
+from esm import Esm
+from schema import find_subrecord, record_name
+
+_CELL_DATA = Struct("<3i")
+_GRID = Struct("<2i")
+
+INTERIOR = 0x01
+DELETED = 0x20  # record flag, deleted records also carry a DELE subrecord
+
+
+def record_key(id, data):
+    """Return the key identifying a record across plugins, None for records
+    that can't be told apart (eg: TES3).
+    Exterior cells and landscape are identified by their grid position.
+
+    :id: (str) Record id.
+    :data: (str) Raw record data.
+    :returns: (tuple) record id, lowercase name or grid
+    """
+    if id == "CELL":
+        cell = find_subrecord(data, "DATA")
+        if cell is not None and len(cell) >= 12:
+            flags, x, y = _CELL_DATA.unpack_from(cell)
+            if not flags & INTERIOR:
+                return (id, "%d,%d" % (x, y))
+    elif id == "LAND":
+        grid = find_subrecord(data, "INTV")
+        if grid is None or len(grid) < 8:
+            return None
+        return (id, "%d,%d" % _GRID.unpack_from(grid))
+
+    name = record_name(id, data)
+    if name is None:
+        return None
+    return (id, name)
+
+
+def record_hash(delflag, recflag, data):
+    """Hash a record the way it is written to a plugin, minus its size.
+
+    :returns: (str) Binary digest.
+    """
+    digest = hashlib.md5(data)
+    digest.update(_GRID.pack(delflag, recflag))
+    return digest.digest()
+
+
+def index_records(path):
+    """Index every record of a plugin.
+
+    :path: (str) Path to the plugin.
+    :returns: (dict) record_key -> (delflag, recflag, record_hash)
+    """
+    plugin = Esm(path)
+    plugin.unpack()
+    index = {}
+    with timings.phase("index records", os.path.basename(path)):
+        for _, id, delflag, recflag, data in plugin.iter_raw():
+            key = record_key(id, data)
+            if key is not None:
+                index[key] = (delflag, recflag, record_hash(delflag, recflag, data))
+    return index
+
+
+def load_indexes(paths, cache=None, jobs=1):
+    """Return the record index of every plugin in :paths:.
+    Plugins missing from the cache are indexed in parallel when :jobs: > 1.
+
+    :paths: (list) Plugin paths.
+    :cache: (FileCache) Optional, on-disk cache of indexes.
+    :jobs: (int) Number of worker processes.
+    :returns: (dict) path -> index
+    """
+    indexes = {}
+    missing = []
+    for path in paths:
+        index = cache.get(path) if cache is not None else None
+        if index is None:
+            missing.append(path)
+        else:
+            indexes[path] = index
+
+    if len(missing) > 1 and jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(jobs, len(missing)))
+        try:
+            computed = pool.map(index_records, missing)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        computed = [index_records(path) for path in missing]
+
+    for path, index in zip(missing, computed):
+        indexes[path] = index
+        if cache is not None:
+            cache.set(path, index)
+    return indexes
+
+
+def find_conflicts(paths, indexes, ids=None):
+    """Find records defined by more than one plugin.
+
+    :paths: (list) Plugin paths in load order.
+    :indexes: (dict) path -> index, see load_indexes().
+    :ids: (set) Only look at these record types. Default: every type.
+    :returns: (list) List of (key, [(path, record_hash)]) sorted by key,
+        paths are in load order so the last one is the winner.
+    """
+    owners = {}
+    for path in paths:
+        for key, (_, _, digest) in indexes[path].iteritems():
+            if ids is not None and key[0] not in ids:
+                continue
+            versions = owners.get(key)
+            if versions is None:
+                owners[key] = [(path, digest)]
+            else:
+                versions.append((path, digest))
+    return sorted((key, versions) for key, versions in owners.iteritems() if len(versions) > 1)
+
+
+def find_dirty_records(plugin, masters):
+    """Find the records of a plugin that change nothing.
+
+    Records byte identical to the version in their closest master are
+    "identical", deleted records that no master defines are "deleted".
+    A DIAL is kept whenever one of its INFO records is kept.
+
+    :plugin: (Esm) Unpacked plugin.
+    :masters: (list) Record indexes of the plugin's masters, closest first.
+    :returns: (list) List of (index, key, reason)
+    """
+    dirty = []
+    dialogue = None  # dirty entry of the current DIAL
+    for index, id, delflag, recflag, data in plugin.iter_raw():
+        key = record_key(id, data)
+        if key is None:
+            continue
+
+        base = None
+        for master in masters:
+            base = master.get(key)
+            if base is not None:
+                break
+
+        reason = None
+        deleted = recflag & DELETED or find_subrecord(data, "DELE") is not None
+        if deleted and base is None:
+            reason = "deleted"
+        elif base is not None and base[2] == record_hash(delflag, recflag, data):
+            reason = "identical"
+
+        if id == "DIAL":
+            dialogue = (index, key, reason) if reason else None
+            if dialogue:
+                dirty.append(dialogue)
+            continue
+        if reason:
+            dirty.append((index, key, reason))
+        elif id == "INFO" and dialogue is not None:
+            dirty.remove(dialogue)
+            dialogue = None
+    return dirty
@@ -0,0 +1,422 @@
+# -*- coding: UTF-8 -*-
+# Declarative subrecord layouts for Morrowind record types.
+# SCHEMA maps a record id to its subrecords, every layout is compiled once
+# into a codec (precomputed struct.Struct and field slices) and records are
+# decoded lazily through RecordView, one subrecord at a time.
+# Layouts are based on the UESP Morrowind file format documentation,
+# subrecords that aren't described here are returned as raw strings.
+from struct import Struct, error as StructError
+
+_SUBRECORD_HEADER = Struct("<4si")
+_INDEX = Struct("<i")
+
+
+# -- Codecs --
+class Raw(object):
+    """Subrecord data kept as is."""
+
+    def decode(self, data):
+        return data
+
+    def encode(self, value):
+        return value
+
+
+class ZString(Raw):
+    """Null terminated string."""
+
+    def decode(self, data):
+        return data.rstrip("\x00")
+
+    def encode(self, value):
+        return value + "\x00"
+
+
+class Fields(object):
+    """Fixed size struct made of named fields.
+
+    :fields: (list) List of (name, format) tuples, eg: [("weight", "f"), ("skills", "27B")].
+        A repeat count makes the field a tuple, except for "s" where it is
+        the string length (trailing nulls are stripped on decode).
+    """
+
+    def __init__(self, fields):
+        self._fields = fields
+        self._struct = Struct("<" + "".join(fmt for _, fmt in fields))
+        self._plan = []  # (name, start, end, kind)
+        pos = 0
+        for name, fmt in fields:
+            count = int(fmt[:-1]) if len(fmt) > 1 else 1
+            code = fmt[-1]
+            if code == "s":
+                self._plan.append((name, pos, pos + 1, "string"))
+                pos += 1
+            elif count > 1:
+                self._plan.append((name, pos, pos + count, "array"))
+                pos += count
+            else:
+                self._plan.append((name, pos, pos + 1, "value"))
+                pos += 1
+
+    @property
+    def size(self):
+        return self._struct.size
+
+    @property
+    def names(self):
+        return [name for name, _ in self._fields]
+
+    def decode(self, data):
+        """Decode :data: into a dict of field name -> value."""
+        values = self._struct.unpack(data)
+        out = {}
+        for name, start, end, kind in self._plan:
+            if kind == "value":
+                out[name] = values[start]
+            elif kind == "string":
+                out[name] = values[start].rstrip("\x00")
+            else:
+                out[name] = values[start:end]
+        return out
+
+    def encode(self, value):
+        flat = []
+        for name, start, end, kind in self._plan:
+            if kind == "array":
+                flat.extend(value[name])
+            else:
+                flat.append(value[name])
+        return self._struct.pack(*flat)
+
+
+class Value(Fields):
+    """Struct holding a single value, decoded to the value itself."""
+
+    def __init__(self, fmt):
+        super(Value, self).__init__([("value", fmt)])
+
+    def decode(self, data):
+        return super(Value, self).decode(data)["value"]
+
+    def encode(self, value):
+        return super(Value, self).encode({"value": value})
+
+
+class BySize(object):
+    """Subrecords whose layout depends on their size, eg: NPC_ NPDT."""
+
+    def __init__(self, *codecs):
+        self._codecs = dict((codec.size, codec) for codec in codecs)
+
+    def decode(self, data):
+        codec = self._codecs.get(len(data))
+        if codec is None:
+            return data
+        return codec.decode(data)
+
+    def encode(self, value):
+        if isinstance(value, str):
+            return value
+        for codec in self._codecs.values():
+            if set(codec.names) == set(value):
+                return codec.encode(value)
+        raise ValueError("No layout matches %s" % sorted(value))
+
+
+RAW = Raw()
+ZSTRING = ZString()
+INT = Value("i")
+FLOAT = Value("f")
+BYTE = Value("B")
+SHORT = Value("h")
+
+# Shared layouts
+EFFECT = Fields([("effect", "h"), ("skill", "b"), ("attribute", "b"), ("range", "i"),
+                 ("area", "i"), ("duration", "i"), ("magnitude_min", "i"), ("magnitude_max", "i")])
+ITEM = Fields([("count", "i"), ("id", "32s")])
+AIDT = Fields([("hello", "B"), ("unknown1", "B"), ("fight", "B"), ("flee", "B"), ("alarm", "B"),
+               ("unknown2", "3B"), ("flags", "i")])
+TRAVEL = Fields([("position", "3f"), ("rotation", "3f")])
+COLOR = Fields([("red", "B"), ("green", "B"), ("blue", "B"), ("unused", "B")])
+
+# Subrecords shared by most object types
+_OBJECT = {"NAME": ZSTRING, "MODL": ZSTRING, "FNAM": ZSTRING, "SCRI": ZSTRING, "ITEX": ZSTRING,
+           "ENAM": ZSTRING}
+
+
+def _object(**subrecords):
+    layout = dict(_OBJECT)
+    layout.update(subrecords)
+    return layout
+
+
+# record id -> {subrecord id: codec}
+SCHEMA = {
+    "TES3": {"HEDR": Fields([("version", "f"), ("type", "i"), ("author", "32s"),
+                             ("description", "256s"), ("records", "i")]),
+             "MAST": ZSTRING, "DATA": Value("q")},
+    "GMST": {"NAME": ZSTRING, "STRV": RAW, "INTV": INT, "FLTV": FLOAT},
+    "GLOB": {"NAME": ZSTRING, "FNAM": Value("c"), "FLTV": FLOAT},
+    "CLAS": {"NAME": ZSTRING, "FNAM": ZSTRING, "DESC": RAW,
+             "CLDT": Fields([("attributes", "2i"), ("specialization", "i"), ("skills", "10i"),
+                             ("playable", "i"), ("services", "i")])},
+    "FACT": {"NAME": ZSTRING, "FNAM": ZSTRING, "RNAM": Value("32s"), "ANAM": ZSTRING, "INTV": INT,
+             "FADT": Fields([("attributes", "2i"), ("ranks", "50i"), ("skills", "7i"),
+                             ("flags", "i")])},
+    "RACE": {"NAME": ZSTRING, "FNAM": ZSTRING, "NPCS": Value("32s"), "DESC": RAW,
+             "RADT": Fields([("skill_bonuses", "14i"), ("attributes", "16i"), ("height", "2f"),
+                             ("weight", "2f"), ("flags", "i")])},
+    "SOUN": {"NAME": ZSTRING, "FNAM": ZSTRING,
+             "DATA": Fields([("volume", "B"), ("range_min", "B"), ("range_max", "B")])},
+    "SKIL": {"INDX": INT, "DESC": RAW,
+             "SKDT": Fields([("attribute", "i"), ("specialization", "i"), ("use_values", "4f")])},
+    "MGEF": {"INDX": INT, "DESC": RAW, "ITEX": ZSTRING, "PTEX": ZSTRING,
+             "MEDT": Fields([("school", "i"), ("base_cost", "f"), ("flags", "i"), ("color", "3i"),
+                             ("speed", "f"), ("size", "f"), ("size_cap", "f")])},
+    "SCPT": {"SCHD": Fields([("name", "32s"), ("shorts", "i"), ("longs", "i"), ("floats", "i"),
+                             ("data_size", "i"), ("locals_size", "i")]),
+             "SCVR": RAW, "SCDT": RAW, "SCTX": RAW},
+    "REGN": {"NAME": ZSTRING, "FNAM": ZSTRING, "BNAM": ZSTRING, "CNAM": COLOR, "WEAT": RAW,
+             "SNAM": Fields([("sound", "32s"), ("chance", "B")])},
+    "BSGN": {"NAME": ZSTRING, "FNAM": ZSTRING, "TNAM": ZSTRING, "DESC": RAW, "NPCS": Value("32s")},
+    "LTEX": {"NAME": ZSTRING, "INTV": INT, "DATA": ZSTRING},
+    "STAT": {"NAME": ZSTRING, "MODL": ZSTRING},
+    "DOOR": _object(SNAM=ZSTRING, ANAM=ZSTRING),
+    "ACTI": _object(),
+    "MISC": _object(MCDT=Fields([("weight", "f"), ("value", "i"), ("unknown", "i")])),
+    "WEAP": _object(WPDT=Fields([("weight", "f"), ("value", "i"), ("type", "h"), ("health", "h"),
+                                 ("speed", "f"), ("reach", "f"), ("enchant", "h"), ("chop", "2B"),
+                                 ("slash", "2B"), ("thrust", "2B"), ("flags", "i")])),
+    "ARMO": _object(AODT=Fields([("type", "i"), ("weight", "f"), ("value", "i"), ("health", "i"),
+                                 ("enchant", "i"), ("armour", "i")]),
+                    INDX=BYTE, BNAM=ZSTRING, CNAM=ZSTRING),
+    "CLOT": _object(CTDT=Fields([("type", "i"), ("weight", "f"), ("value", "h"), ("enchant", "h")]),
+                    INDX=BYTE, BNAM=ZSTRING, CNAM=ZSTRING),
+    "BOOK": _object(BKDT=Fields([("weight", "f"), ("value", "i"), ("scroll", "i"), ("skill", "i"),
+                                 ("enchant", "i")]), TEXT=RAW),
+    "ALCH": _object(ALDT=Fields([("weight", "f"), ("value", "i"), ("autocalc", "i")]),
+                    TEXT=ZSTRING, ENAM=EFFECT),
+    "INGR": _object(IRDT=Fields([("weight", "f"), ("value", "i"), ("effects", "4i"),
+                                 ("skills", "4i"), ("attributes", "4i")])),
+    "APPA": _object(AADT=Fields([("type", "i"), ("quality", "f"), ("weight", "f"), ("value", "i")])),
+    "LOCK": _object(LKDT=Fields([("weight", "f"), ("value", "i"), ("quality", "f"), ("uses", "i")])),
+    "PROB": _object(PBDT=Fields([("weight", "f"), ("value", "i"), ("quality", "f"), ("uses", "i")])),
+    "REPA": _object(RIDT=Fields([("weight", "f"), ("value", "i"), ("uses", "i"), ("quality", "f")])),
+    "LIGH": _object(LHDT=Fields([("weight", "f"), ("value", "i"), ("time", "i"), ("radius", "i"),
+                                 ("color", "4B"), ("flags", "i")]), SNAM=ZSTRING),
+    "BODY": {"NAME": ZSTRING, "MODL": ZSTRING, "FNAM": ZSTRING,
+             "BYDT": Fields([("part", "B"), ("vampire", "B"), ("flags", "B"), ("type", "B")])},
+    "ENCH": {"NAME": ZSTRING, "ENAM": EFFECT,
+             "ENDT": Fields([("type", "i"), ("cost", "i"), ("charge", "i"), ("autocalc", "i")])},
+    "SPEL": {"NAME": ZSTRING, "FNAM": ZSTRING, "ENAM": EFFECT,
+             "SPDT": Fields([("type", "i"), ("cost", "i"), ("flags", "i")])},
+    "CONT": _object(CNDT=FLOAT, FLAG=INT, NPCO=ITEM),
+    "CREA": _object(CNAM=ZSTRING, FLAG=INT, XSCL=FLOAT, NPCO=ITEM, NPCS=Value("32s"), AIDT=AIDT,
+                    DODT=TRAVEL, DNAM=ZSTRING,
+                    NPDT=Fields([("type", "i"), ("level", "i"), ("attributes", "8i"),
+                                 ("health", "i"), ("magicka", "i"), ("fatigue", "i"), ("soul", "i"),
+                                 ("combat", "i"), ("magic", "i"), ("stealth", "i"),
+                                 ("attacks", "6i"), ("gold", "i")])),
+    "NPC_": _object(RNAM=ZSTRING, CNAM=ZSTRING, ANAM=ZSTRING, BNAM=ZSTRING, KNAM=ZSTRING,
+                    FLAG=INT, NPCO=ITEM, NPCS=Value("32s"), AIDT=AIDT, DODT=TRAVEL, DNAM=ZSTRING,
+                    NPDT=BySize(
+                        Fields([("level", "h"), ("attributes", "8B"), ("skills", "27B"),
+                                ("unknown", "B"), ("health", "h"), ("magicka", "h"),
+                                ("fatigue", "h"), ("disposition", "B"), ("reputation", "B"),
+                                ("rank", "B"), ("unknown2", "B"), ("gold", "i")]),
+                        Fields([("level", "h"), ("disposition", "B"), ("reputation", "B"),
+                                ("rank", "B"), ("unknown", "3B"), ("gold", "i")]))),
+    "LEVI": {"NAME": ZSTRING, "DATA": INT, "NNAM": BYTE, "INDX": INT, "INAM": ZSTRING, "INTV": SHORT},
+    "LEVC": {"NAME": ZSTRING, "DATA": INT, "NNAM": BYTE, "INDX": INT, "CNAM": ZSTRING, "INTV": SHORT},
+    "CELL": {"NAME": ZSTRING, "RGNN": ZSTRING, "NAM0": INT, "WHGT": FLOAT,
+             "DATA": BySize(Fields([("flags", "i"), ("grid_x", "i"), ("grid_y", "i")]),
+                            TRAVEL),
+             "AMBI": Fields([("ambient", "4B"), ("sunlight", "4B"), ("fog", "4B"),
+                             ("fog_density", "f")]),
+             "FRMR": INT, "XSCL": FLOAT, "ANAM": ZSTRING, "BNAM": ZSTRING, "XSOL": ZSTRING,
+             "CNAM": ZSTRING, "INDX": INT, "XCHG": FLOAT, "INTV": INT, "NAM9": INT,
+             "DODT": TRAVEL, "DNAM": ZSTRING, "FLTV": INT, "KNAM": ZSTRING, "TNAM": ZSTRING,
+             "UNAM": BYTE, "NAM5": INT},
+    "SNDG": {"NAME": ZSTRING, "DATA": INT, "CNAM": ZSTRING, "SNAM": ZSTRING},
+    "DIAL": {"NAME": ZSTRING, "DATA": BySize(Value("B"), Value("i"))},
+    "INFO": {"INAM": ZSTRING, "PNAM": ZSTRING, "NNAM": ZSTRING, "ONAM": ZSTRING, "RNAM": ZSTRING,
+             "CNAM": ZSTRING, "FNAM": ZSTRING, "ANAM": ZSTRING, "DNAM": ZSTRING, "SNAM": ZSTRING,
+             "NAME": RAW, "SCVR": RAW, "INTV": INT, "FLTV": FLOAT, "BNAM": RAW,
+             "DATA": Fields([("unknown", "i"), ("disposition", "i"), ("rank", "b"), ("gender", "b"),
+                             ("pc_rank", "b"), ("unknown2", "b")])},
+    "LAND": {},
+    "PGRD": {},
+}
+
+
+# Subrecord holding the editor id of records that don't use NAME, None for
+# records without an id.
+NAME_SUBRECORDS = {"INFO": "INAM", "SKIL": "INDX", "MGEF": "INDX", "SCPT": "SCHD",
+                   "LAND": None, "TES3": None}
+
+
+class RecordSchema(object):
+    """Compiled dispatch table for one record type."""
+    __slots__ = ("id", "codecs")
+
+    def __init__(self, id, layout):
+        self.id = id
+        self.codecs = dict(layout)
+
+    def codec(self, sub_id):
+        """Return the codec of :sub_id:, raw for undescribed subrecords."""
+        return self.codecs.get(sub_id, RAW)
+
+
+_compiled = dict((id, RecordSchema(id, layout)) for id, layout in SCHEMA.items())
+_RAW_SCHEMA = RecordSchema(None, {})
+
+
+def get_schema(id):
+    """Return the compiled schema for record type :id:.
+
+    :id: (str) Record id, eg: "NPC_"
+    :returns: (RecordSchema)
+    """
+    return _compiled.get(id, _RAW_SCHEMA)
+
+
+def iter_subrecords(data):
+    """Yield (id, offset, size) for every subrecord in a record's data.
+
+    :data: (str) Raw record data.
+    """
+    pos, end = 0, len(data)
+    header = _SUBRECORD_HEADER
+    while pos < end:
+        id, size = header.unpack_from(data, pos)
+        pos += 8
+        yield id, pos, size
+        pos += size
+
+
+def find_subrecord(data, sub_id):
+    """Return the raw data of the first :sub_id: subrecord, None if missing.
+    Cheaper than a RecordView when only one subrecord is needed, eg: NAME.
+
+    :data: (str) Raw record data.
+    :sub_id: (str) Subrecord id.
+    """
+    pos, end = 0, len(data)
+    header = _SUBRECORD_HEADER
+    while pos < end:
+        id, size = header.unpack_from(data, pos)
+        pos += 8
+        if id == sub_id:
+            return data[pos:pos + size]
+        pos += size
+    return None
+
+
+def record_name(id, data):
+    """Return the lowercase editor id of a record, None if it doesn't have one.
+    Ids are case insensitive in Morrowind.
+
+    :id: (str) Record id.
+    :data: (str) Raw record data.
+    """
+    sub_id = NAME_SUBRECORDS.get(id, "NAME")
+    if sub_id is None:
+        return None
+    name = find_subrecord(data, sub_id)
+    if name is None:
+        return None
+    if sub_id == "INDX":  # Skills and magic effects are identified by their index.
+        return "%d" % _INDEX.unpack_from(name)[0] if len(name) >= 4 else None
+    return name.split("\x00", 1)[0].lower()
+
+
+class RecordView(object):
+    """Lazily decoded view over a record's subrecords.
+
+    Only the subrecord headers are scanned (once, on first access), and a
+    subrecord's data is decoded the first time it is asked for.
+    """
+    __slots__ = ("_id", "_data", "_schema", "_index", "_decoded")
+
+    def __init__(self, id, data):
+        """
+        :id: (str) Record id.
+        :data: (str) Raw record data.
+        """
+        self._id = id
+        self._data = data
+        self._schema = get_schema(id)
+        self._index = None  # list of (subrecord id, offset, size)
+        self._decoded = {}  # offset -> value
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def subrecord_ids(self):
+        """Subrecord ids in the order they appear."""
+        return [sub_id for sub_id, _, _ in self._subrecords()]
+
+    def _subrecords(self):
+        if self._index is None:
+            self._index = list(iter_subrecords(self._data))
+        return self._index
+
+    def _decode(self, sub_id, offset, size):
+        value = self._decoded.get(offset)
+        if value is None:
+            data = self._data[offset:offset + size]
+            try:
+                value = self._schema.codec(sub_id).decode(data)
+            except StructError:  # Not the documented size, keep it raw.
+                value = data
+            self._decoded[offset] = value
+        return value
+
+    def get(self, sub_id, default=None):
+        """Return the decoded value of the first :sub_id: subrecord."""
+        for id, offset, size in self._subrecords():
+            if id == sub_id:
+                return self._decode(id, offset, size)
+        return default
+
+    def __getitem__(self, sub_id):
+        value = self.get(sub_id, self)
+        if value is self:
+            raise KeyError(sub_id)
+        return value
+
+    def __contains__(self, sub_id):
+        return any(id == sub_id for id, _, _ in self._subrecords())
+
+    def get_all(self, sub_id):
+        """Return the decoded values of every :sub_id: subrecord, in order."""
+        return [self._decode(id, offset, size) for id, offset, size in self._subrecords()
+                if id == sub_id]
+
+    def items(self):
+        """Return every subrecord as a list of (id, decoded value) in order."""
+        return [(id, self._decode(id, offset, size)) for id, offset, size in self._subrecords()]
+
+    @property
+    def name(self):
+        """The record's NAME (its editor id), None if it has none."""
+        return self.get("NAME")
+
+
+def encode_subrecords(id, items):
+    """Pack a list of (subrecord id, value) into record data using the schema of :id:.
+
+    :id: (str) Record id.
+    :items: (list) List of (subrecord id, decoded value).
+    :returns: (str)
+    """
+    schema = get_schema(id)
+    out = []
+    for sub_id, value in items:
+        data = schema.codec(sub_id).encode(value)
+        out.append(_SUBRECORD_HEADER.pack(sub_id, len(data)))
+        out.append(data)
+    return "".join(out)
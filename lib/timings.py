@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 -*-
+# Per-phase timing instrumentation, enabled by the CLI's --timings option.
+# Library code wraps expensive work in phases:
+#   with timings.phase("parse", path) as p:
+#       ...
+#       p.read(size)
+# When timings are disabled phase() returns a shared no-op object so the
+# hooks cost next to nothing.
+import os
+import json
+import time
+from collections import OrderedDict
+
+_enabled = False
+_events = []
+
+
+def _cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+class _Phase(object):
+    """A single timed phase, records itself into the event list on exit."""
+    __slots__ = ("name", "detail", "bytes_read", "bytes_written", "_wall", "_cpu")
+
+    def __init__(self, name, detail):
+        self.name = name
+        self.detail = detail
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._cpu = _cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        _events.append({"phase": self.name,
+                        "detail": self.detail,
+                        "wall": time.time() - self._wall,
+                        "cpu": _cpu_time() - self._cpu,
+                        "read": self.bytes_read,
+                        "written": self.bytes_written})
+        return False
+
+    def read(self, num):
+        """Account :num: bytes read during this phase."""
+        self.bytes_read += num
+
+    def written(self, num):
+        """Account :num: bytes written during this phase."""
+        self.bytes_written += num
+
+
+class _NullPhase(object):
+    """Stand in for _Phase when timings are disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def read(self, num):
+        pass
+
+    def written(self, num):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def enable():
+    """Start recording phases, discarding anything recorded before."""
+    global _enabled
+    _enabled = True
+    del _events[:]
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """Use this to skip work that only feeds the timings, eg: measuring sizes.
+
+    :returns: (bool)
+    """
+    return _enabled
+
+
+def phase(name, detail=None):
+    """Return a context manager timing a phase.
+
+    :name: (str) Phase name, events are grouped by it in the summary.
+    :detail: (str) Optional detail, eg: the plugin being parsed.
+    :returns: (context manager)
+    """
+    if not _enabled:
+        return _NULL_PHASE
+    return _Phase(name, detail)
+
+
+def events():
+    """Return the recorded events in the order they finished.
+
+    :returns: (list) List of dicts.
+    """
+    return list(_events)
+
+
+def summary():
+    """Group the recorded events by phase.
+
+    :returns: (OrderedDict) phase -> dict of count, wall, cpu, read, written
+    """
+    phases = OrderedDict()
+    for event in _events:
+        totals = phases.setdefault(event["phase"], {"count": 0, "wall": 0.0, "cpu": 0.0,
+                                                    "read": 0, "written": 0})
+        totals["count"] += 1
+        for key in ("wall", "cpu", "read", "written"):
+            totals[key] += event[key]
+    return phases
+
+
+def format_bytes(num):
+    """Format a byte count for humans, eg: 1.5 MiB"""
+    for unit in ("B", "KiB", "MiB"):
+        if num < 1024:
+            return "%d %s" % (num, unit) if unit == "B" else "%.1f %s" % (num, unit)
+        num /= 1024.0
+    return "%.1f GiB" % num
+
+
+class Throughput(object):
+    """Live "bytes done, rate" line for long running commands.
+    Call it with byte counts as work progresses, the line is redrawn at most
+    every :interval: seconds and finished by close().
+    """
+
+    def __init__(self, label, stream, interval=0.5):
+        """
+        :label: (str) Shown in front of the numbers.
+        :stream: (file) Where the line goes, eg: sys.stderr.
+        :interval: (float) Minimum time between redraws in seconds.
+        """
+        self._label = label
+        self._stream = stream
+        self._interval = interval
+        self._done = 0
+        self._start = self._last = time.time()
+
+    def __call__(self, num):
+        self._done += num
+        now = time.time()
+        if now - self._last >= self._interval:
+            self._last = now
+            self._draw(now)
+
+    def _draw(self, now, end="\r"):
+        rate = self._done / max(now - self._start, 1e-6)
+        self._stream.write("%s: %s (%s/s)\x1b[K%s" % (self._label, format_bytes(self._done),
+                                                      format_bytes(rate), end))
+        self._stream.flush()
+
+    def close(self):
+        """Draw the final line."""
+        self._draw(time.time(), "\n")
+
+
+def format_summary():
+    """Render the summary as a table.
+    Times are inclusive, phases running inside other phases are counted in both.
+
+    :returns: (str)
+    """
+    lines = ["%-16s %6s %10s %10s %12s %12s" % ("phase", "count", "wall (s)", "cpu (s)",
+                                               "read", "written")]
+    for name, totals in summary().items():
+        lines.append("%-16s %6d %10.3f %10.3f %12s %12s" % (
+            name, totals["count"], totals["wall"], totals["cpu"],
+            format_bytes(totals["read"]), format_bytes(totals["written"])))
+    return "\n".join(lines)
+
+
+def dump_json(path):
+    """Write the summary and every event to :path: as JSON.
+
+    :path: (str) Output file.
+    """
+    with open(path, "w") as handle:
+        json.dump({"summary": summary(), "events": _events}, handle, indent=2)
@@ -0,0 +1,274 @@
+# -*- coding: UTF-8 -*-
+# Trash for uninstalled mods.
+# Uninstalling renames the mod directory into a trash directory next to it
+# (same filesystem, so it is a single atomic rename) and the actual deletion
+# happens later, in a background reaper or the purge command. Until then
+# the mod can be restored.
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+
+import core
+
+TRASH_DIR = ".omw-mm-trash"
+DAY = 24 * 60 * 60
+
+
+def _known_dirs_path():
+    return os.path.join(core.get_cache_dir(), "trash_dirs.json")
+
+
+def known_trash_dirs():
+    """Return every trash directory mods were moved to, so they can be found
+    after the mod is gone from openmw.cfg.
+
+    :returns: (list)
+    """
+    try:
+        with open(_known_dirs_path()) as handle:
+            return [d for d in json.load(handle) if os.path.isdir(d)]
+    except (IOError, ValueError):
+        return []
+
+
+def _remember_dir(trash_dir):
+    dirs = known_trash_dirs()
+    if trash_dir in dirs:
+        return
+    dirs.append(trash_dir)
+    path = _known_dirs_path()
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        core.atomic_write(path, json.dumps(dirs))
+    except (IOError, OSError):
+        pass
+
+
+def get_trash_dir(mod_path):
+    """Return the trash directory used for a mod directory.
+
+    :mod_path: (str) Path to the mod directory.
+    :returns: (str)
+    """
+    return os.path.join(os.path.dirname(mod_path.rstrip(os.path.sep)), TRASH_DIR)
+
+
+class TrashEntry(object):
+    """A trashed mod: its directory in the trash and the info needed to restore it."""
+
+    def __init__(self, trash_dir, id, info):
+        """
+        :trash_dir: (str) Trash directory containing the entry.
+        :id: (str) Name of the entry in the trash.
+        :info: (dict) "path", "time", "plugins" (enabled plugins in load order),
+            "positions" (their load order positions) and "data_position"
+            (position of the mod's data= entry).
+        """
+        self._trash_dir = trash_dir
+        self._id = id
+        self._info = info
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def path(self):
+        """Where the mod was installed."""
+        return self._info["path"]
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def time(self):
+        return self._info["time"]
+
+    @property
+    def plugins(self):
+        return self._info.get("plugins", [])
+
+    @property
+    def positions(self):
+        """Load order position of each plugin when the mod was uninstalled,
+        empty for entries trashed before positions were recorded.
+
+        :returns: (dict) plugin name -> position (0 based)
+        """
+        return dict(zip(self.plugins, self._info.get("positions", [])))
+
+    @property
+    def data_position(self):
+        """Position of the mod's data= entry when it was uninstalled, None
+        for entries trashed before it was recorded.
+
+        :returns: (int)
+        """
+        return self._info.get("data_position")
+
+    @property
+    def data_path(self):
+        """Where the mod directory is while in the trash."""
+        return os.path.join(self._trash_dir, self._id)
+
+    @property
+    def info_path(self):
+        return self.data_path + ".json"
+
+    def restore(self):
+        """Move the mod directory back to where it was installed.
+
+        :raises: (ValueError) if something already exists there.
+        """
+        if os.path.exists(self.path):
+            raise ValueError("'%s' already exists, can't restore it." % self.path)
+        os.rename(self.data_path, self.path)
+        os.remove(self.info_path)
+
+    def delete(self):
+        """Permanently delete the trashed mod."""
+        # Drop the info file first so a half deleted entry is never restored.
+        if os.path.exists(self.info_path):
+            os.remove(self.info_path)
+        if os.path.exists(self.data_path):
+            _rmtree(self.data_path)
+        if not os.path.exists(self.path):
+            from manifest import Manifest
+            Manifest(self.path).delete()
+
+
+def move_to_trash(mod_path, plugins=(), positions=(), data_position=None):
+    """Move a mod directory to the trash, this is a single rename.
+
+    :mod_path: (str) Path to the mod directory.
+    :plugins: (list) Enabled plugins of the mod in load order, re-enabled on restore.
+    :positions: (list) Load order position of each of :plugins:, where they go back on restore.
+    :data_position: (int) Position of the mod's data= entry, where it goes back on restore.
+    :returns: (TrashEntry)
+    """
+    if not os.path.isdir(mod_path):
+        raise ValueError("'%s' is not a directory." % mod_path)
+
+    trash_dir = get_trash_dir(mod_path)
+    if not os.path.isdir(trash_dir):
+        os.makedirs(trash_dir)
+    _remember_dir(trash_dir)
+
+    now = time.time()
+    id = "%s.%d" % (os.path.basename(mod_path.rstrip(os.path.sep)), now)
+    while os.path.exists(os.path.join(trash_dir, id)):
+        id += "_"
+    entry = TrashEntry(trash_dir, id, {"path": mod_path, "time": now, "plugins": list(plugins),
+                                     "positions": list(positions),
+                                     "data_position": data_position})
+    # The info file goes first, a directory without one is a purge leftover.
+    with open(entry.info_path, "w") as handle:
+        json.dump(entry._info, handle)
+    try:
+        os.rename(mod_path, entry.data_path)
+    except OSError:
+        os.remove(entry.info_path)
+        raise
+    return entry
+
+
+def list_trash(trash_dirs):
+    """List trashed mods, oldest first.
+
+    :trash_dirs: (iterable) Trash directories to look in.
+    :returns: (list) TrashEntry objects.
+    """
+    entries = []
+    for trash_dir in set(trash_dirs):
+        if not os.path.isdir(trash_dir):
+            continue
+        for fname in os.listdir(trash_dir):
+            if not fname.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(trash_dir, fname)) as handle:
+                    info = json.load(handle)
+            except (IOError, ValueError):
+                continue
+            entries.append(TrashEntry(trash_dir, fname[:-len(".json")], info))
+    entries.sort(key=lambda e: e.time)
+    return entries
+
+
+def orphaned_dirs(trash_dirs):
+    """Return directories in the trash without an info file, left over by an
+    interrupted purge."""
+    found = []
+    for trash_dir in set(trash_dirs):
+        if not os.path.isdir(trash_dir):
+            continue
+        names = set(os.listdir(trash_dir))
+        for fname in names:
+            if not fname.endswith(".json") and fname + ".json" not in names:
+                found.append(os.path.join(trash_dir, fname))
+    return found
+
+
+def purge(entries, jobs=4):
+    """Delete trashed mods, several at a time.
+
+    :entries: (list) TrashEntry objects or paths of orphaned directories.
+    :jobs: (int) Number of deletions running at once.
+    """
+    def delete(entry):
+        if isinstance(entry, TrashEntry):
+            entry.delete()
+        else:
+            _rmtree(entry)
+
+    if len(entries) < 2 or jobs < 2:
+        for entry in entries:
+            delete(entry)
+        return
+
+    # Deleting is mostly waiting on the filesystem, threads are enough.
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(entries)))
+    try:
+        pool.map(delete, entries)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _rmtree(path):
+    # Read only files (eg: from archives) would stop rmtree on windows.
+    def onerror(func, failed, exc_info):
+        os.chmod(failed, 0o700)
+        func(failed)
+    shutil.rmtree(path, onerror=onerror)
+
+
+def expired(entries, days):
+    """Return the entries older than the restore window.
+
+    :entries: (list) TrashEntry objects.
+    :days: (float) Restore window in days.
+    """
+    limit = time.time() - days * DAY
+    return [e for e in entries if e.time < limit]
+
+
+def start_reaper(cfg_path):
+    """Purge expired trash entries in a background process.
+    The process is detached, the calling command doesn't wait for it.
+
+    :cfg_path: (str) Path to openmw.cfg, passed along to the purge command.
+    """
+    script = os.path.join(core.get_base_dir(), "omw-mm-cli.py")
+    if not os.path.isfile(script):
+        return
+    with open(os.devnull, "w") as devnull:
+        subprocess.Popen([sys.executable, script, "--no-daemon", "-f", cfg_path, "purge", "--expired"],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=(os.name != "nt"), cwd=core.get_base_dir())
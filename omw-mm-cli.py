@@ -1,11 +1,11 @@
 #!/usr/bin/env python2.7
 # -*- coding: UTF-8 -*-
 import os
+import sys
 from argparse import ArgumentParser
 
-from lib.omw import ConfigFile, OmwMod
-from lib.esm import Esm
-from lib.config import config
+# Keep this list short, commands import what they need so that startup stays
+# cheap for scripts calling the CLI repeatedly.
 from lib import core
 
 
@@ -17,7 +17,7 @@ def list_mods(omw_cfg, mods_dir=None, path=False):
     :path:    (bool) if True print full path instead of basename. Default: False
     """
 
-    omw_cfg = ConfigFile(core.get_full_path(omw_cfg))
+    omw_cfg = core.open_config(omw_cfg)
     mods = omw_cfg.mods
 
     if mods_dir:
@@ -37,7 +37,7 @@ def clean_mods(omw_cfg):
 
     :omw_cfg: (str) Path to openmw.cfg.
     """
-    omw_cfg = ConfigFile(core.get_full_path(omw_cfg))
+    omw_cfg = core.open_config(omw_cfg)
 
     # Remove invalid data entries
     bad_mods = []
@@ -70,7 +70,8 @@ def uninstall_mod(omw_cfg, mod_name, clean=False, rm=False):
     :omw_cfg: (str) Path to openmw.cfg.
     :mod_name: (str) Name or path of the directory containing the mod.
     :clean: (bool) If true then disable plugins that belong to the mod before uninstalling.
-    :rm: (bool) If true then delete the mod directory. Default: False
+    :rm: (bool) If true then move the mod directory to the trash, it is deleted
+        in the background once the restore window (trash_days) is over. Default: False
     """
 
     # Path given
@@ -78,13 +79,14 @@ def uninstall_mod(omw_cfg, mod_name, clean=False, rm=False):
         mod_path = core.get_full_path(mod_name)
     # Only a name was given
     else:
-        mod_path = os.path.join(config.get("General", "mods_dir"), mod_name)
+        from lib.config import get_config
+        mod_path = os.path.join(get_config().get("General", "mods_dir"), mod_name)
 
     if not os.path.exists(mod_path):
         print("No such file or directory %s. Try the clean command if the mod is already deleted" % mod_name)
         raise SystemExit(1)
 
-    omw_cfg = ConfigFile(core.get_full_path(omw_cfg))
+    omw_cfg = core.open_config(omw_cfg)
 
     for mod in omw_cfg.mods:
         if mod.path == mod_path:
@@ -94,6 +96,9 @@ def uninstall_mod(omw_cfg, mod_name, clean=False, rm=False):
         print("Could not find any reference to %s, are you sure its installed?" % mod_name)
         raise SystemExit(1)
 
+    enabled = [p.name for p in mod.plugins_enabled]
+    positions = [omw_cfg.plugins.index(p) for p in mod.plugins_enabled]
+    data_position = omw_cfg.mods.index(mod)
     if clean:
         for plugin in mod.plugins_enabled:
             plugin.disable()
@@ -103,21 +108,123 @@ def uninstall_mod(omw_cfg, mod_name, clean=False, rm=False):
     omw_cfg.write()
 
     if rm:
-        print("Deleting mod in %s" % mod.path)
-        core.rm_mod_dir(mod.path)
+        from lib import trash
+        # A rename into the trash, the files are deleted by a background reaper.
+        trash.move_to_trash(mod.path, enabled, positions, data_position)
+        print("Moved %s to the trash, use the restore command to undo it" % mod.path)
+        trash.start_reaper(omw_cfg.path)
+
+
+def _trash_dirs(cfg):
+    """Return the trash directories that may hold uninstalled mods.
+
+    :cfg: (ConfigFile) openmw.cfg object.
+    """
+    from lib import trash
+    from lib.config import get_config
+    dirs = set(trash.known_trash_dirs())
+    dirs.add(trash.get_trash_dir(os.path.join(get_config().get("General", "mods_dir"), "x")))
+    for mod in cfg.mods:
+        dirs.add(trash.get_trash_dir(mod.path))
+    return dirs
+
+
+def purge_trash(omw_cfg, expired_only=False):
+    """Permanently delete uninstalled mods from the trash.
+
+    :omw_cfg: (str) Path to openmw.cfg.
+    :expired_only: (bool) Only delete mods older than the restore window (trash_days).
+    """
+    from lib import trash
+
+    dirs = _trash_dirs(core.open_config(omw_cfg))
+    entries = trash.list_trash(dirs)
+    if expired_only:
+        entries = trash.expired(entries, core.get_trash_days())
+    leftovers = trash.orphaned_dirs(dirs)
+
+    if not entries and not leftovers:
+        print("Nothing to purge.")
+        return
+    for entry in entries:
+        print("Deleting %s" % entry.name)
+    trash.purge(entries + leftovers)
+
+
+def restore_mod(omw_cfg, mod_name=None):
+    """Restore an uninstalled mod from the trash and enable it again.
+
+    :omw_cfg: (str) Path to openmw.cfg.
+    :mod_name: (str) Name of the mod, the latest trashed version is restored.
+        If None the trash is listed instead.
+    """
+    import time
+    from lib import trash
+    from lib.omw import OmwMod
+
+    cfg = core.open_config(omw_cfg)
+    entries = trash.list_trash(_trash_dirs(cfg))
+    if not mod_name:
+        if not entries:
+            print("The trash is empty.")
+        for entry in entries:
+            print("%s (%s) %s" % (entry.name, time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.time)),
+                                  entry.path))
+        return
+
+    matches = [e for e in entries if e.name == mod_name or e.path == core.get_full_path(mod_name)]
+    if not matches:
+        print("%s is not in the trash." % mod_name)
+        raise SystemExit(1)
+
+    entry = matches[-1]
+    try:
+        entry.restore()
+    except ValueError as e:
+        print(e)
+        raise SystemExit(1)
+
+    print("Restored %s" % entry.path)
+    mod = OmwMod(entry.path, cfg)
+    if mod.path not in [m.path for m in cfg.mods]:
+        # Back where it was among the data= entries, so it overrides the same files.
+        data_position = entry.data_position
+        if data_position is not None:
+            data_position = min(data_position, len(cfg.mods))
+        mod.enable(data_position)
+    # Uninstalling without --clean leaves the content= entries, as orphans
+    # until the mod is back. Restored plugins take their place, the others
+    # go back where they were in the load order.
+    positions = entry.positions
+    plugins = [p for p in mod.plugins if p.name in entry.plugins]
+    plugins.sort(key=lambda p: positions.get(p.name, len(cfg.plugins)))
+    for plugin in plugins:
+        existing = [p for p in cfg.plugins if p.name == plugin.name]
+        if any(not p.is_orphan for p in existing):
+            continue  # Enabled from another mod.
+        if existing:
+            order = cfg.plugins.index(existing[0])
+            for orphan in existing:
+                orphan.disable()
+        else:
+            order = min(positions.get(plugin.name, len(cfg.plugins)), len(cfg.plugins))
+        plugin.enable(order)
+    cfg.write()
 
 
 # TODO: Better handling of already installed mods
 # TODO: install mod as name command
-def install_mod(omw_cfg, src, dest, force=False):
+def install_mod(omw_cfg, src, dest, force=False, lowercase=False):
     """Install a mod in openmw.cfg."
 
     :omw_cfg: (str) Path to openmw.cfg.
     :src: (str) Path to mod.
     :dest: (str) Path to destination mod directory.
     :force: (bool) Force installation. Default: False.
+    :lowercase: (bool) Lowercase every file and directory name. Default: False.
     """
-    omw_cfg = ConfigFile(core.get_full_path(omw_cfg))
+    from lib.omw import OmwMod
+    omw_cfg = core.open_config(omw_cfg)
     src = core.get_full_path(src)
     dest = core.get_full_path(dest)
     mod_source = core.get_modsource(src)
@@ -128,9 +235,26 @@ def install_mod(omw_cfg, src, dest, force=False):
               if you wish to install it anyway use the --force flag" % name)
         raise SystemExit(1)
 
+    collisions = mod_source.collisions
+    if collisions:
+        print("These names only differ by case, the game only sees one of each:")
+        for found in sorted(collisions.values()):
+            print("\t%s" % ", ".join(found))
+        if lowercase:
+            print("Installing with lowercase names, files above overwrite each other.")
+        else:
+            print("Use --lowercase to merge them into lowercase names.")
+
     # Copy the mod
-    new_dir = mod_source.install(dest)
+    progress = None
+    if sys.stderr.isatty():
+        from lib.timings import Throughput
+        progress = Throughput("Installing %s" % name, sys.stderr)
+    new_dir = mod_source.install(dest, progress, lowercase)
+    if progress is not None:
+        progress.close()
     print("Copying %s to %s" % (name, new_dir))
+    mod_source.manifest.save()
 
     # Enable
     mod = OmwMod(new_dir, omw_cfg)
@@ -139,6 +263,104 @@ def install_mod(omw_cfg, src, dest, force=False):
     omw_cfg.write()
 
 
+def update_mod(omw_cfg, mod_name, src):
+    """Update an installed mod to a new version, only writing the files that changed.
+    The mod keeps its data= entry and its plugins keep their place in the load order.
+
+    :omw_cfg: (str) Path to openmw.cfg.
+    :mod_name: (str) Name or path of the installed mod directory.
+    :src: (str) Path to the new version (archive or directory).
+    """
+    from lib.omw import OmwMod
+    from lib.timings import format_bytes
+
+    omw_cfg = core.open_config(omw_cfg)
+    if os.path.sep in mod_name:
+        matches = [m for m in omw_cfg.mods if m.path == core.get_full_path(mod_name)]
+    else:
+        matches = [m for m in omw_cfg.mods if m.name == mod_name]
+    if not matches:
+        print("Could not find any reference to %s, are you sure its installed?" % mod_name)
+        raise SystemExit(1)
+    mod = matches[0]
+    if not os.path.isdir(mod.path):
+        print("%s doesn't exist, install it instead." % mod.path)
+        raise SystemExit(1)
+
+    src = core.get_full_path(src)
+    if not os.path.exists(src):
+        print("No such file or directory %s" % src)
+        raise SystemExit(1)
+    mod_source = core.get_modsource(src)
+    before = set(p.name for p in mod.plugins)
+    try:
+        stats = mod_source.update(mod.path)
+    except ValueError as e:
+        print(e)
+        raise SystemExit(1)
+
+    for problem in ("added", "changed", "removed"):
+        for rel in stats[problem]:
+            print("%s %s" % (problem, rel))
+
+    # Plugins the new version dropped would be left as orphaned content= entries.
+    after = set(p.name for p in OmwMod(mod.path, omw_cfg).plugins)
+    for plugin in mod.plugins_enabled:
+        if plugin.name not in after:
+            print("Disabling removed plugin %s" % plugin.name)
+            plugin.disable()
+    for name in sorted(after - before):
+        print("New plugin %s, it is not enabled" % name)
+    omw_cfg.write()
+
+    print("Updated %s: wrote %s of %s (%s saved)" % (
+        mod.name, format_bytes(stats["written"]), format_bytes(stats["total"]),
+        format_bytes(stats["total"] - stats["written"])))
+
+
+def verify_mods(omw_cfg, mod_names=None, jobs=4):
+    """Check installed mods against the manifests written when they were installed.
+
+    :omw_cfg: (str) Path to openmw.cfg.
+    :mod_names: (list) Names or paths of the mods to check. Default: every installed mod.
+    :jobs: (int) Number of files checked at once.
+    """
+    from lib.manifest import Manifest
+
+    omw_cfg = core.open_config(omw_cfg)
+    mods = omw_cfg.mods
+    if mod_names:
+        wanted = set(mod_names) | set(core.get_full_path(n) for n in mod_names if os.path.sep in n)
+        mods = [m for m in mods if m.name in wanted or m.path in wanted]
+        if not mods:
+            print("None of %s is installed." % ", ".join(mod_names))
+            raise SystemExit(1)
+
+    failed = False
+    for mod in mods:
+        manifest = Manifest.load(mod.path)
+        if manifest is None:
+            if mod_names:
+                print("%s: no manifest, it wasn't installed by omw-mm" % mod.name)
+            continue
+        if not os.path.isdir(mod.path):
+            print("%s: missing" % mod.name)
+            failed = True
+            continue
+        report = manifest.verify(jobs)
+        if not any(report.values()):
+            print("%s: OK" % mod.name)
+            continue
+        failed = True
+        print("%s:" % mod.name)
+        for problem in ("missing", "modified", "added"):
+            for rel in report[problem]:
+                print("\t%s %s" % (problem, rel))
+
+    if failed:
+        raise SystemExit(1)
+
+
 def list_plugins(omw_cfg, tree=False):
     """List detected openmw plugins.
 
@@ -146,7 +368,7 @@ def list_plugins(omw_cfg, tree=False):
     :tree: (bool) If True show parent mods in a tree.
     """
 
-    omw_cfg = ConfigFile(core.get_full_path(omw_cfg))
+    omw_cfg = core.open_config(omw_cfg)
 
     if tree:  # Tree View
         for mod in omw_cfg.mods:
@@ -179,7 +401,7 @@ def enable_plugin(omw_cfg, plugin_name):
     :plugin_name: (str) Plugin name
     """
 
-    omw_cfg = ConfigFile(core.get_full_path(omw_cfg))
+    omw_cfg = core.open_config(omw_cfg)
     plugin = core.find_plugin(omw_cfg, plugin_name)
     if not plugin:
         print("Could not find plugin %s." % plugin_name)
@@ -202,7 +424,7 @@ def disable_plugin(omw_cfg, plugin_name):
     :plugin_name: (str) Name of the plugin to be disabled.
     """
 
-    omw_cfg = ConfigFile(core.get_full_path(omw_cfg))
+    omw_cfg = core.open_config(omw_cfg)
     plugin = core.find_plugin(omw_cfg, plugin_name)
 
     if not plugin:
@@ -218,46 +440,513 @@ def disable_plugin(omw_cfg, plugin_name):
     omw_cfg.write()
 
 
-def merge_lists(omw_cfg, out=None):
+def merge_lists(omw_cfg, out=None, report_path=None, three_way=False):
     """Merge leveled lists for every enabled plugin.
 
     :omw_cfg: (str) Path to openmw.cfg
     :out: (str) Path to output file. Default: ./merged.esp
+    :report_path: (str) Write a JSON report of every merged list here, "-" for stdout.
+    :three_way: (bool) Diff every list against its masters so removals are kept.
     """
 
-    cfg = ConfigFile(omw_cfg)
-    mods = cfg.mods
-    if not mods:
+    from lib.esm import Esm
+    from lib.config import get_config
+    from lib.merge import MergeReport, ThreeWayMerger
+    from lib.cache import FileCache
+
+    cfg = core.open_config(omw_cfg)
+    load_order = core.get_load_order(cfg)
+    if not load_order:
         print("Nothing to merge!")
         raise SystemExit(1)
 
-    blacklist = config.get("General", "never_merge").split(",")
+    blacklist = get_config().get("General", "never_merge").split(",")
     merged = Esm(os.path.join(core.get_base_dir(), "./Merged.esp"))
     merged.unpack()
-
-    for mod in mods:
-        plugins = mod.plugins
-        if plugins:
-            for plugin in plugins:
-                if plugin.name not in blacklist and plugin.is_enabled:
-                    print("Merging: %s" % plugin.name)
-                    to_merge = Esm(plugin.path)
-                    to_merge.unpack()
-                    diff = merged.merge_with(to_merge)
-
-                    # Pretty Print stuff
-                    for rec in ("LEVC", "LEVI"):
-                        if diff[rec]["Merged"]:
-                            print("\t%s records merged:" % rec)
-                            for record in diff[rec]["Merged"]:
-                                print("\t\t%s" % record)
+    report = MergeReport() if report_path else None
+    # Keep stdout clean for the JSON report.
+    log = sys.stderr if report_path == "-" else sys.stdout
+
+    if three_way:
+        paths = core.get_installed_plugins(cfg)
+        merger = ThreeWayMerger(lambda name: paths.get(name.lower()),
+                                FileCache("leveled_lists"), report)
+        for path in load_order:
+            name = os.path.basename(path)
+            if name not in blacklist:
+                log.write("Merging: %s\n" % name)
+                to_merge = Esm(path)
+                to_merge.unpack()
+                merger.add(to_merge)
+
+        records = merger.result()
+        for record in records:
+            log.write("\t%s %s\n" % (record.id, record._name))
+        merged.records.extend(records)
+        for path in merger.contributors(records):
+            merged.header.add_master(path)
+        merged.header.record_count = len(merged.records)
+        return _write_merged(merged, out, report, report_path)
+
+    # Merge in load order so the report knows which plugin is loaded last.
+    for path in load_order:
+        name = os.path.basename(path)
+        if name not in blacklist:
+            log.write("Merging: %s\n" % name)
+            to_merge = Esm(path)
+            to_merge.unpack()
+            diff = merged.merge_with(to_merge, report)
+
+            # Pretty Print stuff
+            for rec in ("LEVC", "LEVI"):
+                if diff[rec]["Merged"]:
+                    log.write("\t%s records merged:\n" % rec)
+                    for record in diff[rec]["Merged"]:
+                        log.write("\t\t%s\n" % record)
 
     merged.post_merge()
+    _write_merged(merged, out, report, report_path)
 
+
+def _write_merged(merged, out, report, report_path):
+    """Write the merged plugin and the optional report."""
     if not out:
         out = "./Merged_Lists.esp"
     merged.write(out)
 
+    if report is not None:
+        report.finish(merged)
+        if report_path == "-":
+            report.write(sys.stdout)
+        else:
+            with open(report_path, "w") as handle:
+                report.write(handle)
+
+
+def patch_records(omw_cfg, out=None, types=None):
+    """Merge every record edited by more than one enabled plugin into a patch plugin.
+    Inventories, spell lists, faction reactions and leveled lists are merged
+    entry by entry, see lib/patch.py for the merge strategies.
+
+    :omw_cfg: (str) Path to openmw.cfg
+    :out: (str) Path to output file. Default: ./Merged_Patch.esp
+    :types: (list) Only merge these record types. Default: every supported type.
+    """
+
+    from lib.esm import Esm
+    from lib.patch import RecordPatcher, STRATEGIES
+
+    if not out:
+        out = "./Merged_Patch.esp"
+    strategies = None
+    if types:
+        unknown = [t for t in types if t not in STRATEGIES]
+        if unknown:
+            print("Can't merge record types: %s (supported: %s)"
+                  % (", ".join(unknown), ", ".join(sorted(STRATEGIES))))
+            raise SystemExit(1)
+        strategies = dict((t, STRATEGIES[t]) for t in types)
+
+    cfg = core.open_config(omw_cfg)
+    patcher = RecordPatcher(strategies)
+    # Previous patches and merged lists would feed merged records back into the merge.
+    skip = set([os.path.basename(out).lower(), "merged_patch.esp", "merged_lists.esp"])
+    for path in core.get_load_order(cfg):
+        name = os.path.basename(path)
+        if name.lower() not in skip:
+            print("Reading: %s" % name)
+            patcher.add(path)
+
+    merged = patcher.result()
+    if not merged:
+        print("Nothing to merge!")
+        return
+
+    patch = Esm(os.path.join(core.get_base_dir(), "./Merged.esp"))
+    patch.unpack()
+    for record, paths in merged:
+        print("\t%s %s (%s)" % (record.id, record.view().get("NAME", ""),
+                                ", ".join(os.path.basename(p) for p in paths)))
+        patch.records.append(record)
+    for path in patcher.contributors(merged):
+        patch.header.add_master(path)
+    patch.header.record_count = len(patch.records)
+    patch.write(out)
+
+
+def record_conflicts(omw_cfg, types=None, show_all=False, jobs=None):
+    """List records defined by more than one enabled plugin and which plugin wins.
+
+    :omw_cfg: (str) Path to openmw.cfg
+    :types: (list) Only list records of these types, eg: ["NPC_"]. Default: every type.
+    :show_all: (bool) Also list records every plugin has an identical copy of.
+    :jobs: (int) Plugins indexed in parallel. Default: number of cpus.
+    """
+
+    from lib.cache import FileCache
+    from lib.records import load_indexes, find_conflicts
+
+    if jobs is None:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+
+    cfg = core.open_config(omw_cfg)
+    paths = core.get_load_order(cfg)
+    indexes = load_indexes(paths, FileCache("records"), jobs)
+
+    count = 0
+    for (id, name), versions in find_conflicts(paths, indexes, set(types) if types else None):
+        if not show_all and len(set(digest for _, digest in versions)) == 1:
+            continue
+        count += 1
+        names = [os.path.basename(path) for path, _ in versions]
+        print("%s %s: %s -> %s" % (id, name, ", ".join(names[:-1]), names[-1]))
+    print("%d conflicting records" % count)
+
+
+def list_assets(omw_cfg, pattern=None, overrides=False, archive=None):
+    """List data files (loose and inside enabled BSA archives) and where they come from.
+
+    :omw_cfg: (str) Path to openmw.cfg
+    :pattern: (str) Only list files matching this wildcard pattern, eg: textures/tx_*
+    :overrides: (bool) Only list files provided by more than one source.
+    :archive: (str) List the contents of this BSA instead.
+    """
+    from fnmatch import fnmatchcase
+    from lib.cache import FileCache
+    from lib.bsa import BsaArchive
+
+    pattern = pattern.lower().replace("\\", "/") if pattern else None
+    if archive:
+        try:
+            names = BsaArchive(core.get_full_path(archive), FileCache("bsa")).names
+        except (IOError, OSError, ValueError) as e:
+            print(e)
+            raise SystemExit(1)
+        for name in names:
+            if pattern is None or fnmatchcase(name, pattern):
+                print(name)
+        return
+
+    from lib.assets import collect_assets, find_archives
+    from lib.omw import ConfigChain
+    cfg = core.open_config(omw_cfg)
+    for name, path in find_archives(ConfigChain(cfg)):
+        if path is None:
+            print("Missing archive %s" % name)
+    collisions = []
+    assets = collect_assets(cfg, FileCache("bsa"), collisions)
+    for mod_path, found in collisions:
+        print("%s: names only differ by case, only one is used: %s" % (
+            os.path.basename(mod_path), ", ".join(found)))
+    for rel, providers in assets.iteritems():
+        if overrides and len(providers) < 2:
+            continue
+        if pattern is not None and not fnmatchcase(rel, pattern):
+            continue
+        names = [os.path.basename(p.source) for p in providers]
+        if overrides:
+            print("%s: %s -> %s" % (rel, ", ".join(names[:-1]), names[-1]))
+        else:
+            print("%s: %s" % (rel, names[-1]))
+
+
+def find_dupes(omw_cfg, min_size=1, jobs=4, show_files=False):
+    """Find byte identical files across the data directories of installed mods.
+
+    :omw_cfg: (str) Path to openmw.cfg
+    :min_size: (int) Ignore files smaller than this many bytes.
+    :jobs: (int) Number of files read at once.
+    :show_files: (bool) List every group of identical files.
+    """
+    from lib.cache import HashCache
+    from lib.dupes import find_duplicates
+    from lib.paths import normalize
+    from lib.timings import format_bytes
+
+    cfg = core.open_config(omw_cfg)
+    order = {}  # file -> (mod load order, mod)
+    below = {}  # file -> file the game would use at the same data path without it
+    last = {}  # data path -> last file seen providing it
+    for i, mod in enumerate(cfg.mods):
+        for root, _, files in os.walk(mod.path):
+            for fname in files:
+                path = os.path.join(root, fname)
+                if path in order:
+                    continue
+                order[path] = (i, mod)
+                key = normalize(os.path.relpath(path, mod.path))
+                below[path] = last.get(key)
+                last[key] = path
+
+    cache = HashCache("hashes")
+    groups = find_duplicates(list(order), cache, jobs, min_size)
+    cache.save()
+
+    # A copy can only go if the game would then load an identical file at
+    # the same data path: the one it overrides is in the same group. Copies
+    # at other data paths, or overriding a different file, are listed but
+    # not counted.
+    wasted = {}
+    for size, paths in groups:
+        paths.sort(key=lambda p: order[p][0])
+        if show_files:
+            print("%s x%d" % (format_bytes(size), len(paths)))
+            for path in paths:
+                print("\t%s" % path)
+        identical = set(paths)
+        for path in paths[1:]:
+            if below[path] not in identical:
+                continue
+            mod = order[path][1]
+            total, count = wasted.get(mod.path, (0, 0))
+            wasted[mod.path] = (total + size, count + 1)
+
+    if not groups:
+        print("No duplicate files found.")
+        return
+    print("Space reclaimable by deleting copies of the file they override, per mod:")
+    for mod in cfg.mods:
+        if mod.path in wasted:
+            total, count = wasted[mod.path]
+            print("\t%s: %s in %d files" % (mod.name, format_bytes(total), count))
+    print("Total: %s in %d groups of identical files" % (
+        format_bytes(sum(total for total, _ in wasted.values())), len(groups)))
+
+
+def resolve_lists(omw_cfg, list_name=None, level=1):
+    """Show what leveled lists spawn once nested lists are expanded.
+
+    :omw_cfg: (str) Path to openmw.cfg
+    :list_name: (str) Name of a leveled list. Default: check every list for loops.
+    :level: (int) PC level the probabilities are shown for.
+    """
+    from lib.cache import FileCache
+    from lib.leveled import LeveledLists, MAX_LEVEL
+
+    if not 1 <= level <= MAX_LEVEL:
+        print("The level must be between 1 and %d" % MAX_LEVEL)
+        raise SystemExit(1)
+
+    cfg = core.open_config(omw_cfg)
+    paths = core.get_load_order(cfg)
+    lists = LeveledLists.from_plugins(paths, FileCache("leveled_lists"))
+
+    if not list_name:
+        count = lists.resolve_all()
+        for cycle in lists.cycles:
+            print("Leveled lists contain themselves: %s" % " -> ".join(name for _, name in cycle))
+        print("Resolved %d leveled lists" % count)
+        return
+
+    keys = [key for key in lists.keys if key[1] == list_name.lower()]
+    if not keys:
+        print("No leveled list named %s" % list_name)
+        raise SystemExit(1)
+    for key in keys:
+        result = lists.resolve(key)
+        chances = sorted(((float(p[level - 1]), item) for item, p in result.iteritems()), reverse=True)
+        print("%s %s at level %d%s:" % (key[0], key[1], level,
+                                        " (rolled per item)" if lists.calc_each_item(key) else ""))
+        for chance, item in chances:
+            if chance > 0:
+                print("\t%6.2f%% %s" % (chance * 100, item))
+        print("\t%6.2f%% nothing" % (max(0.0, 1 - sum(c for c, _ in chances)) * 100))
+    for cycle in lists.cycles:
+        print("Leveled lists contain themselves: %s" % " -> ".join(name for _, name in cycle))
+
+
+def find_record(omw_cfg, name, mode="exact", record_type=None, limit=50):
+    """Show which enabled plugins define a record.
+
+    :omw_cfg: (str) Path to openmw.cfg
+    :name: (str) Record name, eg: fargoth, or "x,y" for exterior cells.
+    :mode: (str) exact, prefix or substring.
+    :record_type: (str) Optional, only records of this type, eg: NPC_
+    :limit: (int) Maximum number of names shown.
+    """
+    from lib.cache import FileCache
+    from lib.recordindex import RecordIndex
+
+    if record_type is not None and len(record_type) != 4:
+        print("Record types are 4 characters long, eg: NPC_")
+        raise SystemExit(1)
+
+    cfg = core.open_config(omw_cfg)
+    paths = core.get_load_order(cfg)
+    index = RecordIndex.load(paths, FileCache("record_ids"))
+    found = index.find(name, mode, record_type and record_type.upper(), limit + 1)
+    if not found:
+        print("No record matching %s" % name)
+        raise SystemExit(1)
+    for record_name, entries in found[:limit]:
+        print(record_name)
+        for path, type, offset in entries:
+            print("\t%s %s (offset %d)" % (type, os.path.basename(path), offset))
+    if len(found) > limit:
+        print("More than %d records match, showing the first %d" % (limit, limit))
+
+
+def diff_plugin(omw_cfg, old, new, types=None, brief=False):
+    """Show the records added, removed and changed between two versions of a plugin.
+
+    :omw_cfg: (str) Path to openmw.cfg
+    :old: (str) Name of an installed plugin or path to the old version.
+    :new: (str) Name of an installed plugin or path to the new version.
+    :types: (list) Only show records of these types, eg: ["NPC_"]. Default: every type.
+    :brief: (bool) Don't show the subrecords of changed records.
+    """
+    from lib.plugindiff import diff_plugins, ADDED, REMOVED, CHANGED
+
+    def find(plugin_name):
+        if os.path.sep in plugin_name:
+            path = core.get_full_path(plugin_name)
+        else:
+            plugin = core.find_plugin(core.open_config(omw_cfg), plugin_name)
+            path = plugin.path if plugin else None
+        if not path or not os.path.isfile(path):
+            print("Could not find plugin %s." % plugin_name)
+            raise SystemExit(1)
+        return path
+
+    def show(value):
+        if value is None:
+            return "(none)"
+        text = repr(value)
+        return text if len(text) <= 60 else text[:57] + "..."
+
+    marks = {ADDED: "+", REMOVED: "-", CHANGED: "~"}
+    counts = dict.fromkeys(marks, 0)
+    types = set(types) if types else None
+    for status, (id, name), changes in diff_plugins(find(old), find(new)):
+        if status not in marks or (types is not None and id not in types):
+            continue
+        if id == "TES3":
+            print("~ file header")
+        else:
+            counts[status] += 1
+            print("%s %s %s" % (marks[status], id, name))
+        if brief or not changes:
+            continue
+        for field, old_value, new_value in changes:
+            print("\t%s: %s -> %s" % (field, show(old_value), show(new_value)))
+    print("%d added, %d removed, %d changed records" % (counts[ADDED], counts[REMOVED], counts[CHANGED]))
+
+
+def clean_plugin(omw_cfg, plugin_name, out=None, dry_run=False):
+    """Remove records that are identical to their master's copy, and deleted
+    records that don't delete anything, from a plugin.
+
+    :omw_cfg: (str) Path to openmw.cfg
+    :plugin_name: (str) Name of an installed plugin or path to a plugin.
+    :out: (str) Path to the cleaned copy. Default: ./clean_<plugin name>
+    :dry_run: (bool) Only list the records that would be removed.
+    """
+
+    from lib.esm import Esm
+    from lib.cache import FileCache
+    from lib.records import load_indexes, find_dirty_records
+
+    cfg = core.open_config(omw_cfg)
+    paths = core.get_installed_plugins(cfg)
+    if os.path.sep in plugin_name:
+        path = core.get_full_path(plugin_name)
+    else:
+        path = paths.get(plugin_name.lower())
+    if not path or not os.path.isfile(path):
+        print("Could not find plugin %s." % plugin_name)
+        raise SystemExit(1)
+
+    esm = Esm(path)
+    esm.unpack()
+    masters = []
+    for name, _ in esm.header.masters:
+        master = paths.get(name.lower())
+        if master is None:
+            print("Missing master %s, records it defines won't be cleaned." % name)
+        else:
+            masters.append(master)
+    # Master indexes are cached, cleaning many plugins only hashes each master once.
+    indexes = load_indexes(masters, FileCache("records"))
+    dirty = find_dirty_records(esm, [indexes[m] for m in reversed(masters)])
+
+    for _, (id, name), reason in dirty:
+        print("\t%s %s: %s" % (id, name, reason))
+    print("%d of %d records to clean" % (len(dirty), len(esm)))
+    if dry_run or not dirty:
+        return
+
+    if not out:
+        out = "./clean_%s" % os.path.basename(path)
+    esm.remove_records(index for index, _, _ in dirty)
+    esm.write(out)
+    print("Cleaned plugin written to %s" % out)
+
+
+def sort_plugins(omw_cfg, rules=None, dry_run=False):
+    """Sort the load order so masters load first and mlox rules are followed.
+
+    :omw_cfg: (str) Path to openmw.cfg
+    :rules: (list) Extra mlox rule files, added after sort_rules in omw-mm.cfg.
+    :dry_run: (bool) Only print the new load order.
+    """
+
+    from lib.cache import FileCache
+    from lib import loadorder
+
+    paths = core.get_sort_rules() + [core.get_full_path(r) for r in rules or ()]
+    for path in paths:
+        if not os.path.isfile(path):
+            print("Could not find rules file %s." % path)
+            raise SystemExit(1)
+
+    cfg = core.open_config(omw_cfg)
+    compiled = loadorder.load_rules(paths, FileCache("rules"))
+    plugins = [(p.name, loadorder.plugin_masters(p)) for p in cfg.plugins]
+    result = loadorder.sort_plugins(plugins, compiled)
+
+    for message in result.conflicts:
+        print("Warning: %s" % message)
+
+    old = [p.name for p in cfg.plugins]
+    if result.order == old:
+        print("Load order is already sorted.")
+        return
+
+    for position, name in enumerate(result.order, 1):
+        moved = " (was %d)" % (old.index(name) + 1) if old.index(name) + 1 != position else ""
+        print("%d %s%s" % (position, name, moved))
+    if dry_run:
+        return
+
+    by_name = dict((p.name, p) for p in cfg.plugins)
+    cfg.plugins[:] = [by_name[name] for name in result.order]
+    cfg.write()
+
+
+def run_daemon(action):
+    """Start or stop the background daemon.
+
+    :action: (str) "start" or "stop".
+    """
+    from lib import daemon
+    sock_path = core.get_daemon_socket()
+
+    if action == "stop":
+        result = daemon.send_command(sock_path, ["daemon-stop"])
+        if result is None:
+            print("No daemon is running on %s" % sock_path)
+            raise SystemExit(1)
+        sys.stdout.write(result[0])
+        return
+
+    print("Listening on %s" % sock_path)
+    try:
+        daemon.Daemon(sock_path, main_local).serve_forever()
+    except ValueError as e:
+        print(e)
+        raise SystemExit(1)
+
 
 def create_arg_parser(*args, **kwargs):
     """Create the argument parser.
@@ -267,22 +956,30 @@ def create_arg_parser(*args, **kwargs):
     parser = ArgumentParser(*args, **kwargs)
     subparser = parser.add_subparsers(title="Commands", dest="command", metavar="<command>")
 
-    # Defaults
-    mods_dir = config.get("General", "mods_dir")   # Destination directory to install mods
-    omw_cfg = config.get("General", "openmw_cfg")  # Openmw config object
-
     # General arguments
-    parser.add_argument("-f", "--file", dest="cfg", metavar="file", default=omw_cfg,
-            help="Path to openmw.cfg")
+    # Defaults that come from omw-mm.cfg are filled in by run_command, so
+    # building the parser doesn't have to read the config.
+    parser.add_argument("-f", "--file", dest="cfg", metavar="file", default=None,
+            help="Path to openmw.cfg. Default: openmw_cfg in omw-mm.cfg")
+    parser.add_argument("--no-daemon", action="store_true", dest="no_daemon", default=False,
+            help="Run the command in this process even if a daemon is running")
+    parser.add_argument("--timings", action="store_true", dest="timings", default=False,
+            help="Print how long each phase of the command took")
+    parser.add_argument("--timings-json", metavar="file", dest="timings_json", default=None,
+            help="Write every timed phase to file as JSON (implies --timings)")
+    parser.add_argument("--profile", metavar="file", dest="profile", default=None,
+            help="Write cProfile stats of the command to file (implies --timings)")
 
     # Install command.
     parser_i = subparser.add_parser("install", help="Install a mod")
     parser_i.add_argument("src", metavar="path",
             help="Path to the archive/directory to be installed")
-    parser_i.add_argument("dest", metavar="destination", nargs="?", default=mods_dir,
-            help="Destination mods directory")
+    parser_i.add_argument("dest", metavar="destination", nargs="?", default=None,
+            help="Destination mods directory. Default: mods_dir in omw-mm.cfg")
     parser_i.add_argument("-f", "--force", action="store_true", dest="force", default=False,
             help="Don't check if the archive/directory is an actual mod")
+    parser_i.add_argument("-l", "--lowercase", action="store_true", dest="lowercase", default=False,
+            help="Lowercase every file and directory name, merging names that only differ by case")
 
     # Uninstall command
     parser_u = subparser.add_parser("uninstall", help="Uninstall a mod directory")
@@ -290,10 +987,34 @@ def create_arg_parser(*args, **kwargs):
             help="Either the name of the mod or a path to the mod directory.\
                     \n(NOTE: If only a name is given then only the configured mods_dir is checked)")
     parser_u.add_argument("-d", "--delete", action="store_true", dest="rm",
-            help="Delete the directory (USE AT YOUR OWN RISK!)")
+            help="Move the directory to the trash, it is deleted after trash_days (see restore/purge)")
     parser_u.add_argument("-c", "--clean", action="store_true", dest="clean",
             help="Disable plugins for this mod before uninstalling")
 
+    # Purge command
+    parser_pu = subparser.add_parser("purge", help="Permanently delete uninstalled mods from the trash")
+    parser_pu.add_argument("--expired", action="store_true", dest="expired", default=False,
+            help="Only delete mods that have been in the trash longer than trash_days")
+
+    # Restore command
+    parser_r = subparser.add_parser("restore", help="Restore a mod uninstalled with --delete")
+    parser_r.add_argument("mod", metavar="mod_directory", nargs="?", default=None,
+            help="Name or original path of the mod. Default: list the trash")
+
+    # Update command
+    parser_up = subparser.add_parser("update", help="Update an installed mod, only writing files that changed")
+    parser_up.add_argument("mod", metavar="mod_directory",
+            help="Name or path of the installed mod directory")
+    parser_up.add_argument("src", metavar="path",
+            help="Path to the archive/directory of the new version")
+
+    # Verify command
+    parser_v = subparser.add_parser("verify", help="Check installed mods against their install manifests")
+    parser_v.add_argument("mods", metavar="mod", nargs="*", default=None,
+            help="Names or paths of the mods to check. Default: every installed mod")
+    parser_v.add_argument("-j", "--jobs", metavar="n", type=int, default=4, dest="jobs",
+            help="Number of files checked at once. Default: 4")
+
     # Enable command
     parser_ep = subparser.add_parser("enable", help="Enable a plugin")
     parser_ep.add_argument("plugin", help="Full name of the plugin eg: Morrowind.esm")
@@ -321,12 +1042,154 @@ def create_arg_parser(*args, **kwargs):
     subparser_m = subparser.add_parser("merge", help="Merge all leveled lists into one file")
     subparser_m.add_argument("-o", "--output", metavar="output", default=None, dest="out",
             help="Destination of the merged esp. Default: ./Merged_Lists.esp")
+    subparser_m.add_argument("-r", "--report", metavar="file", default=None, dest="report",
+            help="Write a JSON report of every merged list (contributing plugins, entries \
+                    removed by the last plugin, final flags) to file, - for stdout")
+    subparser_m.add_argument("-3", "--three-way", action="store_true", default=False, dest="three_way",
+            help="Diff each plugin's lists against its masters so entries a plugin \
+                    removed stay removed, instead of merging everything as a union")
+
+    # Patch command
+    subparser_p = subparser.add_parser("patch",
+            help="Merge inventories, spell lists, faction reactions and leveled lists into one patch")
+    subparser_p.add_argument("-o", "--output", metavar="output", default=None, dest="out",
+            help="Destination of the patch. Default: ./Merged_Patch.esp")
+    subparser_p.add_argument("-t", "--type", metavar="type", action="append", default=None,
+            dest="types", help="Only merge records of this type, eg: NPC_ (can be repeated)")
+
+    # Record conflicts command
+    subparser_rc = subparser.add_parser("record-conflicts",
+            help="List records overridden by more than one plugin")
+    subparser_rc.add_argument("-t", "--type", metavar="type", action="append", default=None,
+            dest="types", help="Only list records of this type, eg: NPC_ (can be repeated)")
+    subparser_rc.add_argument("-a", "--all", action="store_true", default=False, dest="show_all",
+            help="Also list records where every plugin has an identical copy")
+    subparser_rc.add_argument("-j", "--jobs", metavar="n", type=int, default=None, dest="jobs",
+            help="Number of plugins indexed in parallel. Default: number of cpus")
+
+    # Clean plugin command
+    subparser_cp = subparser.add_parser("clean-plugin",
+            help="Remove records identical to the master's copy from a plugin")
+    subparser_cp.add_argument("plugin", help="Name of the plugin eg: Mod.esp, or a path to it")
+    subparser_cp.add_argument("-o", "--output", metavar="output", default=None, dest="out",
+            help="Destination of the cleaned copy. Default: ./clean_<plugin>")
+    subparser_cp.add_argument("-n", "--dry-run", action="store_true", default=False, dest="dry_run",
+            help="Only list the records that would be removed")
+
+    # Sort command
+    subparser_s = subparser.add_parser("sort",
+            help="Sort the load order using plugin masters and mlox rules")
+    subparser_s.add_argument("-r", "--rules", metavar="file", action="append", default=None,
+            dest="rules", help="mlox rules file, used after sort_rules in omw-mm.cfg (can be repeated)")
+    subparser_s.add_argument("-n", "--dry-run", action="store_true", default=False, dest="dry_run",
+            help="Only print the sorted load order")
+
+    # List assets command
+    subparser_la = subparser.add_parser("list-assets",
+            help="List data files, loose and in BSA archives, and which mod provides them")
+    subparser_la.add_argument("pattern", nargs="?", default=None,
+            help="Only list files matching this pattern, eg: 'textures/tx_*'")
+    subparser_la.add_argument("-o", "--overrides", action="store_true", default=False, dest="overrides",
+            help="Only list files provided by more than one mod or archive")
+    subparser_la.add_argument("-b", "--bsa", metavar="archive", default=None, dest="archive",
+            help="List the contents of a BSA archive instead")
+
+    # Dupes command
+    subparser_du = subparser.add_parser("dupes",
+            help="Find identical files across installed mods and the space they waste")
+    subparser_du.add_argument("-m", "--min-size", metavar="bytes", type=int, default=1, dest="min_size",
+            help="Ignore files smaller than this. Default: 1")
+    subparser_du.add_argument("-j", "--jobs", metavar="n", type=int, default=4, dest="jobs",
+            help="Number of files read at once. Default: 4")
+    subparser_du.add_argument("-l", "--list", action="store_true", default=False, dest="show_files",
+            help="List every group of identical files")
+
+    # Resolve lists command
+    subparser_rl = subparser.add_parser("resolve-lists",
+            help="Show what a leveled list spawns once nested lists are expanded")
+    subparser_rl.add_argument("list", nargs="?", default=None,
+            help="Name of the leveled list. Default: resolve every list and report loops")
+    subparser_rl.add_argument("-l", "--level", metavar="level", type=int, default=1, dest="level",
+            help="PC level to show the chances for. Default: 1")
+
+    # Find record command
+    subparser_fr = subparser.add_parser("find-record",
+            help="Show which plugins define or edit a record")
+    subparser_fr.add_argument("name",
+            help="Record name, case insensitive, eg: fargoth. Exterior cells by grid, eg: -2,-9")
+    subparser_fr_mode = subparser_fr.add_mutually_exclusive_group()
+    subparser_fr_mode.add_argument("-p", "--prefix", action="store_const", const="prefix",
+            default="exact", dest="mode", help="Find records whose name starts with name")
+    subparser_fr_mode.add_argument("-s", "--substring", action="store_const", const="substring",
+            dest="mode", help="Find records whose name contains name")
+    subparser_fr.add_argument("-t", "--type", metavar="type", default=None, dest="record_type",
+            help="Only records of this type, eg: NPC_")
+    subparser_fr.add_argument("-n", "--limit", metavar="n", type=int, default=50, dest="limit",
+            help="Maximum number of records shown. Default: 50")
+
+    # Diff plugin command
+    subparser_dp = subparser.add_parser("diff-plugin",
+            help="Show the records added, removed and changed between two versions of a plugin")
+    subparser_dp.add_argument("old", help="Old version, name of a plugin eg: Mod.esp, or a path to it")
+    subparser_dp.add_argument("new", help="New version, name of a plugin eg: Mod.esp, or a path to it")
+    subparser_dp.add_argument("-t", "--type", metavar="type", action="append", default=None,
+            dest="types", help="Only show records of this type, eg: NPC_ (can be repeated)")
+    subparser_dp.add_argument("-b", "--brief", action="store_true", default=False, dest="brief",
+            help="Only list changed records, not what changed in them")
+
+    # Daemon command
+    subparser_d = subparser.add_parser("daemon",
+            help="Keep openmw.cfg and mod indexes in memory and serve commands from a background process")
+    subparser_d.add_argument("action", choices=("start", "stop"), nargs="?", default="start",
+            help="Start (in the foreground) or stop the daemon. Default: start")
 
     return parser
 
-if __name__ == "__main__":
-    args = create_arg_parser(prog="omw-mm-cli").parse_args()
 
+def run_command(args):
+    """Fill in defaults from omw-mm.cfg and run the command, timing it if asked to.
+
+    :args: (Namespace) Parsed arguments.
+    """
+    if args.command == "daemon":
+        run_daemon(args.action)
+        return
+
+    from lib.config import get_config
+    if args.cfg is None:
+        args.cfg = get_config().get("General", "openmw_cfg")
+    if getattr(args, "dest", False) is None:
+        args.dest = get_config().get("General", "mods_dir")
+
+    if not (args.timings or args.timings_json or args.profile):
+        dispatch_command(args)
+        return
+
+    from lib import timings
+    timings.enable()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        dispatch_command(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        timings.disable()
+        sys.stderr.write("\n%s\n" % timings.format_summary())
+        if args.timings_json:
+            timings.dump_json(args.timings_json)
+
+
+def dispatch_command(args):
+    """Call the function implementing args.command.
+
+    :args: (Namespace) Parsed arguments.
+    """
     if args.command == "list":
         list_mods(args.cfg, args.dir, args.path)
 
@@ -334,11 +1197,23 @@ if __name__ == "__main__":
         clean_mods(args.cfg)
 
     if args.command == "install":
-        install_mod(args.cfg, args.src, args.dest, args.force)
+        install_mod(args.cfg, args.src, args.dest, args.force, args.lowercase)
 
     if args.command == "uninstall":
         uninstall_mod(args.cfg, args.mod, args.clean, args.rm)
 
+    if args.command == "purge":
+        purge_trash(args.cfg, args.expired)
+
+    if args.command == "restore":
+        restore_mod(args.cfg, args.mod)
+
+    if args.command == "update":
+        update_mod(args.cfg, args.mod, args.src)
+
+    if args.command == "verify":
+        verify_mods(args.cfg, args.mods, args.jobs)
+
     if args.command == "list-plugins":
         list_plugins(args.cfg, args.tree)
 
@@ -349,4 +1224,82 @@ if __name__ == "__main__":
         disable_plugin(args.cfg, args.plugin)
 
     if args.command == "merge":
-        merge_lists(args.cfg, args.out)
+        merge_lists(args.cfg, args.out, args.report, args.three_way)
+
+    if args.command == "patch":
+        patch_records(args.cfg, args.out, args.types)
+
+    if args.command == "record-conflicts":
+        record_conflicts(args.cfg, args.types, args.show_all, args.jobs)
+
+    if args.command == "list-assets":
+        list_assets(args.cfg, args.pattern, args.overrides, args.archive)
+
+    if args.command == "dupes":
+        find_dupes(args.cfg, args.min_size, args.jobs, args.show_files)
+
+    if args.command == "resolve-lists":
+        resolve_lists(args.cfg, args.list, args.level)
+
+    if args.command == "find-record":
+        find_record(args.cfg, args.name, args.mode, args.record_type, args.limit)
+
+    if args.command == "diff-plugin":
+        diff_plugin(args.cfg, args.old, args.new, args.types, args.brief)
+
+    if args.command == "clean-plugin":
+        clean_plugin(args.cfg, args.plugin, args.out, args.dry_run)
+
+    if args.command == "sort":
+        sort_plugins(args.cfg, args.rules, args.dry_run)
+
+
+def main_local(argv):
+    """Parse :argv: and run the command in this process.
+
+    :argv: (list) Command line arguments without the program name.
+    """
+    run_command(create_arg_parser(prog="omw-mm-cli").parse_args(argv))
+
+
+# Options before the command taking a value, see create_arg_parser().
+GLOBAL_VALUE_OPTIONS = ("-f", "--file", "--timings-json", "--profile")
+
+
+def split_command(argv):
+    """Find the command in the command line without parsing the whole of it.
+
+    :argv: (list) Command line arguments without the program name.
+    :returns: (tuple) (options before the command, command), command is None without one.
+    """
+    options = []
+    args = iter(argv)
+    for arg in args:
+        if not arg.startswith("-"):
+            return options, arg
+        options.append(arg)
+        if arg in GLOBAL_VALUE_OPTIONS:
+            options.append(next(args, None))
+    return options, None
+
+
+def main(argv):
+    """Entry point, forwards the command to the daemon if one is running.
+
+    :argv: (list) Command line arguments without the program name.
+    """
+    options, command = split_command(argv)
+    forward = command not in (None, "daemon") and "--no-daemon" not in options
+    if forward:
+        from lib import daemon
+        result = daemon.send_command(core.get_daemon_socket(), argv)
+        if result is not None:
+            output, status = result
+            sys.stdout.write(output)
+            raise SystemExit(status)
+
+    main_local(argv)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])